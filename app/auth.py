@@ -1,16 +1,18 @@
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from enum import Enum
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Tuple
+from app.cache import TTLCache
+from app.passwords import password_hasher
 from app.database import db
 import logging
 from bson import ObjectId
 from fastapi import Request
 import os
+import time
 
 logger = logging.getLogger(__name__)
 # Configuración 
@@ -18,12 +20,26 @@ SECRET_KEY = os.getenv("SECRET_KEY", "NegdgE{=1BX_|,E>,qG14h@q%")  # Cambia esto
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+# Caché de usuarios autenticados por (user id, iat del token), solo con los campos que
+# leen las rutas (sin relationships, que no está acotado, ni hashed_password).
+# Se invalida al cambiar el perfil, la foto, las relaciones o la contraseña
+# (invalidate_principal); en los demás workers el cambio tarda como mucho el TTL.
+PRINCIPAL_PROJECTION = {
+    "username": 1, "role": 1, "version": 1, "profile_picture": 1,
+    # Arrays antiguos de amistad que aún consultan search_users y get_user_profile
+    "friends": 1, "friend_requests": 1
+}
+principal_cache = TTLCache(
+    "principals",
+    maxsize=int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+)
+# Payloads ya verificados por token; la expiración se vuelve a comprobar en cada uso
+token_cache = TTLCache("tokens", maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")), ttl=300)
+
 # Esquema de seguridad
 security = HTTPBearer()
 
-# Contexto para hashing de contraseñas
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 class UserRole(str, Enum):
     ADMIN = "admin"
     EDITOR = "editor"
@@ -47,12 +63,17 @@ class OptionalHTTPBearer(HTTPBearer):
 
 optional_security = OptionalHTTPBearer()
 
-# Funciones de utilidad
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+# Funciones de utilidad (bcrypt corre en un pool acotado; lanzan 503 si está saturado, ver app/passwords.py)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    verified, _ = await password_hasher.verify_and_update(plain_password, hashed_password)
+    return verified
 
-def get_password_hash(password: str):
-    return pwd_context.hash(password)
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Como verify_password, y además devuelve el hash nuevo si hay que rehacerlo (BCRYPT_ROUNDS cambió)"""
+    return await password_hasher.verify_and_update(plain_password, hashed_password)
+
+async def get_password_hash(password: str):
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -60,20 +81,53 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def decode_token(token: str) -> dict:
+    """Verifica el JWT (o reutiliza el payload ya verificado) y lanza JWTError si no es válido o expiró"""
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.set(token, payload)
+    elif payload.get("exp") is not None and payload["exp"] <= time.time():
+        token_cache.invalidate(token)
+        raise jwt.ExpiredSignatureError("Signature has expired.")
+    return payload
+
+async def load_principal(payload: dict) -> Optional[dict]:
+    """Usuario del token (por id; por username en tokens sin id) con PRINCIPAL_PROJECTION, desde la caché si está"""
+    user_id = payload.get("id")
+    key = (user_id or payload.get("sub"), payload.get("iat"))
+    user = principal_cache.get(key)
+    if user is not None:
+        return user
+
+    # Las cuentas en proceso de borrado ya no autentican
+    if user_id:
+        query = {"_id": ObjectId(user_id), "deleted_at": {"$exists": False}}
+    else:
+        query = {"username": payload.get("sub"), "deleted_at": {"$exists": False}}
+    user = await db.users.find_one(query, PRINCIPAL_PROJECTION)
+    if user:
+        principal_cache.set(key, user)
+    return user
+
+def invalidate_principal(*user_ids) -> None:
+    """Llamar tras cambiar el documento del usuario (perfil, fotos, relaciones, rol, contraseña o borrado)"""
+    ids = {str(user_id) for user_id in user_ids}
+    principal_cache.invalidate_where(lambda user: str(user["_id"]) in ids)
+
 # Funciones de verificación
 async def get_current_user_websocket(token: str):
     """Versión especial para WebSockets que devuelve el usuario o None"""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if not username:
+        payload = decode_token(token)
+        if not payload.get("sub"):
             return None
             
-        user = await db.users.find_one({"username": username})
+        user = await load_principal(payload)
         if user:
             user["_id"] = str(user["_id"])
         return user
@@ -110,8 +164,8 @@ async def optional_auth(credentials: Optional[HTTPAuthorizationCredentials] = De
         
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = await db.users.find_one({"username": payload["sub"]})
+        payload = decode_token(token)
+        user = await load_principal(payload)
         if user:
             user["_id"] = str(user["_id"])
         return user
@@ -123,7 +177,7 @@ def require_role(required_role: UserRole):
     async def dependency(credentials: HTTPAuthorizationCredentials = Depends(security)):
         try:
             token = credentials.credentials
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            payload = decode_token(token)
             
             
             # Verificar rol
@@ -133,8 +187,8 @@ def require_role(required_role: UserRole):
                     detail=f"Se requiere rol de {required_role.value}"
                 )
             
-            # Buscar por ID en lugar de username
-            user = await db.users.find_one({"_id": ObjectId(payload.get("id"))})
+            # Buscar por ID en lugar de username (desde la caché si está)
+            user = await load_principal(payload)
             if not user:
                 raise HTTPException(
                     status_code=status.HTTP_404_NOT_FOUND,
@@ -0,0 +1,84 @@
+# app/authors.py
+"""
+Tarjetas de autor (username y foto de perfil) resueltas al leer.
+
+Posts y comentarios guardan author_username/author_profile_picture tal como
+estaban al crearse, pero ya no se reescriben cuando el usuario cambia su
+perfil (eso era un update_many sobre todo lo que había escrito): las lecturas
+los sustituyen por la tarjeta actual del autor.
+
+Las tarjetas se piden en lote (una consulta $in por página) y se guardan en
+una caché por user id que se invalida al cambiar el perfil. Cada worker tiene
+su propia caché, así que en los demás el cambio tarda como mucho
+AUTHOR_CACHE_TTL segundos en verse.
+"""
+from bson import ObjectId
+from typing import Dict, Iterable, List
+from app.cache import TTLCache
+from app.database import db
+import os
+
+AUTHOR_CARD_PROJECTION = {"username": 1, "profile_picture": 1, "version": 1}
+
+# campo del documento -> campo de la tarjeta (posts y comentarios)
+AUTHOR_FIELD_MAP = {"author_username": "username", "author_profile_picture": "profile_picture"}
+# El feed además expone username/profile_picture
+FEED_AUTHOR_MAP = {**AUTHOR_FIELD_MAP, "username": "username", "profile_picture": "profile_picture"}
+
+author_cache = TTLCache(
+    "authors",
+    maxsize=int(os.getenv("AUTHOR_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("AUTHOR_CACHE_TTL", "30"))
+)
+
+
+def author_card(user: dict) -> dict:
+    return {
+        "username": user.get("username", ""),
+        "profile_picture": user.get("profile_picture") or "",
+        "version": user.get("version", 0)
+    }
+
+
+async def get_author_cards(author_ids: Iterable) -> Dict[str, dict]:
+    """Tarjetas de los autores indicados por id (str); las que no están en caché se leen en una sola consulta"""
+    cards = {}
+    missing = []
+    for author_id in {str(author_id) for author_id in author_ids if author_id}:
+        card = author_cache.get(author_id)
+        if card is None:
+            missing.append(author_id)
+        else:
+            cards[author_id] = card
+
+    object_ids = [ObjectId(author_id) for author_id in missing if ObjectId.is_valid(author_id)]
+    if object_ids:
+        async for user in db.users.find({"_id": {"$in": object_ids}}, AUTHOR_CARD_PROJECTION):
+            card = author_card(user)
+            author_cache.set(str(user["_id"]), card)
+            cards[str(user["_id"])] = card
+    return cards
+
+
+async def attach_author_cards(docs: List[dict], fields: Dict[str, str], loader=None) -> List[dict]:
+    """
+    Escribe en cada documento los datos actuales de su autor (`fields`: campo del
+    documento -> campo de la tarjeta). Si el autor ya no existe se conserva lo guardado.
+    Con `loader` (Loaders.authors de la petición) las tarjetas se comparten con el resto
+    de la petición; sin él se piden en una consulta propia.
+    """
+    if loader is None:
+        cards = await get_author_cards(doc.get("author_id") for doc in docs)
+    else:
+        author_ids = list({str(doc["author_id"]) for doc in docs if doc.get("author_id")})
+        cards = dict(zip(author_ids, await loader.load_many(author_ids)))
+    for doc in docs:
+        card = cards.get(str(doc.get("author_id")))  # None si el autor no existe
+        for doc_field, card_field in fields.items():
+            doc[doc_field] = card[card_field] if card else (doc.get(doc_field) or "")
+    return docs
+
+
+def invalidate_author(user_id) -> None:
+    """Llamar al cambiar username o foto de perfil"""
+    author_cache.invalidate(str(user_id))
@@ -0,0 +1,93 @@
+# app/cache.py
+"""
+Caché en memoria del proceso con expiración (TTL) y desalojo LRU.
+Cada worker tiene su propia copia: usar solo para datos que se invalidan
+explícitamente o que toleran unos segundos de retraso.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+import copy
+import os
+import time
+
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int = 1000, ttl: float = 60.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expira_en, valor)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Devuelve una copia del valor o None si no existe o expiró"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def patch(self, key: Hashable, fields: Dict[str, Any]):
+        """Actualiza campos de una entrada existente sin reiniciar su TTL"""
+        entry = self._entries.get(key)
+        if entry is not None and isinstance(entry[1], dict):
+            entry[1].update(copy.deepcopy(fields))
+
+    def invalidate(self, key: Hashable):
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]):
+        """
+        Invalida todas las entradas cuyo valor cumple el predicado (recorre la caché entera:
+        para invalidaciones poco frecuentes, p. ej. los posts de un usuario que se borra)
+        """
+        for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+            del self._entries[key]
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# Documentos de post (sin liked_by) servidos por GET /posts/{post_id}; los datos del
+# autor se añaden al leer desde las tarjetas de app/authors.py, no se guardan aquí
+post_cache = TTLCache(
+    "posts",
+    maxsize=int(os.getenv("POST_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("POST_CACHE_TTL", "60"))
+)
+
@@ -0,0 +1,274 @@
+# app/counters.py
+"""
+Buffer de escritura diferida (write-behind) para contadores calientes.
+
+Con COUNTER_BUFFER_ENABLED=true los $inc de likes_count / comments_count se
+acumulan en memoria por (colección, documento) y se escriben con un único
+bulk_write cada COUNTER_FLUSH_INTERVAL_MS o cada COUNTER_FLUSH_MAX_EVENTS
+eventos. Un post en tendencia pasa de N escrituras a una por intervalo.
+
+Las lecturas deben pasar los documentos por `counter_buffer.apply` para sumar
+los deltas pendientes. Al apagar la aplicación se hace un flush final.
+Si una escritura falla se reintentan solo los deltas que seguro no se aplicaron
+(los writeErrors de un BulkWriteError, o todo si no había servidor); con resultado
+desconocido se descartan y quedan en el log, porque reintentarlos podría duplicarlos.
+
+Desactivado (por defecto), cada incremento se escribe inmediatamente.
+
+Los campos derivados de los contadores (p. ej. posts.hot_score) se registran con
+`add_derived_field` y se recalculan en la misma escritura que los incrementa.
+"""
+from bson import ObjectId
+from collections import defaultdict
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from app.database import db
+import asyncio
+import inspect
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+COUNTER_BUFFER_ENABLED = os.getenv("COUNTER_BUFFER_ENABLED", "false").lower() in ("1", "true", "yes")
+COUNTER_FLUSH_INTERVAL_MS = int(os.getenv("COUNTER_FLUSH_INTERVAL_MS", "500"))
+COUNTER_FLUSH_MAX_EVENTS = int(os.getenv("COUNTER_FLUSH_MAX_EVENTS", "1000"))
+
+DocId = Union[ObjectId, str]
+# Puede ser una función normal o una corrutina
+FlushListener = Callable[[str, List[str]], Optional[Awaitable[None]]]
+
+
+class CounterBuffer:
+    def __init__(self, enabled: bool, interval_ms: int, max_events: int):
+        self.enabled = enabled
+        self.interval = interval_ms / 1000
+        self.max_events = max_events
+        # (colección, id) -> {"inc": {campo: delta}, "set": {campo: valor}}
+        self._pending: Dict[Tuple[str, str], dict] = {}
+        # Lote que se está escribiendo: sigue contando para las lecturas
+        self._flushing: Dict[Tuple[str, str], dict] = {}
+        self._events_since_flush = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self._listeners: List[FlushListener] = []
+        # colección -> {campo: expresión de agregación}
+        self._derived: Dict[str, dict] = {}
+        self.events = 0
+        self.flushes = 0
+        self.documents_written = 0
+        self.unknown_outcomes = 0
+
+    def add_derived_field(self, collection: str, field: str, expression: dict):
+        """Recalcula `field` con `expression` en cada escritura de contadores de la colección"""
+        self._derived.setdefault(collection, {})[field] = expression
+
+    def _update(self, collection: str, incs: Dict[str, int], sets: Optional[dict] = None) -> Union[dict, List[dict]]:
+        """
+        Update de los contadores. Con campos derivados es un pipeline (una sola escritura):
+        primero los incrementos, después los derivados con los valores ya incrementados.
+        Los campos incrementados son de primer nivel.
+        """
+        derived = self._derived.get(collection)
+        if not derived:
+            update = {"$inc": dict(incs)}
+            if sets:
+                update["$set"] = sets
+            return update
+
+        stage = {field: {"$add": [{"$ifNull": [f"${field}", 0]}, delta]} for field, delta in incs.items()}
+        for field, value in (sets or {}).items():
+            stage[field] = {"$literal": value}
+        return [{"$set": stage}, {"$set": dict(derived)}]
+
+    def add_flush_listener(self, listener: FlushListener):
+        """Se llama con (colección, ids) cada vez que los contadores llegan a la base de datos"""
+        self._listeners.append(listener)
+
+    async def _notify(self, collection: str, doc_ids: Iterable[str]):
+        doc_ids = list(doc_ids)
+        for listener in self._listeners:
+            try:
+                result = listener(collection, doc_ids)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error en listener de contadores: {str(e)}")
+
+    async def increment(self, collection: str, doc_id: DocId, incs: Dict[str, int], sets: Optional[dict] = None):
+        """Incrementa campos de un documento (diferido si el buffer está activo)"""
+        self.events += 1
+        if not self.enabled:
+            await db[collection].update_one({"_id": ObjectId(doc_id)}, self._update(collection, incs, sets))
+            await self._notify(collection, [str(doc_id)])
+            return
+
+        entry = self._pending.setdefault((collection, str(doc_id)), {"inc": defaultdict(int), "set": {}})
+        for field, delta in incs.items():
+            entry["inc"][field] += delta
+        if sets:
+            entry["set"].update(sets)
+
+        self._events_since_flush += 1
+        if self._events_since_flush >= self.max_events:
+            await self.flush()
+
+    async def increment_and_get(
+        self,
+        collection: str,
+        doc_id: DocId,
+        incs: Dict[str, int],
+        sets: Optional[dict] = None
+    ) -> Optional[dict]:
+        """
+        Incrementa y devuelve el documento con los contadores actualizados,
+        o None si el documento no existe.
+        """
+        if not self.enabled:
+            self.events += 1
+            doc = await db[collection].find_one_and_update(
+                {"_id": ObjectId(doc_id)},
+                self._update(collection, incs, sets),
+                return_document=ReturnDocument.AFTER
+            )
+            if doc:
+                await self._notify(collection, [str(doc_id)])
+            return doc
+
+        doc = await db[collection].find_one({"_id": ObjectId(doc_id)})
+        if not doc:
+            return None
+        await self.increment(collection, doc_id, incs, sets)
+        return self.apply(collection, doc)
+
+    def apply(self, collection: str, doc: dict) -> dict:
+        """Suma al documento los deltas pendientes (modifica y devuelve el mismo dict)"""
+        if not self.enabled or not doc or "_id" not in doc:
+            return doc
+        for batch in (self._flushing, self._pending):
+            entry = batch.get((collection, str(doc["_id"])))
+            if entry:
+                for field, delta in entry["inc"].items():
+                    doc[field] = (doc.get(field) or 0) + delta
+                doc.update(entry["set"])
+        return doc
+
+    async def flush(self):
+        """Escribe todos los deltas pendientes con un bulk_write por colección"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            self._events_since_flush = 0
+
+            by_collection: Dict[str, List[Tuple[str, dict]]] = defaultdict(list)
+            for (collection, doc_id), entry in self._flushing.items():
+                by_collection[collection].append((doc_id, entry))
+
+            # Lote enviado cuyo resultado se desconoce si el flush se cancela a mitad
+            in_flight: Optional[Tuple[str, List[Tuple[str, dict]]]] = None
+            try:
+                for collection, entries in by_collection.items():
+                    operations = []
+                    for doc_id, entry in entries:
+                        update = self._update(collection, entry["inc"], entry["set"])
+                        operations.append(UpdateOne({"_id": ObjectId(doc_id)}, update))
+                    in_flight = (collection, entries)
+                    try:
+                        await db[collection].bulk_write(operations, ordered=False)
+                        written = entries
+                    except BulkWriteError as e:
+                        # ordered=False: se aplicaron todas menos las de writeErrors, que vuelven al buffer
+                        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                        written = [item for index, item in enumerate(entries) if index not in failed]
+                        logger.error(
+                            f"Error escribiendo {len(failed)} de {len(entries)} contadores de {collection}; "
+                            f"se reintentan en el próximo flush: {e.details.get('writeErrors')}"
+                        )
+                    except ServerSelectionTimeoutError as e:
+                        # No se llegó a enviar nada: se reintenta entero
+                        written = []
+                        logger.error(f"Sin servidor para escribir contadores de {collection}; se reintentan: {str(e)}")
+                    except Exception as e:
+                        # Resultado desconocido (el servidor pudo aplicarlos): reintentar duplicaría incrementos
+                        self._discard_unknown(collection, entries, e)
+                        written = []
+                    in_flight = None
+
+                    for doc_id, _ in written:
+                        del self._flushing[(collection, doc_id)]
+                    if written:
+                        self.documents_written += len(written)
+                        await self._notify(collection, [doc_id for doc_id, _ in written])
+            finally:
+                if in_flight is not None:
+                    # Cancelado durante el bulk_write: mismo caso que un error desconocido
+                    self._discard_unknown(*in_flight, asyncio.CancelledError())
+                # Lo que no se llegó a enviar o falló con seguridad se reintenta en el próximo flush
+                for (collection, doc_id), entry in self._flushing.items():
+                    self._merge_back(collection, doc_id, entry)
+                self._flushing = {}
+
+            self.flushes += 1
+
+    def _discard_unknown(self, collection: str, entries: List[Tuple[str, dict]], error: BaseException):
+        """Saca del lote los deltas con resultado desconocido y los deja en el log para revisarlos"""
+        for doc_id, _ in entries:
+            self._flushing.pop((collection, doc_id), None)
+        self.unknown_outcomes += len(entries)
+        deltas = {doc_id: dict(entry["inc"]) for doc_id, entry in entries}
+        logger.error(
+            f"Resultado desconocido al escribir contadores de {collection} ({error!r}); "
+            f"no se reintentan para no duplicarlos: {deltas}"
+        )
+
+    def _merge_back(self, collection: str, doc_id: str, entry: dict):
+        current = self._pending.setdefault((collection, doc_id), {"inc": defaultdict(int), "set": {}})
+        for field, delta in entry["inc"].items():
+            current["inc"][field] += delta
+        # Los $set más recientes ganan
+        current["set"] = {**entry["set"], **current["set"]}
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+                break  # stop() hace el flush final
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error en flush periódico de contadores: {str(e)}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Buffer de contadores activo (cada {int(self.interval * 1000)} ms o {self.max_events} eventos)")
+
+    async def stop(self):
+        """Detiene el flush periódico y escribe lo pendiente para no perder actualizaciones"""
+        if self._task is not None:
+            # Sin cancelar: un flush en curso termina (o devuelve sus deltas al buffer) antes del final
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "events": self.events,
+            "flushes": self.flushes,
+            "documents_written": self.documents_written,
+            "pending_documents": len(self._pending),
+            "unknown_outcomes": self.unknown_outcomes,
+            # Escrituras evitadas frente a un $inc por evento
+            "writes_saved": max(self.events - self.documents_written, 0) if self.enabled else 0
+        }
+
+
+counter_buffer = CounterBuffer(COUNTER_BUFFER_ENABLED, COUNTER_FLUSH_INTERVAL_MS, COUNTER_FLUSH_MAX_EVENTS)
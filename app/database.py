@@ -1,4 +1,4 @@
-from pymongo import IndexModel, DESCENDING
+from pymongo import IndexModel, DESCENDING, TEXT
 from motor.motor_asyncio import AsyncIOMotorClient
 import logging
 import os
@@ -44,9 +44,13 @@ async def initialize_database():
         # Crear índices para la colección de notificaciones
         notification_indexes = [
             IndexModel([("user_id", 1)], name="user_id_index"),
+            IndexModel([("user_id", 1), ("created_at", DESCENDING)], name="user_created_index"),
             IndexModel([("read", 1)], name="read_status_index"),
             IndexModel([("created_at", DESCENDING)], name="created_at_desc_index"),
-            IndexModel([("type", 1)], name="notification_type_index")
+            IndexModel([("type", 1)], name="notification_type_index"),
+            IndexModel([("emitter_id", 1)], name="emitter_id_index"),
+            IndexModel([("related_post_id", 1)], name="related_post_id_index", sparse=True),
+            IndexModel([("post_id", 1)], name="post_id_index", sparse=True)
         ]
         
         await db.notifications.create_indexes(notification_indexes)
@@ -56,13 +60,27 @@ async def initialize_database():
         # Índices para posts (NUEVO)
         post_indexes = [
             IndexModel([("created_at", DESCENDING)], name="posts_created_at_desc"),
+            IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="posts_created_at_id_desc"),  # Paginación por cursor
             IndexModel([("author_id", 1)], name="posts_author_id"),
             IndexModel([("author_id", 1), ("created_at", DESCENDING)], name="posts_author_created"),
-            IndexModel([("liked_by", 1)], name="posts_liked_by")
+            IndexModel([("image_url", 1)], name="posts_image_url", sparse=True),  # Referencias a archivos subidos
+            IndexModel([("hot_score", DESCENDING), ("_id", DESCENDING)], name="posts_hot_score_id_desc"),  # Tendencias
+            # Búsqueda de texto: índice invertido con stemming en español (sin distinguir tildes)
+            IndexModel(
+                [("title", TEXT), ("content", TEXT)],
+                name="posts_text",
+                weights={"title": 3, "content": 1},
+                default_language="spanish"
+            )
         ]
         await db.posts.create_indexes(post_indexes)
         logger.info("Índices creados para la colección 'posts'")
 
+        # Los likes ya no se guardan en posts.liked_by
+        if "posts_liked_by" in (await db.posts.index_information()):
+            await db.posts.drop_index("posts_liked_by")
+            logger.info("Índice posts_liked_by eliminado")
+
         # Índices para users (NUEVO)
         # Eliminar todos los índices existentes en users
         await db.users.drop_indexes()
@@ -71,7 +89,10 @@ async def initialize_database():
         user_indexes = [
             IndexModel([("username", 1)], name="username_unique", unique=True),
             IndexModel([("email", 1)], name="email_unique", unique=True),
-            IndexModel([("relationships", 1)], name="relationships_index")
+            IndexModel([("relationships", 1)], name="relationships_index"),
+            # Referencias a archivos subidos (recolector de subidas huérfanas)
+            IndexModel([("profile_picture", 1)], name="users_profile_picture", sparse=True),
+            IndexModel([("cover_photo", 1)], name="users_cover_photo", sparse=True)
         ]
         await db.users.create_indexes(user_indexes)
         logger.info("Índices creados para la colección 'users'")
@@ -80,15 +101,72 @@ async def initialize_database():
         comment_indexes = [
             IndexModel([("post_id", 1)], name="comments_post_id"),
             IndexModel([("post_id", 1), ("created_at", DESCENDING)], name="comments_post_created"),
+            # Hilos: comentarios principales por post, respuestas por padre y subárboles por ruta
+            IndexModel(
+                [("post_id", 1), ("parent_id", 1), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                name="comments_post_parent_created"
+            ),
+            IndexModel(
+                [("parent_id", 1), ("created_at", 1), ("_id", 1)],
+                name="comments_parent_created",
+                partialFilterExpression={"parent_id": {"$type": "objectId"}}
+            ),
+            IndexModel([("post_id", 1), ("path", 1)], name="comments_post_path"),
             IndexModel([("author_id", 1)], name="comments_author_id")
         ]
         await db.comments.create_indexes(comment_indexes)
         logger.info("Índices creados para la colección 'comments'")
+
+        # Índices para images
+        # Galería paginada por cursor, con y sin filtro por tipo
+        image_indexes = [
+            IndexModel([("owner_id", 1), ("created_at", DESCENDING), ("_id", DESCENDING)], name="images_owner_created_id"),
+            IndexModel(
+                [("owner_id", 1), ("image_type", 1), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                name="images_owner_type_created_id"
+            ),
+            IndexModel([("url", 1)], name="images_url")
+        ]
+        await db.images.create_indexes(image_indexes)
+        logger.info("Índices creados para la colección 'images'")
+
+        # Reemplazado por images_owner_created_id (desempate por _id para el cursor)
+        if "images_owner_created" in (await db.images.index_information()):
+            await db.images.drop_index("images_owner_created")
+            logger.info("Índice images_owner_created eliminado")
+
+        image_comment_indexes = [
+            IndexModel([("image_id", 1), ("created_at", DESCENDING)], name="image_comments_image_created"),
+            IndexModel([("author_id", 1)], name="image_comments_author_id")
+        ]
+        await db.image_comments.create_indexes(image_comment_indexes)
+        logger.info("Índices creados para la colección 'image_comments'")
+
+        # Índices para el timeline de amigos (fan-out-on-write)
+        timeline_indexes = [
+            IndexModel([("owner_id", 1), ("created_at", DESCENDING), ("post_id", DESCENDING)], name="timeline_owner_created"),
+            IndexModel([("owner_id", 1), ("post_id", 1)], name="timeline_owner_post_unique", unique=True),
+            IndexModel([("post_id", 1)], name="timeline_post_id")
+        ]
+        await db.timelines.create_indexes(timeline_indexes)
+        logger.info("Índices creados para la colección 'timelines'")
+
+        # Índices para likes (aristas usuario -> post/imagen)
+        like_indexes = [
+            IndexModel([("target_type", 1), ("target_id", 1), ("user_id", 1)], name="likes_target_user_unique", unique=True),
+            IndexModel([("user_id", 1)], name="likes_user_id")
+        ]
+        await db.likes.create_indexes(like_indexes)
+        logger.info("Índices creados para la colección 'likes'")
+
+        # Índices para los trabajos de borrado en cascada
+        deletion_job_indexes = [
+            IndexModel([("kind", 1), ("target_id", 1)], name="deletion_jobs_target_unique", unique=True),
+            IndexModel([("status", 1), ("created_at", 1)], name="deletion_jobs_status_created")
+        ]
+        await db.deletion_jobs.create_indexes(deletion_job_indexes)
+        logger.info("Índices creados para la colección 'deletion_jobs'")
         
     except Exception as e:
         logger.error(f"Error al inicializar la base de datos: {str(e)}")
         raise
-
-# Llamar a la inicialización cuando el módulo se importe
-import asyncio
-asyncio.create_task(initialize_database())
\ No newline at end of file
@@ -0,0 +1,526 @@
+# app/deletion.py
+"""
+Borrado en cascada en segundo plano para posts y cuentas de usuario.
+
+La petición HTTP solo marca el documento con `deleted_at` (lápida) y encola
+un trabajo en `deletion_jobs`; todas las lecturas ignoran los documentos
+marcados. El worker ejecuta cada trabajo paso a paso, borrando en lotes de
+DELETION_BATCH_SIZE y guardando el progreso tras cada lote.
+
+Los pasos son idempotentes: si el proceso se reinicia a mitad de un trabajo,
+otro worker lo retoma desde su paso actual cuando vence su `lease_until`. Lo que
+no se puede repetir (descontar contadores, soltar referencias de subidas) se hace
+una sola vez por lote al marcarlo con el trabajo, ver _delete_in_batches.
+"""
+from bson import ObjectId
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from app.database import db
+from app.auth import invalidate_principal
+from app.cache import post_cache
+from app.counters import counter_buffer
+from app.likes import LIKE_TARGET_POST, LIKE_TARGET_IMAGE
+from app.uploads import is_object_url, release_reference, remove_upload_files
+import asyncio
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+DELETION_BATCH_SIZE = int(os.getenv("DELETION_BATCH_SIZE", "200"))
+DELETION_POLL_INTERVAL = float(os.getenv("DELETION_POLL_INTERVAL", "5"))
+# Tiempo que un worker se reserva un trabajo; si muere, otro lo retoma al vencer
+DELETION_LEASE_SECONDS = int(os.getenv("DELETION_LEASE_SECONDS", "60"))
+DELETION_MAX_ATTEMPTS = int(os.getenv("DELETION_MAX_ATTEMPTS", "5"))
+
+JOB_POST = "post"
+JOB_USER = "user"
+
+# Filtro para excluir documentos con lápida en las lecturas
+NOT_DELETED = {"deleted_at": {"$exists": False}}
+
+# Colección donde vive el contador likes_count de cada tipo de like
+LIKE_COLLECTIONS = {LIKE_TARGET_POST: "posts", LIKE_TARGET_IMAGE: "images"}
+
+UPLOADS_PREFIX = "/static/uploads/"
+
+# Trabajo que reclamó el documento para borrarlo (sus contadores ya se descontaron)
+CLAIMED_BY = "deletion_job"
+
+
+def _lease_until() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=DELETION_LEASE_SECONDS)
+
+
+async def _record_progress(job: dict, step: str, count: int, cursor: Optional[ObjectId] = None):
+    """Suma lo borrado en el paso y renueva el lease del trabajo"""
+    update = {
+        "$inc": {f"progress.{step}": count},
+        "$set": {"lease_until": _lease_until(), "updated_at": datetime.utcnow()}
+    }
+    if cursor is not None:
+        update["$set"]["cursor"] = cursor
+        job["cursor"] = cursor
+    await db.deletion_jobs.update_one({"_id": job["_id"]}, update)
+
+
+async def _delete_in_batches(
+    job: dict,
+    step: str,
+    collection,
+    query: dict,
+    projection: Optional[dict] = None,
+    on_batch: Optional[Callable[[List[dict]], Awaitable[None]]] = None,
+    on_claim: Optional[Callable[[List[dict]], Awaitable[None]]] = None
+):
+    """
+    Borra los documentos que cumplen `query` en lotes acotados. Cada lote:
+
+    1. Con `on_claim`, se marca con el trabajo (CLAIMED_BY) y se le pasa a `on_claim`
+       una sola vez: es para lo que no se puede repetir, como descontar contadores.
+       Un reintento retoma primero los documentos ya marcados y no lo vuelve a llamar
+       (si el proceso muere entre la marca y `on_claim` se pierde ese descuento, igual
+       que los incrementos aún en el buffer; se prefiere a descontar dos veces).
+    2. `on_batch` limpia los dependientes. Debe ser idempotente: tras un fallo se
+       repite con el mismo lote.
+    3. Por último se borran los documentos, así un fallo antes no pierde la limpieza.
+    """
+    projection = projection or {"_id": 1}
+    claimed = {**query, CLAIMED_BY: job["_id"]}
+    unclaimed = {**query, CLAIMED_BY: {"$exists": False}}
+    while True:
+        docs = []
+        if on_claim:
+            # Lote marcado por un intento anterior que no llegó a borrarse
+            docs = await collection.find(claimed, projection).limit(DELETION_BATCH_SIZE).to_list(DELETION_BATCH_SIZE)
+        if not docs:
+            docs = await collection.find(unclaimed if on_claim else query, projection).limit(DELETION_BATCH_SIZE).to_list(DELETION_BATCH_SIZE)
+            if not docs:
+                return
+            if on_claim:
+                await collection.update_many(
+                    {"_id": {"$in": [doc["_id"] for doc in docs]}, CLAIMED_BY: {"$exists": False}},
+                    {"$set": {CLAIMED_BY: job["_id"]}}
+                )
+                await on_claim(docs)
+        if on_batch:
+            await on_batch(docs)
+        result = await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        await _record_progress(job, step, result.deleted_count)
+
+
+async def delete_upload(url: Optional[str], deleted_user_id: Optional[ObjectId] = None, released: bool = False) -> bool:
+    """
+    Suelta la referencia de un documento a una subida y la borra del disco (con sus
+    variantes) si ya nadie la usa. Las subidas direccionadas por contenido llevan su
+    cuenta en `uploads`; en todos los casos se comprueba además que ningún post,
+    imagen ni foto de perfil o portada de un usuario siga apuntando a la URL (las
+    subidas antiguas conservan el nombre original, así que dos usuarios pueden
+    compartir archivo). Son las mismas referencias que mira el recolector de huérfanas.
+    `deleted_user_id`: usuario cuya cuenta se está borrando; sus fotos no cuentan.
+    `released`: la referencia ya se soltó (al reclamar el lote); así se puede repetir.
+    """
+    if not url or not url.startswith(UPLOADS_PREFIX):
+        return False
+    if is_object_url(url) and not released and await release_reference(url) > 0:
+        return False
+    if await db.posts.find_one({"image_url": url, **NOT_DELETED}, {"_id": 1}):
+        return False
+    # Las imágenes reclamadas por un borrado ya no cuentan
+    if await db.images.find_one({"url": url, CLAIMED_BY: {"$exists": False}}, {"_id": 1}):
+        return False
+    # Índices dispersos users_profile_picture / users_cover_photo
+    users_query = {"$or": [{"profile_picture": url}, {"cover_photo": url}]}
+    if deleted_user_id is not None:
+        users_query["_id"] = {"$ne": deleted_user_id}
+    if await db.users.find_one(users_query, {"_id": 1}):
+        return False
+    return await remove_upload_files(url)
+
+
+async def _decrement_counters(collection: str, counts: Dict[ObjectId, int], field: str):
+    for doc_id, count in counts.items():
+        await counter_buffer.increment(collection, doc_id, {field: -count, "version": 1})
+
+
+# --- Pasos del borrado de un post ---
+
+async def _post_timelines(job: dict):
+    await _delete_in_batches(job, "timelines", db.timelines, {"post_id": job["target_id"]})
+
+
+async def _post_comments(job: dict):
+    await _delete_in_batches(job, "comments", db.comments, {"post_id": job["target_id"]})
+
+
+async def _post_notifications(job: dict):
+    post_id = job["target_id"]
+    await _delete_in_batches(job, "notifications", db.notifications, {
+        "$or": [
+            {"related_post_id": str(post_id)},  # Likes sobre el post
+            {"post_id": post_id}                # Comentarios en el post
+        ]
+    })
+
+
+async def _post_likes(job: dict):
+    await _delete_in_batches(job, "likes", db.likes, {"target_type": LIKE_TARGET_POST, "target_id": job["target_id"]})
+
+
+async def _post_files(job: dict):
+    post = await db.posts.find_one({"_id": job["target_id"]}, {"image_url": 1})
+    if post and await delete_upload(post.get("image_url")):
+        await _record_progress(job, "files", 1)
+
+
+async def _post_document(job: dict):
+    result = await db.posts.delete_one({"_id": job["target_id"]})
+    post_cache.invalidate(str(job["target_id"]))
+    await _record_progress(job, "post", result.deleted_count)
+
+
+# --- Pasos del borrado de una cuenta ---
+
+async def _user_posts(job: dict):
+    """Encola un trabajo de borrado por cada post del usuario (recorrido por _id con cursor)"""
+    while True:
+        query = {"author_id": job["target_id"]}
+        if job.get("cursor"):
+            query["_id"] = {"$gt": job["cursor"]}
+        posts = await db.posts.find(query, {"_id": 1}).sort("_id", 1).limit(DELETION_BATCH_SIZE).to_list(DELETION_BATCH_SIZE)
+        if not posts:
+            return
+        for post in posts:
+            await enqueue_deletion(JOB_POST, post["_id"], wake=False)
+        await _record_progress(job, "posts", len(posts), cursor=posts[-1]["_id"])
+
+
+async def _user_comments(job: dict):
+    user_id = job["target_id"]
+
+    async def decrement_post_comments(comments: List[dict]):
+        counts = defaultdict(int)
+        replies = defaultdict(int)
+        for comment in comments:
+            counts[comment["post_id"]] += 1
+            if comment.get("parent_id"):
+                replies[comment["parent_id"]] += 1
+        await _decrement_counters("posts", counts, "comments_count")
+        for parent_id, count in replies.items():
+            await counter_buffer.increment("comments", parent_id, {"replies_count": -count})
+
+    async def delete_post_comment_subtrees(comments: List[dict]):
+        counts = defaultdict(int)
+        removed_replies = 0
+        for comment in comments:
+            # Las respuestas de otros usuarios se borran con el comentario (como en DELETE /comments/{id}):
+            # prefijo anclado sobre la ruta materializada (índice post_id + path). Los comentarios
+            # del lote ya están descontados; al repetirse solo cuenta lo que aún quedaba.
+            subtree_prefix = f"{comment.get('path') or ''}{comment['_id']},"
+            result = await db.comments.delete_many({
+                "post_id": comment["post_id"],
+                "path": {"$regex": f"^{re.escape(subtree_prefix)}"},
+                CLAIMED_BY: {"$ne": job["_id"]}
+            })
+            if result.deleted_count:
+                counts[comment["post_id"]] += result.deleted_count
+                removed_replies += result.deleted_count
+        await _decrement_counters("posts", counts, "comments_count")
+        if removed_replies:
+            await _record_progress(job, "comment_replies", removed_replies)
+
+    async def decrement_image_comments(comments: List[dict]):
+        counts = defaultdict(int)
+        for comment in comments:
+            if ObjectId.is_valid(str(comment.get("image_id"))):
+                counts[ObjectId(comment["image_id"])] += 1
+        await _decrement_counters("images", counts, "comments_count")
+
+    await _delete_in_batches(
+        job, "comments", db.comments, {"author_id": user_id},
+        {"post_id": 1, "parent_id": 1, "path": 1},
+        on_batch=delete_post_comment_subtrees, on_claim=decrement_post_comments
+    )
+    await _delete_in_batches(
+        job, "image_comments", db.image_comments, {"author_id": str(user_id)},
+        {"image_id": 1}, on_claim=decrement_image_comments
+    )
+
+
+async def _user_likes(job: dict):
+    async def decrement_likes(likes: List[dict]):
+        counts: Dict[Tuple[str, ObjectId], int] = defaultdict(int)
+        for like in likes:
+            counts[(like["target_type"], like["target_id"])] += 1
+        for (target_type, target_id), count in counts.items():
+            collection = LIKE_COLLECTIONS.get(target_type)
+            if collection:
+                await counter_buffer.increment(collection, target_id, {"likes_count": -count, "version": 1})
+
+    await _delete_in_batches(
+        job, "likes", db.likes, {"user_id": job["target_id"]},
+        {"target_type": 1, "target_id": 1}, on_claim=decrement_likes
+    )
+
+
+async def _user_notifications(job: dict):
+    user_id = job["target_id"]
+    await _delete_in_batches(job, "notifications", db.notifications, {
+        "$or": [{"user_id": user_id}, {"emitter_id": str(user_id)}]
+    })
+
+
+async def _user_images(job: dict):
+    async def release_files(images: List[dict]):
+        for image in images:
+            if is_object_url(image.get("url")):
+                await release_reference(image["url"])
+
+    async def delete_image_data(images: List[dict]):
+        image_ids = [image["_id"] for image in images]
+        await db.image_comments.delete_many({"image_id": {"$in": [str(image_id) for image_id in image_ids]}})
+        await db.likes.delete_many({"target_type": LIKE_TARGET_IMAGE, "target_id": {"$in": image_ids}})
+        for image in images:
+            if await delete_upload(image.get("url"), deleted_user_id=job["target_id"], released=True):
+                await _record_progress(job, "files", 1)
+
+    await _delete_in_batches(
+        job, "images", db.images, {"owner_id": job["target_id"]},
+        {"url": 1}, on_batch=delete_image_data, on_claim=release_files
+    )
+
+
+async def _user_files(job: dict):
+    """
+    Fotos de perfil y portada guardadas como URL directa en el usuario (se borran si nadie más las usa).
+    Las direccionadas por contenido son copia de la URL de una imagen de la galería y su
+    referencia ya la soltó _user_images.
+    """
+    user = await db.users.find_one({"_id": job["target_id"]}, {"profile_picture": 1, "cover_photo": 1})
+    for url in (user or {}).values():
+        if isinstance(url, str) and not is_object_url(url) and await delete_upload(url, deleted_user_id=job["target_id"]):
+            await _record_progress(job, "files", 1)
+
+
+async def _user_timeline(job: dict):
+    await _delete_in_batches(job, "timelines", db.timelines, {"owner_id": job["target_id"]})
+
+
+async def _user_relationships(job: dict):
+    user_id = str(job["target_id"])
+    # Los ids primero (la caché de usuarios autenticados no guarda relationships),
+    # y la escritura por _id
+    related_ids = await db.users.distinct("_id", {f"relationships.{user_id}": {"$exists": True}})
+    if not related_ids:
+        return
+    result = await db.users.update_many(
+        {"_id": {"$in": related_ids}},
+        {"$unset": {f"relationships.{user_id}": ""}, "$inc": {"version": 1}}
+    )
+    invalidate_principal(*related_ids)
+    await _record_progress(job, "relationships", result.modified_count)
+
+
+async def _user_document(job: dict):
+    result = await db.users.delete_one({"_id": job["target_id"]})
+    await _record_progress(job, "user", result.deleted_count)
+
+
+Step = Tuple[str, Callable[[dict], Awaitable[None]]]
+
+JOB_STEPS: Dict[str, List[Step]] = {
+    JOB_POST: [
+        ("timelines", _post_timelines),
+        ("comments", _post_comments),
+        ("notifications", _post_notifications),
+        ("likes", _post_likes),
+        ("files", _post_files),
+        ("post", _post_document),
+    ],
+    JOB_USER: [
+        ("posts", _user_posts),
+        ("comments", _user_comments),
+        ("likes", _user_likes),
+        ("notifications", _user_notifications),
+        ("images", _user_images),
+        ("files", _user_files),
+        ("timelines", _user_timeline),
+        ("relationships", _user_relationships),
+        ("user", _user_document),
+    ],
+}
+
+
+async def enqueue_deletion(kind: str, target_id: ObjectId, requested_by: Optional[str] = None, wake: bool = True) -> ObjectId:
+    """Crea el trabajo de borrado (o devuelve el existente: índice único kind + target_id)"""
+    now = datetime.utcnow()
+    try:
+        job = await db.deletion_jobs.find_one_and_update(
+            {"kind": kind, "target_id": target_id},
+            {"$setOnInsert": {
+                "status": "pending",
+                "step": 0,
+                "progress": {},
+                "attempts": 0,
+                "requested_by": requested_by,
+                "created_at": now,
+                "updated_at": now
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Otra petición lo creó a la vez
+        job = await db.deletion_jobs.find_one({"kind": kind, "target_id": target_id})
+    if wake:
+        deletion_worker.wake()
+    return job["_id"]
+
+
+async def request_post_deletion(post_id: ObjectId, requested_by: Optional[str] = None) -> Optional[ObjectId]:
+    """Lápida del post y trabajo de borrado. Devuelve None si el post no existe o ya estaba borrado"""
+    result = await db.posts.update_one(
+        {"_id": post_id, **NOT_DELETED},
+        {"$set": {"deleted_at": datetime.utcnow()}, "$inc": {"version": 1}}
+    )
+    if result.modified_count == 0:
+        return None
+    post_cache.invalidate(str(post_id))
+    return await enqueue_deletion(JOB_POST, post_id, requested_by)
+
+
+async def request_user_deletion(user_id: ObjectId, requested_by: Optional[str] = None) -> Optional[ObjectId]:
+    """Lápida del usuario y de sus posts, y trabajo de borrado de la cuenta"""
+    now = datetime.utcnow()
+    result = await db.users.update_one(
+        {"_id": user_id, **NOT_DELETED},
+        {"$set": {"deleted_at": now}, "$inc": {"version": 1}}
+    )
+    if result.modified_count == 0:
+        return None
+    # Deja de autenticar ya, sin esperar al TTL de la caché
+    invalidate_principal(user_id)
+    # Una sola escritura por índice (author_id): los posts desaparecen de las lecturas ya
+    await db.posts.update_many(
+        {"author_id": user_id, **NOT_DELETED},
+        {"$set": {"deleted_at": now}, "$inc": {"version": 1}}
+    )
+    post_cache.invalidate_where(lambda post: str(post.get("author_id")) == str(user_id))
+    return await enqueue_deletion(JOB_USER, user_id, requested_by)
+
+
+class DeletionWorker:
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self._wake_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._current_job: Optional[ObjectId] = None
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+
+    def wake(self):
+        """Despierta al worker cuando se encola un trabajo nuevo"""
+        self._wake_event.set()
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await db.deletion_jobs.find_one_and_update(
+            {
+                "status": {"$in": ["pending", "running"]},
+                "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]
+            },
+            {
+                "$set": {"status": "running", "lease_until": _lease_until(), "updated_at": now},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def run_job(self, job: dict):
+        """Ejecuta los pasos pendientes del trabajo, empezando por `step`"""
+        steps = JOB_STEPS[job["kind"]]
+        for index in range(job.get("step", 0), len(steps)):
+            name, step = steps[index]
+            await step(job)
+            await db.deletion_jobs.update_one(
+                {"_id": job["_id"]},
+                {"$set": {"step": index + 1, "cursor": None, "updated_at": datetime.utcnow()}}
+            )
+            job["cursor"] = None
+
+        await db.deletion_jobs.update_one(
+            {"_id": job["_id"]},
+            {
+                "$set": {"status": "done", "finished_at": datetime.utcnow()},
+                "$unset": {"lease_until": "", "error": ""}
+            }
+        )
+        logger.info(f"Borrado de {job['kind']} {job['target_id']} completado: {job.get('progress', {})}")
+
+    async def _fail(self, job: dict, error: Exception):
+        logger.error(f"Error en borrado de {job['kind']} {job['target_id']}: {str(error)}")
+        if job.get("attempts", 0) >= DELETION_MAX_ATTEMPTS:
+            update = {"$set": {"status": "failed", "error": str(error)}, "$unset": {"lease_until": ""}}
+            self.jobs_failed += 1
+        else:
+            # Reintentar más tarde desde el mismo paso
+            update = {"$set": {"error": str(error), "lease_until": _lease_until()}}
+        await db.deletion_jobs.update_one({"_id": job["_id"]}, update)
+
+    async def _run(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Error buscando trabajos de borrado: {str(e)}")
+                job = None
+
+            if job:
+                self._current_job = job["_id"]
+                try:
+                    await self.run_job(job)
+                    self.jobs_completed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    await self._fail(job, e)
+                finally:
+                    self._current_job = None
+                continue
+
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake_event.clear()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detiene el worker y libera el trabajo en curso para que se retome al arrancar"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._current_job is not None:
+            await db.deletion_jobs.update_one({"_id": self._current_job}, {"$unset": {"lease_until": ""}})
+            self._current_job = None
+
+    async def stats(self) -> dict:
+        by_status = {}
+        async for row in db.deletion_jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            by_status[row["_id"]] = row["count"]
+        return {
+            "jobs": by_status,
+            "completed_by_worker": self.jobs_completed,
+            "failed_by_worker": self.jobs_failed
+        }
+
+
+deletion_worker = DeletionWorker(DELETION_POLL_INTERVAL)
@@ -0,0 +1,163 @@
+# app/image_variants.py
+"""
+Variantes derivadas de las imágenes subidas (miniaturas y tamaños responsive en WebP/AVIF).
+
+Las variantes dependen del tipo de subida (`kind`: posts, profile_pictures,
+cover_photos), porque el mismo archivo puede ser a la vez foto de perfil
+(recorte cuadrado) y portada. Para /static/uploads/objects/ab/cd/<sha>.<ext>
+se generan /static/uploads/variants/<kind>/ab/cd/<sha>_<tamaño>.<formato>
+(las subidas antiguas fuera de objects/ conservan su ruta relativa). Las rutas
+se deducen de la URL, así que cualquier proceso puede calcularlas sin
+consultar la base de datos.
+
+Decodificar y recodificar imágenes es trabajo de CPU: se hace en un
+ProcessPoolExecutor para no bloquear el event loop ni competir por el GIL.
+Este módulo no importa la base de datos porque los procesos hijos lo vuelven
+a importar (contexto "spawn").
+"""
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps, features
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import multiprocessing
+import os
+
+UPLOADS_PREFIX = "/static/uploads/"
+OBJECTS_SUBDIR = "objects/"
+VARIANTS_DIR = "variants"
+
+# tipo de subida -> {nombre de la variante: (ancho máximo en px, recorte cuadrado)}
+VARIANT_SPECS: Dict[str, Dict[str, Tuple[int, bool]]] = {
+    "profile_pictures": {"thumb": (48, True), "small": (96, True), "medium": (256, True)},
+    "cover_photos": {"small": (640, False), "large": (1280, False)},
+    "posts": {"thumb": (320, False), "medium": (720, False), "large": (1280, False)},
+}
+
+# images.image_type -> tipo de subida
+IMAGE_TYPE_KINDS = {"profile_picture": "profile_pictures", "cover_photo": "cover_photos"}
+
+# Solo los formatos que el Pillow instalado sabe codificar
+VARIANT_FORMATS = [
+    fmt for fmt in (
+        name.strip().lower() for name in os.getenv("IMAGE_VARIANT_FORMATS", "webp,avif").split(",")
+    )
+    if fmt and features.check(fmt)
+]
+VARIANT_QUALITY = {"webp": 80, "avif": 55}
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _relative_stem(url: Optional[str]) -> Optional[str]:
+    """Ruta de la subida relativa a static/uploads (sin extensión), o None si no es una subida"""
+    if not url or not url.startswith(UPLOADS_PREFIX):
+        return None
+    relative = url[len(UPLOADS_PREFIX):]
+    if relative.startswith(OBJECTS_SUBDIR):
+        relative = relative[len(OBJECTS_SUBDIR):]
+    return os.path.splitext(relative)[0] or None
+
+
+def _variant_relpath(kind: str, stem: str, size: str, fmt: str) -> str:
+    return f"{UPLOADS_PREFIX}{VARIANTS_DIR}/{kind}/{stem}_{size}.{fmt}"
+
+
+def variant_urls(url: Optional[str], kind: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """URLs de las variantes de una subida: {"thumb": {"webp": ..., "avif": ...}, ...}"""
+    stem = _relative_stem(url)
+    if stem is None or kind not in VARIANT_SPECS or not VARIANT_FORMATS:
+        return None
+    return {
+        size: {fmt: _variant_relpath(kind, stem, size, fmt) for fmt in VARIANT_FORMATS}
+        for size in VARIANT_SPECS[kind]
+    }
+
+
+def variant_paths(url: Optional[str], kinds: Optional[List[str]] = None) -> List[str]:
+    """Rutas en disco de las variantes de los tipos indicados (todos por defecto), para borrarlas con el original"""
+    paths = []
+    for kind in kinds or VARIANT_SPECS:
+        variants = variant_urls(url, kind) or {}
+        paths.extend(path.lstrip("/") for formats in variants.values() for path in formats.values())
+    return paths
+
+
+def _render_variants(source_path: str, targets: List[Tuple[str, int, bool, str, int]]) -> int:
+    """
+    Se ejecuta en un proceso del pool. Abre la imagen una sola vez y escribe cada
+    variante en un temporal que luego se renombra (nunca se sirve una variante a medias).
+    No amplía imágenes más pequeñas que el tamaño pedido.
+    """
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+        resized = {}
+        written = 0
+        for path, width, square, fmt, quality in targets:
+            key = (width, square)
+            if key not in resized:
+                if square:
+                    side = min(width, image.width, image.height)
+                    resized[key] = ImageOps.fit(image, (side, side), Image.LANCZOS)
+                elif image.width > width:
+                    height = max(1, round(image.height * width / image.width))
+                    resized[key] = image.resize((width, height), Image.LANCZOS)
+                else:
+                    resized[key] = image
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.part"
+            resized[key].save(temp_path, format=fmt.upper(), quality=quality)
+            os.replace(temp_path, path)
+            written += 1
+        return written
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # "spawn" para no hacer fork de un proceso con el event loop y los hilos de Motor
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+async def generate_variants(url: str, kind: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """
+    Genera todas las variantes de una subida en el pool de procesos y devuelve sus URLs.
+    Propaga los errores de Pillow (p. ej. UnidentifiedImageError si el archivo no es una imagen válida).
+    """
+    variants = variant_urls(url, kind)
+    if variants is None:
+        return None
+    stem = _relative_stem(url)
+
+    targets = [
+        (_variant_relpath(kind, stem, size, fmt).lstrip("/"), width, square, fmt, VARIANT_QUALITY.get(fmt, 80))
+        for size, (width, square) in VARIANT_SPECS[kind].items()
+        for fmt in VARIANT_FORMATS
+    ]
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_get_pool(), _render_variants, url.lstrip("/"), targets)
+    return variants
+
+
+async def existing_variant_urls(url: Optional[str], kind: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """Las URLs de las variantes solo si ya se generaron (se comprueba la última que se escribe)"""
+    paths = variant_paths(url, [kind])
+    if not paths or not await asyncio.to_thread(os.path.exists, paths[-1]):
+        return None
+    return variant_urls(url, kind)
+
+
+def shutdown_image_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,81 @@
+# app/likes.py
+"""
+Likes guardados como aristas en la colección `likes`:
+{target_type, target_id, user_id, created_at}, con índice único
+(target_type, target_id, user_id). Los documentos de posts e imágenes solo
+guardan el contador desnormalizado `likes_count`.
+"""
+from bson import ObjectId
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+from typing import Iterable, Set, Union
+from app.database import db
+
+LIKE_TARGET_POST = "post"
+LIKE_TARGET_IMAGE = "image"
+
+
+def _oid(value: Union[ObjectId, str]) -> ObjectId:
+    return value if isinstance(value, ObjectId) else ObjectId(value)
+
+
+async def add_like(target_type: str, target_id: Union[ObjectId, str], user_id: Union[ObjectId, str]) -> bool:
+    """Registra el like. Devuelve False si el usuario ya había dado like"""
+    try:
+        await db.likes.insert_one({
+            "target_type": target_type,
+            "target_id": _oid(target_id),
+            "user_id": _oid(user_id),
+            "created_at": datetime.utcnow()
+        })
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def remove_like(target_type: str, target_id: Union[ObjectId, str], user_id: Union[ObjectId, str]) -> bool:
+    """Elimina el like. Devuelve False si no existía"""
+    result = await db.likes.delete_one({
+        "target_type": target_type,
+        "target_id": _oid(target_id),
+        "user_id": _oid(user_id)
+    })
+    return result.deleted_count == 1
+
+
+async def has_liked(target_type: str, target_id: Union[ObjectId, str], user_id: Union[ObjectId, str]) -> bool:
+    like = await db.likes.find_one(
+        {
+            "target_type": target_type,
+            "target_id": _oid(target_id),
+            "user_id": _oid(user_id)
+        },
+        {"_id": 1}
+    )
+    return like is not None
+
+
+async def liked_target_ids(
+    target_type: str,
+    target_ids: Iterable[Union[ObjectId, str]],
+    user_id: Union[ObjectId, str]
+) -> Set[str]:
+    """
+    IDs (string) de los objetivos a los que el usuario dio like,
+    resuelto con una sola consulta $in para toda una página.
+    """
+    target_oids = [_oid(target_id) for target_id in target_ids]
+    if not target_oids:
+        return set()
+
+    liked = set()
+    async for like in db.likes.find(
+        {
+            "target_type": target_type,
+            "target_id": {"$in": target_oids},
+            "user_id": _oid(user_id)
+        },
+        {"target_id": 1, "_id": 0}
+    ):
+        liked.add(str(like["target_id"]))
+    return liked
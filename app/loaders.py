@@ -0,0 +1,95 @@
+# app/loaders.py
+"""
+Carga por lotes con alcance de petición, al estilo DataLoader.
+
+Las llamadas a `load(key)` hechas en el mismo ciclo del event loop (p. ej. desde
+un asyncio.gather o un bucle que crea tareas) se agrupan en una sola llamada a
+la función de lote, que resuelve todas las claves con una consulta `$in`.
+Cada loader memoiza sus resultados, así que pedir dos veces la misma clave en
+una petición no repite la consulta.
+
+Las rutas reciben un `Loaders` nuevo por petición con `Depends(get_loaders)`;
+no se comparte entre peticiones (para eso están las cachés de app/cache.py).
+"""
+from bson import ObjectId
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+from app.authors import get_author_cards
+from app.database import db
+import asyncio
+
+BatchFunction = Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]
+
+
+class DataLoader:
+    def __init__(self, batch_fn: BatchFunction, max_batch_size: int = 1000):
+        """`batch_fn` recibe una lista de claves y devuelve {clave: valor}; las que falten se resuelven como None"""
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[Hashable] = []
+        self.batches = 0
+
+    async def load(self, key: Hashable) -> Optional[Any]:
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[key] = future
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # Se despacha cuando terminen de ejecutarse las tareas ya listas en este ciclo
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: Iterable[Hashable]) -> List[Optional[Any]]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def prime(self, key: Hashable, value: Any):
+        """Guarda un valor ya conocido (p. ej. el usuario autenticado) para no consultarlo"""
+        if key not in self._futures:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(value)
+            self._futures[key] = future
+
+    async def _dispatch(self):
+        queue, self._queue = self._queue, []
+        for start in range(0, len(queue), self.max_batch_size):
+            keys = queue[start:start + self.max_batch_size]
+            self.batches += 1
+            try:
+                results = await self.batch_fn(keys)
+            except Exception as e:
+                for key in keys:
+                    # Sin memoizar el error: otra llamada puede reintentar
+                    future = self._futures.pop(key)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for key in keys:
+                future = self._futures[key]
+                if not future.done():
+                    future.set_result(results.get(key))
+
+
+async def get_image_urls(image_ids: List[Hashable]) -> Dict[Hashable, str]:
+    """URL de cada imagen de la galería (por id, str u ObjectId) en una consulta $in; los ids vacíos o inválidos no consultan"""
+    keys = {ObjectId(str(image_id)): image_id for image_id in image_ids if image_id and ObjectId.is_valid(str(image_id))}
+    urls = {}
+    if keys:
+        async for image in db.images.find({"_id": {"$in": list(keys)}}, {"url": 1}):
+            urls[keys[image["_id"]]] = image.get("url")
+    return urls
+
+
+class Loaders:
+    """Loaders de una petición"""
+    def __init__(self):
+        # Tarjetas de autor por user id (str); usa la caché compartida de app/authors.py
+        self.authors = DataLoader(get_author_cards)
+        # URL de imágenes de la galería por id (current_profile_picture, current_cover_photo...)
+        self.image_urls = DataLoader(get_image_urls)
+
+
+def get_loaders() -> Loaders:
+    """Dependencia de FastAPI: un conjunto de loaders nuevo por petición"""
+    return Loaders()
@@ -1,16 +1,23 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from app.routes import user_routes, post_routes, comment_routes, notifications, friendship_routes, images
+from app.routes import user_routes, post_routes, comment_routes, notifications, friendship_routes, images, metrics
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Dict, List
 from app.websocket_manager import manager
 from app.auth import get_current_user_websocket
+from app.database import initialize_database
+from app.maintenance import run_startup_tasks
+from app.counters import counter_buffer
+from app.deletion import deletion_worker
+from app.image_variants import shutdown_image_pool
+from app.passwords import password_hasher
 from fastapi import status
 from fastapi import Query
 from datetime import datetime
 import json
 import logging
 from dotenv import load_dotenv
-from fastapi.staticfiles import StaticFiles 
+from app.media import MediaFiles
+from app.utils.util import UploadSizeLimitMiddleware
 import asyncio
 import time
 ## 
@@ -21,7 +28,25 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+@app.on_event("startup")
+async def startup():
+    await initialize_database()
+    # Migraciones idempotentes en segundo plano para no retrasar el arranque
+    asyncio.create_task(run_startup_tasks())
+    counter_buffer.start()
+    # Retoma también los borrados en cascada que quedaron a medias
+    deletion_worker.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await deletion_worker.stop()
+    # Escribir los contadores pendientes antes de salir
+    await counter_buffer.stop()
+    shutdown_image_pool()
+    password_hasher.shutdown()
+
+# Caché inmutable para las subidas con nombre de hash/UUID, ETag y Range (ver app/media.py)
+app.mount("/static", MediaFiles(directory="static"), name="static")
 
 # Configuración CORS actualizada
 origins = [
@@ -29,6 +54,10 @@ origins = [
     "http://127.0.0.1:5173",  # Alternativa para localhost
 ]
 
+# Rechaza las subidas demasiado grandes antes de recibir y parsear el cuerpo
+# (se añade antes que CORS para que el 413 también lleve sus cabeceras)
+app.add_middleware(UploadSizeLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -156,4 +185,5 @@ app.include_router(post_routes.router, prefix="/api")
 app.include_router(comment_routes.router, prefix="/api")
 app.include_router(notifications.router, prefix="/api")
 app.include_router(friendship_routes.router, prefix="/api")
-app.include_router(images.router, prefix="/api")  # Añade esta línea para el router de imágenes
\ No newline at end of file
+app.include_router(images.router, prefix="/api")  # Añade esta línea para el router de imágenes
+app.include_router(metrics.router, prefix="/api")
\ No newline at end of file
@@ -0,0 +1,289 @@
+# app/maintenance.py
+"""
+Tareas de mantenimiento (migraciones y backfills).
+
+Todas son idempotentes: se pueden relanzar sin duplicar datos.
+Uso desde la raíz del proyecto:
+
+    python -m app.maintenance migrate-likes
+    python -m app.maintenance migrate-reference-ids
+    python -m app.maintenance check-query-plans
+    python -m app.maintenance backfill-hot-scores
+    python -m app.maintenance backfill-image-variants
+    python -m app.maintenance gc-uploads-dry-run
+    python -m app.maintenance gc-uploads
+"""
+from bson import ObjectId
+from datetime import datetime
+from functools import partial
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from typing import Optional
+from app.database import db
+from app.likes import LIKE_TARGET_POST, LIKE_TARGET_IMAGE
+from app.trending import backfill_hot_scores
+from app.deletion import NOT_DELETED
+from app.uploads import collect_orphan_uploads
+from app.image_variants import IMAGE_TYPE_KINDS, IMAGE_WORKERS, generate_variants, variant_urls
+import asyncio
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+async def _insert_likes(likes: list):
+    """Inserta likes ignorando los que ya existen"""
+    if not likes:
+        return
+    try:
+        await db.likes.insert_many(likes, ordered=False)
+    except BulkWriteError as e:
+        real_errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+        if real_errors:
+            raise
+
+
+async def migrate_liked_by_to_likes(batch_size: int = BATCH_SIZE) -> dict:
+    """
+    Mueve los arrays `liked_by` de posts e imágenes a la colección `likes`
+    y los elimina de los documentos. `likes_count` se recalcula a partir del array.
+    """
+    migrated = {}
+    for collection, target_type in ((db.posts, LIKE_TARGET_POST), (db.images, LIKE_TARGET_IMAGE)):
+        count = 0
+        likes, updates = [], []
+        cursor = collection.find(
+            {"liked_by": {"$exists": True}},
+            {"liked_by": 1}
+        ).batch_size(batch_size)
+
+        async for doc in cursor:
+            user_ids = {str(user_id) for user_id in doc.get("liked_by") or [] if ObjectId.is_valid(str(user_id))}
+            likes.extend(
+                {
+                    "target_type": target_type,
+                    "target_id": doc["_id"],
+                    "user_id": ObjectId(user_id),
+                    "created_at": datetime.utcnow()
+                }
+                for user_id in user_ids
+            )
+            updates.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"likes_count": len(user_ids)}, "$unset": {"liked_by": ""}}
+            ))
+
+            if len(updates) >= batch_size:
+                # Primero los likes: si algo falla, el array sigue en el documento
+                await _insert_likes(likes)
+                await collection.bulk_write(updates, ordered=False)
+                count += len(updates)
+                likes, updates = [], []
+
+        await _insert_likes(likes)
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+            count += len(updates)
+
+        migrated[target_type] = count
+        logger.info(f"Migrados likes de {count} documentos ({target_type})")
+
+    return migrated
+
+
+# Referencias que se guardaban como string y ahora son ObjectId
+REFERENCE_FIELDS = {
+    "posts": ["author_id"],
+    "comments": ["post_id", "author_id"],
+    "images": ["owner_id"],
+    "notifications": ["user_id", "post_id"],
+}
+
+
+async def migrate_reference_ids() -> dict:
+    """
+    Convierte a ObjectId las referencias guardadas como string para que los
+    $lookup con localField/foreignField y los filtros usen los índices.
+    Los valores que no son un ObjectId válido se dejan como están.
+    """
+    migrated = {}
+    for collection_name, fields in REFERENCE_FIELDS.items():
+        for field in fields:
+            result = await db[collection_name].update_many(
+                {field: {"$type": "string"}},
+                [{"$set": {field: {"$convert": {"input": f"${field}", "to": "objectId", "onError": f"${field}"}}}}]
+            )
+            migrated[f"{collection_name}.{field}"] = result.modified_count
+            if result.modified_count:
+                logger.info(f"Convertidas {result.modified_count} referencias {collection_name}.{field}")
+    return migrated
+
+
+def _plan_problems(plan, path: str = "") -> list:
+    """Busca COLLSCAN y $lookup que recorren la colección completa en un explain"""
+    problems = []
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            problems.append(f"COLLSCAN en {path or 'raíz'}")
+        if "$lookup" in plan and plan.get("collectionScans"):
+            problems.append(f"$lookup {plan['$lookup'].get('from')} con {plan['collectionScans']} collectionScans")
+        for key, value in plan.items():
+            problems.extend(_plan_problems(value, f"{path}.{key}" if path else key))
+    elif isinstance(plan, list):
+        for index, value in enumerate(plan):
+            problems.extend(_plan_problems(value, f"{path}[{index}]"))
+    return problems
+
+
+async def _explain(command: dict) -> dict:
+    return await db.command({"explain": command, "verbosity": "executionStats"})
+
+
+async def check_query_plans() -> dict:
+    """
+    Ejecuta explain("executionStats") sobre las consultas calientes y falla
+    (código de salida 1 desde la CLI) si alguna recorre una colección entera.
+    Necesita al menos un usuario, un post y un comentario para tener datos de ejemplo.
+    """
+    # Importación diferida: las rutas importan este módulo indirectamente vía main
+    from app.routes.post_routes import post_detail_pipeline, user_posts_pipeline
+    from app.routes.comment_routes import comments_pipeline
+
+    post = await db.posts.find_one({}, {"_id": 1, "author_id": 1})
+    if not post:
+        return {"skipped": "No hay posts para generar los planes"}
+    author_id = post["author_id"]
+
+    checks = {
+        "get_post": {"aggregate": "posts", "pipeline": post_detail_pipeline(post["_id"]), "cursor": {}},
+        "get_comments": {"aggregate": "comments", "pipeline": comments_pipeline(post["_id"], 0, 20), "cursor": {}},
+        "get_user_posts": {"aggregate": "users", "pipeline": user_posts_pipeline(author_id, 0, 10), "cursor": {}},
+        "feed": {
+            "aggregate": "posts",
+            "pipeline": [{"$match": NOT_DELETED}, {"$sort": {"created_at": -1, "_id": -1}}, {"$limit": 11}],
+            "cursor": {}
+        },
+        "notifications": {
+            "find": "notifications",
+            "filter": {"user_id": author_id},
+            "sort": {"created_at": -1},
+            "limit": 100
+        },
+        "user_images": {
+            "find": "images",
+            "filter": {"owner_id": author_id},
+            "sort": {"created_at": -1, "_id": -1},
+            "limit": 51
+        },
+        "user_images_by_type": {
+            "find": "images",
+            "filter": {"owner_id": author_id, "image_type": "profile_picture"},
+            "sort": {"created_at": -1, "_id": -1},
+            "limit": 51
+        },
+    }
+
+    report = {}
+    for name, command in checks.items():
+        problems = _plan_problems(await _explain(command))
+        report[name] = problems or "ok"
+        if problems:
+            logger.error(f"Plan de {name}: {'; '.join(problems)}")
+    return report
+
+
+async def _generate_for_backfill(url: str, kind: Optional[str], report: dict):
+    """Genera las variantes de un archivo existente; devuelve sus URLs o None si no se pudo"""
+    if not kind or not variant_urls(url, kind):
+        report["skipped"] += 1
+        return None
+    if not await asyncio.to_thread(os.path.exists, url.lstrip("/")):
+        report["missing_files"] += 1
+        return None
+    try:
+        variants = await generate_variants(url, kind)
+    except Exception as e:
+        logger.error(f"No se pudieron generar las variantes de {url}: {str(e)}")
+        report["failed"] += 1
+        return None
+    report["generated"] += 1
+    return variants
+
+
+async def backfill_image_variants() -> dict:
+    """
+    Genera miniaturas y versiones WebP/AVIF de las imágenes subidas antes de que
+    existiera el pipeline y las guarda en images.variants y posts.image_variants.
+    Procesa IMAGE_WORKERS archivos a la vez (uno por proceso del pool).
+    """
+    report = {"generated": 0, "skipped": 0, "missing_files": 0, "failed": 0, "images": 0, "posts": 0}
+
+    async def backfill_image(image: dict):
+        variants = await _generate_for_backfill(image["url"], IMAGE_TYPE_KINDS.get(image.get("image_type")), report)
+        if variants:
+            await db.images.update_one({"_id": image["_id"]}, {"$set": {"variants": variants}})
+            report["images"] += 1
+
+    async def backfill_post_image(url: str):
+        variants = await _generate_for_backfill(url, "posts", report)
+        if variants:
+            result = await db.posts.update_many(
+                {"image_url": url, "image_variants": None},
+                {"$set": {"image_variants": variants}}
+            )
+            report["posts"] += result.modified_count
+
+    batch = []
+    async for image in db.images.find({"variants": None}, {"url": 1, "image_type": 1}):
+        batch.append(backfill_image(image))
+        if len(batch) >= IMAGE_WORKERS:
+            await asyncio.gather(*batch)
+            batch = []
+    await asyncio.gather(*batch)
+
+    # Varios posts pueden compartir archivo: se procesa cada URL una vez
+    post_urls = await db.posts.distinct(
+        "image_url",
+        {"image_url": {"$regex": "^/static/uploads/"}, "image_variants": None, **NOT_DELETED}
+    )
+    for start in range(0, len(post_urls), IMAGE_WORKERS):
+        await asyncio.gather(*(backfill_post_image(url) for url in post_urls[start:start + IMAGE_WORKERS]))
+
+    logger.info(f"Variantes de imágenes: {report}")
+    return report
+
+
+TASKS = {
+    "migrate-likes": migrate_liked_by_to_likes,
+    "migrate-reference-ids": migrate_reference_ids,
+    "check-query-plans": check_query_plans,
+    "backfill-hot-scores": backfill_hot_scores,
+    "backfill-image-variants": backfill_image_variants,
+    "gc-uploads": collect_orphan_uploads,
+    "gc-uploads-dry-run": partial(collect_orphan_uploads, dry_run=True),
+}
+
+
+async def run_startup_tasks():
+    """Migraciones que se aplican solas al arrancar la aplicación"""
+    try:
+        await migrate_reference_ids()
+        await migrate_liked_by_to_likes()
+        await backfill_hot_scores()
+    except Exception as e:
+        logger.error(f"Error en migraciones de arranque: {str(e)}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2 or sys.argv[1] not in TASKS:
+        print(f"Uso: python -m app.maintenance [{'|'.join(TASKS)}]")
+        sys.exit(1)
+    result = asyncio.run(TASKS[sys.argv[1]]())
+    print(result)
+    if sys.argv[1] == "check-query-plans" and any(isinstance(value, list) for value in result.values()):
+        sys.exit(1)
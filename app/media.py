@@ -0,0 +1,111 @@
+# app/media.py
+"""
+Servidor de archivos estáticos para /static con política de caché.
+
+- Los archivos cuyo nombre es un hash de contenido (static/uploads/objects y sus
+  variantes) o un UUID no cambian nunca: se sirven con
+  `Cache-Control: public, max-age=<1 año>, immutable` y el navegador no vuelve a pedirlos.
+  El resto (subidas antiguas que conservan el nombre original) se revalida siempre.
+- ETag fuerte: el propio hash para los archivos direccionados por contenido; para el
+  resto el de Starlette (tamaño + fecha de modificación).
+- Si existe una versión precomprimida (`<archivo>.br` / `<archivo>.gz`) y el cliente
+  la acepta, se sirve esa con Content-Encoding (útil para SVG, JSON, JS...; las
+  imágenes ya van comprimidas y no se buscan).
+
+Las peticiones `Range` (y `If-Range`) las resuelve FileResponse de Starlette, que además
+envía el archivo con `http.response.pathsend` (sendfile sin copiar a Python) cuando el
+servidor ASGI ofrece esa extensión.
+"""
+from fastapi.staticfiles import StaticFiles
+from mimetypes import guess_type
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+from typing import Optional, Tuple
+import os
+import re
+
+MEDIA_IMMUTABLE_MAX_AGE = int(os.getenv("MEDIA_IMMUTABLE_MAX_AGE", str(365 * 24 * 3600)))
+IMMUTABLE_CACHE_CONTROL = f"public, max-age={MEDIA_IMMUTABLE_MAX_AGE}, immutable"
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+# <sha256>.<ext>, <uuid>.<ext> y sus variantes <nombre>_<tamaño>.<formato>
+OBJECT_NAME = re.compile(r"^(?P<hash>[0-9a-f]{64})\.\w+$")
+HASH_NAME = re.compile(r"^[0-9a-f]{64}(?:_\w+)?\.\w+$")
+UUID_NAME = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?:_\w+)?\.\w+$")
+
+# Codificaciones precomprimidas por orden de preferencia
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+
+def is_immutable(filename: str) -> bool:
+    return bool(HASH_NAME.match(filename) or UUID_NAME.match(filename))
+
+
+def content_etag(relative_path: str) -> Optional[str]:
+    """ETag fuerte a partir del hash del nombre (solo los originales, no las variantes)"""
+    if not relative_path.startswith("uploads/objects/"):
+        return None
+    match = OBJECT_NAME.match(os.path.basename(relative_path))
+    return f'"{match.group("hash")}"' if match else None
+
+
+def is_compressible(media_type: str) -> bool:
+    return media_type == "image/svg+xml" or not media_type.startswith(("image/", "video/", "audio/"))
+
+
+class MediaFiles(StaticFiles):
+    def precompressed(self, full_path: str, request_headers: Headers) -> Optional[Tuple[str, str, os.stat_result]]:
+        """(codificación, ruta, stat) de la versión precomprimida que acepta el cliente, si existe"""
+        accepted = {
+            token.split(";")[0].strip()
+            for token in request_headers.get("accept-encoding", "").split(",")
+        }
+        for encoding, suffix in PRECOMPRESSED:
+            if encoding not in accepted:
+                continue
+            try:
+                stat_result = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            return encoding, full_path + suffix, stat_result
+        return None
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        relative_path = self.get_path(scope).replace(os.sep, "/")
+        filename = os.path.basename(relative_path)
+        media_type = guess_type(filename)[0] or "application/octet-stream"
+
+        headers = {
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if is_immutable(filename) else REVALIDATE_CACHE_CONTROL
+        }
+        etag = content_etag(relative_path)
+        path = full_path
+
+        if status_code == 200 and is_compressible(media_type):
+            headers["Vary"] = "Accept-Encoding"
+            encoded = self.precompressed(str(full_path), request_headers)
+            if encoded:
+                encoding, path, stat_result = encoded
+                headers["Content-Encoding"] = encoding
+                if etag:
+                    etag = f'{etag[:-1]}-{encoding}"'
+
+        if etag:
+            headers["ETag"] = etag
+
+        response = FileResponse(
+            path, status_code=status_code, headers=headers,
+            media_type=media_type, stat_result=stat_result
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
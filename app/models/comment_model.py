@@ -1,13 +1,14 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
+from app.utils.fields import partial_model
 
 class CommentBase(BaseModel):
     content: str
     post_id: Optional[str]  # Ahora viene en el cuerpo
 
 class CommentCreate(CommentBase):
-    pass
+    parent_id: Optional[str] = None  # Comentario al que responde (None = comentario principal)
 
 class Comment(CommentBase):
     id: str = Field(alias="_id")
@@ -15,6 +16,8 @@ class Comment(CommentBase):
     author_username: str
     author_profile_picture: Optional[str] = ""  # ← Nuevo campo
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    parent_id: Optional[str] = None
+    replies_count: int = 0  # Respuestas directas (desnormalizado)
     
     class Config:
         json_encoders = {
@@ -22,4 +25,11 @@ class Comment(CommentBase):
             "author_id": str,
             "post_id": str
         }
-        allow_population_by_field_name = True
\ No newline at end of file
+        allow_population_by_field_name = True
+
+class CommentsPage(BaseModel):
+    comments: List[dict]
+    next_cursor: Optional[str] = None
+
+# Comentario con solo los campos pedidos en ?fields=
+CommentPartial = partial_model(Comment, "CommentPartial")
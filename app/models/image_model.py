@@ -4,7 +4,8 @@ from pydantic import BaseModel, Field, ConfigDict
 from datetime import datetime
 from enum import Enum
 from bson import ObjectId
-from typing import Optional, List
+from typing import Optional, List, Dict
+from app.utils.fields import partial_model
 
 
 
@@ -14,11 +15,12 @@ class ImageType(str, Enum):
 
 class ImageBase(BaseModel):
     url: str
+    # Tamaño -> formato -> URL (ver app/image_variants.py)
+    variants: Optional[Dict[str, Dict[str, str]]] = None
     image_type: ImageType
     owner_id: str
     created_at: Optional[datetime] = None  # Hacerlo opcional
     likes_count: int = Field(default=0)
-    liked_by: List[str] = Field(default_factory=list)
     comments_count: int = Field(default=0)
 
 class ImageCreate(ImageBase):
@@ -47,12 +49,19 @@ class ImageComment(ImageCommentBase):
 
 class Image(ImageBase):
     id: str = Field(alias="_id")
+    thumbnail_url: Optional[str] = None  # Variante más pequeña (o la original si aún no tiene variantes)
     
     class Config:
         json_encoders = {
             "_id": str,
             "owner_id": str,
-            "created_at": lambda v: v.isoformat() if v else None,
-            "liked_by": lambda v: [str(user_id) for user_id in v]
+            "created_at": lambda v: v.isoformat() if v else None
         }
-        allow_population_by_field_name = True
\ No newline at end of file
+        allow_population_by_field_name = True
+
+# Imagen con solo los campos pedidos en ?fields= (p. ej. la cuadrícula de la galería)
+ImagePartial = partial_model(Image, "ImagePartial")
+
+class ImagesPage(BaseModel):
+    images: List[dict]
+    next_cursor: Optional[str] = None
@@ -3,6 +3,7 @@ from enum import Enum
 from pydantic import BaseModel, Field, ConfigDict
 from typing import Optional, List  # Añade List para manejar arrays
 from bson import ObjectId  # Añade esto para manejar ObjectId en serialización
+from app.utils.fields import partial_model
 
 class NotificationType(str, Enum):
     LIKE = "like"
@@ -75,4 +76,7 @@ class Notification(NotificationBase):
             ObjectId: str  # Añade esto para manejar ObjectId en serialización
         },
         populate_by_name=True  # Equivalente a allow_population_by_field_name
-    )
\ No newline at end of file
+    )
+
+# Notificación con solo los campos pedidos en ?fields=
+NotificationPartial = partial_model(Notification, "NotificationPartial")
@@ -1,28 +1,39 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 from bson.objectid import ObjectId
 from pydantic import Field
-from typing import List
+from typing import List, Union
+from app.utils.fields import partial_model
 
 class Post(BaseModel):
     id: Optional[str] = Field(None, alias="_id")
     title: str
     content: str
     image_url: Optional[str] = None  # Nuevo campo para la URL de la imagen
+    image_variants: Optional[Dict[str, Dict[str, str]]] = None  # Lo rellena el servidor a partir de image_url
     author_id: Optional[str] = None  # Añade este campo
     author_username: Optional[str] = None
     author_profile_picture: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     likes_count: int = Field(default=0)
-    liked_by: List[str] = Field(default_factory=list)
     comments_count: int = Field(default=0)
     
     class Config:
         json_encoders = {ObjectId: str}
+
+class PostResponse(Post):
+    has_liked: bool = False  # Calculado por usuario con la colección likes
+
+# Post con solo los campos pedidos en ?fields=
+PostPartial = partial_model(PostResponse, "PostPartial")
         
 class UserPostsResponse(BaseModel):
-    posts: List[Post]
+    posts: List[Union[PostResponse, PostPartial]]
     total_posts: int
     skip: int
-    limit: int
\ No newline at end of file
+    limit: int
+
+class PostsPage(BaseModel):
+    posts: List[dict]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,119 @@
+# app/passwords.py
+"""
+Hash y verificación de contraseñas (bcrypt) fuera del event loop.
+
+bcrypt tarda decenas o cientos de milisegundos por llamada a propósito; hecho
+dentro de un handler async congela todas las peticiones y WebSockets del worker.
+Aquí se ejecuta en un pool de hilos propio y acotado (la extensión de bcrypt
+suelta el GIL mientras calcula), con control de admisión: si ya hay
+PASSWORD_HASH_MAX_PENDING operaciones en cola o en curso, se responde 503 con
+Retry-After en lugar de acumular logins que acabarían expirando.
+
+El coste se configura con BCRYPT_ROUNDS. Al subirlo, los hashes antiguos siguen
+siendo válidos y se rehacen con el coste nuevo en el siguiente login correcto
+(ver verify_and_update).
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from typing import Callable, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+PASSWORD_HASH_RETRY_AFTER = os.getenv("PASSWORD_HASH_RETRY_AFTER", "1")
+
+# deprecated="auto" + rounds: needs_update() marca los hashes con un coste distinto
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.operations = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        # Últimas latencias (cola + cálculo) para los percentiles
+        self._latencies = deque(maxlen=1000)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, fn: Callable, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning(f"Pool de contraseñas saturado ({self.pending} pendientes): 503")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servidor ocupado, inténtalo de nuevo en unos segundos",
+                headers={"Retry-After": PASSWORD_HASH_RETRY_AFTER}
+            )
+
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.operations += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self._latencies.append(elapsed_ms)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """
+        (válida, hash nuevo). El hash nuevo solo viene si la contraseña es correcta y el
+        guardado usa un coste distinto de BCRYPT_ROUNDS: hay que guardarlo en su lugar.
+        """
+        if not hashed_password:
+            return False, None
+        verified, new_hash = await self._run(pwd_context.verify_and_update, password, hashed_password)
+        if new_hash:
+            self.rehashed += 1
+        return verified, new_hash
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(fraction: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))], 2) if latencies else 0.0
+
+        return {
+            "rounds": BCRYPT_ROUNDS,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "operations": self.operations,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "avg_ms": round(self.total_ms / self.operations, 2) if self.operations else 0.0,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(self.max_ms, 2)
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
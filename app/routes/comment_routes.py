@@ -1,13 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Request, Response, Query
 from bson import ObjectId
 from app.auth import require_role, UserRole, optional_auth
 from app.database import db
-from app.models.comment_model import Comment, CommentCreate
-from typing import List, Optional
+from app.models.comment_model import Comment, CommentCreate, CommentPartial, CommentsPage
+from app.utils.pagination import encode_cursor, decode_cursor, keyset_match
+from app.utils.fields import parse_fields, project_stage, pick_fields, model_field_names
+from app.utils.etag import make_etag, etag_matches, set_etag, not_modified
+from typing import List, Optional, Set, Union
 from datetime import datetime, timezone
+import asyncio
 import pytz
 import logging
+import re
 from app.websocket_manager import manager  # Importa el manager aquí
+from app.cache import post_cache
+from app.counters import counter_buffer
+from app.deletion import NOT_DELETED
+from app.authors import AUTHOR_FIELD_MAP, attach_author_cards
+from app.loaders import Loaders, get_loaders
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +26,11 @@ PERU_TIMEZONE = pytz.timezone('America/Lima')
 
 router = APIRouter(prefix="/comments", tags=["comments"])
 
+# Campos que se pueden pedir con ?fields= (los del autor salen de su tarjeta al leer)
+COMMENT_FIELDS = model_field_names(Comment)
+COMMENT_AUTHOR_FIELDS = set(AUTHOR_FIELD_MAP)
+COMMENT_STORED_FIELDS = COMMENT_FIELDS - {"author_profile_picture"}
+
 def get_peru_time():
     return datetime.now(PERU_TIMEZONE)
 
@@ -26,99 +41,220 @@ def format_peru_time(dt: datetime):
         dt = pytz.utc.localize(dt).astimezone(PERU_TIMEZONE)
     return dt.isoformat()
 
+def serialize_comment_ids(comment: dict) -> dict:
+    """Convierte las referencias ObjectId del comentario a string para la respuesta"""
+    for field in ("_id", "post_id", "author_id", "parent_id"):
+        if comment.get(field) is not None:
+            comment[field] = str(comment[field])
+    return comment
+
+def thread_pipeline(
+    match: dict,
+    descending: bool,
+    skip: int,
+    limit: int,
+    selected: Optional[Set[str]] = None,
+    after: Optional[str] = None
+) -> List[dict]:
+    """
+    Una página de comentarios con la foto actual del autor (join por índice sobre users._id).
+    Con `after` (cursor; vacío = primera página) pagina por (created_at, _id) y pide limit + 1.
+    """
+    direction = -1 if descending else 1
+    if after:
+        after_created_at, after_id = decode_cursor(after)
+        match = {**match, **keyset_match("created_at", after_created_at, after_id, descending=descending)}
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": direction, "_id": direction}}
+    ]
+    if after is None:
+        pipeline += [{"$skip": skip}, {"$limit": limit}]
+    else:
+        pipeline.append({"$limit": limit + 1})
+
+    if selected is not None:
+        # El cursor necesita created_at y las tarjetas de autor necesitan author_id
+        extra = ["created_at"] if after is not None else []
+        if selected & COMMENT_AUTHOR_FIELDS:
+            extra.append("author_id")
+        pipeline.append(project_stage(selected, COMMENT_STORED_FIELDS, extra))
+    return pipeline
+
+def comments_pipeline(
+    post_object_id: ObjectId,
+    skip: int,
+    limit: int,
+    selected: Optional[Set[str]] = None,
+    after: Optional[str] = None
+) -> List[dict]:
+    """Comentarios principales de un post, del más reciente al más antiguo"""
+    # parent_id: None también cubre los comentarios anteriores a los hilos (sin el campo)
+    return thread_pipeline({"post_id": post_object_id, "parent_id": None}, True, skip, limit, selected, after)
+
+def replies_pipeline(
+    comment_object_id: ObjectId,
+    limit: int,
+    selected: Optional[Set[str]] = None,
+    after: Optional[str] = None
+) -> List[dict]:
+    """Respuestas directas de un comentario, en orden cronológico"""
+    return thread_pipeline({"parent_id": comment_object_id}, False, 0, limit, selected, after if after is not None else "")
+
+async def read_comment_page(pipeline: List[dict], limit: int, selected: Optional[Set[str]], cursor_mode: bool, loader=None):
+    """Ejecuta la página y la prepara para la respuesta (lista, o {comments, next_cursor} con cursor)"""
+    raw_comments = await db.comments.aggregate(pipeline).to_list(None)
+    if selected is None or selected & COMMENT_AUTHOR_FIELDS:
+        await attach_author_cards(raw_comments, AUTHOR_FIELD_MAP, loader)
+
+    next_cursor = None
+    if cursor_mode and len(raw_comments) > limit:
+        raw_comments = raw_comments[:limit]
+        next_cursor = encode_cursor(raw_comments[-1]["created_at"], raw_comments[-1]["_id"])
+
+    comments = []
+    for comment in raw_comments:
+        counter_buffer.apply("comments", comment)
+        serialize_comment_ids(comment)
+        # Aplicar formato de hora Perú a cada comentario ← ¡ESTA LÍNEA FALTABA!
+        if "created_at" in comment:
+            comment["created_at"] = format_peru_time(comment["created_at"])
+        comments.append(pick_fields(comment, selected))
+
+    if not cursor_mode:
+        return comments
+    return {
+        "comments": comments,
+        "next_cursor": next_cursor
+    }
+
+
+
+async def publish_comment(post: dict, comment: dict, current_user: dict, content: str):
+    """
+    Notificación al autor del post y broadcast del comentario.
+    Se ejecuta después de enviar la respuesta (BackgroundTasks).
+    """
+    post_id = str(post["_id"])
+    try:
+        # Emitir el comentario via WebSocket - SOLO SI HAY CONEXIONES
+        await manager.broadcast_comment(post_id, comment)
+        logger.info(f"Comentario broadcasted para post {post_id}")
+    except Exception as e:
+        logger.error(f"Error en broadcast_comment: {str(e)}")
+
+    # Crear notificación si no es comentario propio
+    if str(post["author_id"]) == str(current_user["_id"]):
+        return
+    try:
+        post_author = await db.users.find_one(
+            {"_id": ObjectId(post["author_id"])},
+            {"username": 1, "profile_picture": 1}
+        )
+
+        notification = {
+            "user_id": ObjectId(post["author_id"]),
+            "emitter_id": str(current_user["_id"]),
+            "emitter_username": current_user.get("username", "Usuario"),
+            "comment_id": comment["_id"],
+            "type": "comment",
+            "message": f"{current_user['username']} comentó en tu publicación: {content[:30]}...",
+            "read": False,
+            "created_at": get_peru_time(),  # ← También usar hora Perú aquí
+            # AGREGAR TODA LA INFORMACIÓN DEL POST (igual que para likes)
+            "post_id": post["_id"],
+            "post_title": post.get("title", ""),
+            "post_content": post.get("content", ""),
+            "post_author_id": str(post["author_id"]),
+            "post_author_username": post_author.get("username", "Usuario") if post_author else "Usuario",
+            "post_author_profile_picture": post_author.get("profile_picture", "") if post_author else "",
+            "post_image_url": post.get("image_url", ""),
+            "post_likes_count": post.get("likes_count", 0),
+            "post_comments_count": post.get("comments_count", 0) + 1,  # +1 porque acabamos de agregar un comentario
+            "post_created_at": post.get("created_at", datetime.utcnow()),
+            "post_updated_at": post.get("updated_at", datetime.utcnow())
+        }
+    
+        notification_result = await db.notifications.insert_one(notification)
+        notification["_id"] = str(notification_result.inserted_id)  # Convertir _id a string
+        await manager.broadcast_notification(
+            str(post["author_id"]),
+            notification
+        )
+    except Exception as e:
+        logger.error(f"Error creando notificación de comentario en {post_id}: {str(e)}")
 
 
 @router.post("/", response_model=Comment, status_code=status.HTTP_201_CREATED)
 async def create_comment(
     comment_data: CommentCreate,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(require_role(UserRole.USER))
 ):
+    """
+    Crea un comentario (o una respuesta si trae parent_id).
+    Las lecturas independientes se lanzan en paralelo, y los contadores (a la vez)
+    después de insertar; la notificación y el broadcast se hacen después de responder.
+    """
     try:
         post_id = comment_data.post_id
         post_object_id = ObjectId(post_id)
+        parent_object_id = ObjectId(comment_data.parent_id) if comment_data.parent_id else None
         
-        # Verificar si el post existe
-        post = await db.posts.find_one({"_id": post_object_id})
+        # Verificar que el post (y el comentario padre) existen, en paralelo
+        post, parent = await asyncio.gather(
+            db.posts.find_one({"_id": post_object_id, **NOT_DELETED}),
+            db.comments.find_one(
+                {"_id": parent_object_id, "post_id": post_object_id},
+                {"path": 1}
+            ) if parent_object_id else asyncio.sleep(0)
+        )
         if not post:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Post no encontrado"
             )
+        if parent_object_id and not parent:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Comentario padre no encontrado"
+            )
         
-        # Crear el comentario con los datos del usuario
-        peru_time = get_peru_time()
+        # Crear el comentario con los datos del usuario; el _id se genera aquí
+        # para poder devolver el documento sin volver a leerlo
         comment_dict = comment_data.dict()
         comment_dict.update({
-            "author_id": str(current_user["_id"]),
+            "_id": ObjectId(),
+            "post_id": post_object_id,
+            "parent_id": parent_object_id,
+            # Ruta materializada: la del padre más el id del padre
+            "path": f"{parent.get('path') or ''}{parent_object_id}," if parent else "",
+            "replies_count": 0,
+            "author_id": ObjectId(current_user["_id"]),
             "author_username": current_user.get("username", ""),
             "author_profile_picture": current_user.get("profile_picture", ""),
-            "created_at": peru_time
+            "created_at": get_peru_time()
         })
         
-        # Insertar el comentario
-        result = await db.comments.insert_one(comment_dict)
-        
-        # Obtener y devolver el comentario creado
-        created_comment = await db.comments.find_one({"_id": result.inserted_id})
-        created_comment["_id"] = str(created_comment["_id"])
-        created_comment["created_at"] = format_peru_time(created_comment["created_at"])
+        # Insertar el comentario; los contadores solo se incrementan si la inserción tuvo éxito
+        # (si falla no queda nada que compensar), y los del post y el padre van a la vez
+        await db.comments.insert_one(comment_dict)
+        increments = [counter_buffer.increment("posts", post_object_id, {"comments_count": 1, "version": 1})]
+        if parent_object_id:
+            increments.append(counter_buffer.increment("comments", parent_object_id, {"replies_count": 1}))
+        await asyncio.gather(*increments)
+        post_cache.invalidate(post_id)
         
-        # Incrementar el contador de comentarios en el post
-        await db.posts.update_one(
-            {"_id": post_object_id},
-            {"$inc": {"comments_count": 1}},
-            upsert=True
-        )
-
-        # Emitir el comentario via WebSocket - SOLO SI HAY CONEXIONES
-        try:
-            await manager.broadcast_comment(post_id, created_comment)
-            logger.info(f"Comentario broadcasted para post {post_id}")
-        except Exception as e:
-            logger.error(f"Error en broadcast_comment: {str(e)}")
-            # NO relanzar la excepción - permitir que la operación continue 
-        
-        # Crear notificación si no es comentario propio
-        if str(post["author_id"]) != str(current_user["_id"]):
-            post_author = await db.users.find_one({"_id": ObjectId(post["author_id"])})
-
-            notification = {
-                "user_id": str(post["author_id"]),
-                "emitter_id": str(current_user["_id"]),
-                "emitter_username": current_user.get("username", "Usuario"),
-                "post_id": str(post["_id"]),
-                "comment_id": str(result.inserted_id),
-                "type": "comment",
-                "message": f"{current_user['username']} comentó en tu publicación: {comment_data.content[:30]}...",
-                "read": False,
-                "created_at": get_peru_time(),  # ← También usar hora Perú aquí
-                # AGREGAR TODA LA INFORMACIÓN DEL POST (igual que para likes)
-                "post_id": post_id,
-                "post_title": post.get("title", ""),
-                "post_content": post.get("content", ""),
-                "post_author_id": str(post["author_id"]),
-                "post_author_username": post_author.get("username", "Usuario") if post_author else "Usuario",
-                "post_author_profile_picture": post_author.get("profile_picture", "") if post_author else "",
-                "post_image_url": post.get("image_url", ""),
-                "post_likes_count": post.get("likes_count", 0),
-                "post_comments_count": post.get("comments_count", 0) + 1,  # +1 porque acabamos de agregar un comentario
-                "post_liked_by": post.get("liked_by", []),
-                "post_created_at": post.get("created_at", datetime.utcnow()),
-                "post_updated_at": post.get("updated_at", datetime.utcnow())
-            }
-        
-            notification_result = await db.notifications.insert_one(notification)
-            notification["_id"] = str(notification_result.inserted_id)  # Convertir _id a string
-            await manager.broadcast_notification(
-                str(post["author_id"]),
-                notification
-            )
+        created_comment = serialize_comment_ids(dict(comment_dict))
+        created_comment.pop("path", None)
+        created_comment["created_at"] = format_peru_time(comment_dict["created_at"])
         
-        # Emitir el comentario via WebSocket
-        await manager.broadcast_comment(post_id, created_comment)
+        background_tasks.add_task(publish_comment, post, created_comment, current_user, comment_data.content)
         
         return created_comment
         
+    except HTTPException:
+        raise
     except Exception as e:
         if "invalid object id" in str(e).lower():
             raise HTTPException(
@@ -130,75 +266,50 @@ async def create_comment(
             detail=str(e)
         )
 
-@router.get("/post/{post_id}", response_model=List[Comment])
+@router.get(
+    "/post/{post_id}",
+    response_model=Union[List[Union[Comment, CommentPartial]], CommentsPage],
+    response_model_exclude_unset=True
+)
 async def get_comments(
     post_id: str,
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
-    current_user: Optional[dict] = Depends(optional_auth)
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: Optional[dict] = Depends(optional_auth),
+    loaders: Loaders = Depends(get_loaders)
 ):
+    """
+    Comentarios principales de un post (las respuestas se piden con /comments/{id}/replies).
+    - Sin `after`: paginación con skip/limit (devuelve una lista).
+    - Con `after` (vacío para la primera página): paginación por cursor; devuelve {comments, next_cursor}.
+    Con `fields` (separados por comas) solo se leen esos campos.
+    El ETag sale de la versión del post (crear o borrar un comentario la incrementa),
+    así que un If-None-Match vigente responde 304 sin ejecutar la agregación.
+    """
+    selected = parse_fields(fields, COMMENT_FIELDS)
     try:
         post_object_id = ObjectId(post_id)
         # Verificar si el post existe
-        post = await db.posts.find_one({"_id": post_object_id})
+        post = await db.posts.find_one({"_id": post_object_id, **NOT_DELETED}, {"version": 1})
         if not post:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Post no encontrado"
             )
+        counter_buffer.apply("posts", post)
+        etag = make_etag("comments", post_id, post.get("version", 0))
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+        set_etag(response, etag)
         
-        # Usar agregación para obtener comentarios con información del autor
-        pipeline = [
-            {"$match": {"post_id": post_id}},
-            {"$sort": {"created_at": -1}},
-            {"$skip": skip},
-            {"$limit": limit},
-            {
-                "$lookup": {
-                    "from": "users",
-                    "let": {"author_id_str": "$author_id"},
-                    "pipeline": [
-                        {
-                            "$match": {
-                                "$expr": {
-                                    "$eq": [
-                                        {"$toString": "$_id"},
-                                        "$$author_id_str"
-                                    ]
-                                }
-                            }
-                        }
-                    ],
-                    "as": "author_info"
-                }
-            },
-            {
-                "$addFields": {
-                    "author_profile_picture": {
-                        "$ifNull": [
-                            {"$arrayElemAt": ["$author_info.profile_picture", 0]},
-                            ""
-                        ]
-                    }
-                }
-            },
-            {"$unset": "author_info"}  # Remover el array temporal
-        ]
-        
-        # Obtener comentarios paginados
-        cursor = db.comments.find({"post_id": post_id}) \
-            .sort("created_at", -1) \
-            .skip(skip) \
-            .limit(limit)
-        
-        comments = []
-        async for comment in db.comments.aggregate(pipeline):
-            comment["_id"] = str(comment["_id"])
-            # Aplicar formato de hora Perú a cada comentario ← ¡ESTA LÍNEA FALTABA!
-            comment["created_at"] = format_peru_time(comment["created_at"])
-            comments.append(comment)
-            
-        return comments
+        return await read_comment_page(
+            comments_pipeline(post_object_id, skip, limit, selected, after),
+            limit, selected, cursor_mode=after is not None, loader=loaders.authors
+        )
         
     except Exception as e:
         if "invalid object id" in str(e).lower():
@@ -211,6 +322,38 @@ async def get_comments(
             detail=str(e)
         )
 
+@router.get("/{comment_id}/replies", response_model=CommentsPage)
+async def get_replies(
+    comment_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor opaco devuelto como next_cursor"),
+    fields: Optional[str] = None,
+    loaders: Loaders = Depends(get_loaders)
+):
+    """
+    Respuestas directas de un comentario, paginadas por cursor, para expandir un hilo
+    bajo demanda. Cada respuesta trae su replies_count para seguir expandiendo.
+    """
+    selected = parse_fields(fields, COMMENT_FIELDS)
+    try:
+        comment_object_id = ObjectId(comment_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ID de comentario inválido"
+        )
+    
+    if not await db.comments.find_one({"_id": comment_object_id}, {"_id": 1}):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Comentario no encontrado"
+        )
+    
+    return await read_comment_page(
+        replies_pipeline(comment_object_id, limit, selected, after),
+        limit, selected, cursor_mode=True, loader=loaders.authors
+    )
+
 @router.delete("/{comment_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_comment(
     comment_id: str,
@@ -247,13 +390,22 @@ async def delete_comment(
                 detail="No se pudo eliminar el comentario"
             )
         
-        # Decrementar el contador de comentarios en el post
+        # Eliminar sus respuestas: prefijo anclado sobre la ruta materializada (índice post_id + path)
         post_id = comment.get("post_id")
+        subtree_prefix = f"{comment.get('path') or ''}{comment_object_id},"
+        replies_result = await db.comments.delete_many({
+            "post_id": post_id,
+            "path": {"$regex": f"^{re.escape(subtree_prefix)}"}
+        })
+        deleted_count = 1 + replies_result.deleted_count
+        
+        if comment.get("parent_id"):
+            await counter_buffer.increment("comments", comment["parent_id"], {"replies_count": -1})
+        
+        # Decrementar el contador de comentarios en el post
         if post_id:
-            await db.posts.update_one(
-                {"_id": ObjectId(post_id)},
-                {"$inc": {"comments_count": -1}}
-            )
+            await counter_buffer.increment("posts", post_id, {"comments_count": -deleted_count, "version": 1})
+            post_cache.invalidate(str(post_id))
         
         return None
         
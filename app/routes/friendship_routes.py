@@ -1,14 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from bson import ObjectId
 from app.database import db
-from app.auth import require_role, UserRole, optional_auth
+from app.auth import require_role, UserRole, optional_auth, invalidate_principal
 from app.models.notification_model import NotificationCreate, NotificationType
 from app.websocket_manager import manager
+from app.timeline import backfill_friendship
 from datetime import datetime
 from typing import List 
+import logging
 
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/friends", tags=["Friends"])
 
 @router.post("/request/{user_id}")
@@ -45,18 +49,20 @@ async def send_friend_request(
         # Actualizar relaciones
         await db.users.update_one(
             {"_id": current_user_id},
-            {"$set": {f"relationships.{str(target_oid)}": "request_sent"}}
+            {"$set": {f"relationships.{str(target_oid)}": "request_sent"}, "$inc": {"version": 1}}
         )
         
         await db.users.update_one(
             {"_id": target_oid},
-            {"$set": {f"relationships.{str(current_user_id)}": "request_received"}}
+            {"$set": {f"relationships.{str(current_user_id)}": "request_received"}, "$inc": {"version": 1}}
         )
+        invalidate_principal(current_user_id)
+        invalidate_principal(target_oid)
 
         # Notificación
         notification = {
             "_id": str(ObjectId()),  # Asegúrate de incluir un ID
-            "user_id": str(target_oid),
+            "user_id": target_oid,
             "emitter_id": str(current_user_id),
             "emitter_username": current_user["username"],
             "type": NotificationType.FRIEND_REQUEST.value,
@@ -140,6 +146,7 @@ async def accept_friend_request(
                             {"_id": current_user_oid},
                             {
                                 "$set": {f"relationships.{str(requester_oid)}": "friend"},
+                                "$inc": {"version": 1},
                                 "$pull": {"friend_requests": str(requester_oid)}  # Limpiar array antiguo
                             },
                             session=session
@@ -150,6 +157,7 @@ async def accept_friend_request(
                             {"_id": requester_oid},
                             {
                                 "$set": {f"relationships.{str(current_user_oid)}": "friend"},
+                                "$inc": {"version": 1},
                                 "$pull": {"sent_requests": str(current_user_oid)}  # Limpiar array antiguo
                             },
                             session=session
@@ -157,7 +165,7 @@ async def accept_friend_request(
                         
                         # Crear notificación
                         notification = {
-                            "user_id": str(requester_oid),
+                            "user_id": requester_oid,
                             "emitter_id": str(current_user_oid),
                             "emitter_username": current_user["username"],
                             "type": NotificationType.FRIEND_ACCEPTED.value,
@@ -190,6 +198,7 @@ async def accept_friend_request(
                 {"_id": current_user_oid},
                 {
                     "$set": {f"relationships.{str(requester_oid)}": "friend"},
+                    "$inc": {"version": 1},
                     "$pull": {"friend_requests": str(requester_oid)}  # Limpiar array antiguo
                 }
             )
@@ -199,13 +208,14 @@ async def accept_friend_request(
                 {"_id": requester_oid},
                 {
                     "$set": {f"relationships.{str(current_user_oid)}": "friend"},
+                    "$inc": {"version": 1},
                     "$pull": {"sent_requests": str(current_user_oid)}  # Limpiar array antiguo
                 }
             )
             
             # Crear notificación
             notification = {
-                "user_id": str(requester_oid),
+                "user_id": requester_oid,
                 "emitter_id": str(current_user_oid),
                 "emitter_username": current_user["username"],
                 "type": NotificationType.FRIEND_ACCEPTED.value,
@@ -220,6 +230,16 @@ async def accept_friend_request(
         # Capturamos cualquier otro error no relacionado con transacciones
         print(f"Error general: {str(e)}")
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, f"Error al procesar la solicitud: {str(e)}")
+    finally:
+        # Las relaciones forman parte del usuario autenticado en caché
+        invalidate_principal(current_user_oid)
+        invalidate_principal(requester_oid)
+    
+    # Llenar el timeline de cada uno con los posts recientes del otro
+    try:
+        await backfill_friendship(current_user_oid, requester_oid)
+    except Exception as e:
+        logger.error(f"Error en backfill de timeline: {str(e)}", exc_info=True)
     
     # Obtener y devolver estado actualizado
     updated_user = await db.users.find_one({"_id": current_user_oid})
@@ -259,6 +279,7 @@ async def reject_friend_request(
         {"_id": current_user_oid},
         {
             "$unset": {f"relationships.{str(requester_oid)}": ""},
+            "$inc": {"version": 1},
             "$pull": {"friend_requests": user_id}  # Mantener por compatibilidad
         }
     )
@@ -267,9 +288,12 @@ async def reject_friend_request(
         {"_id": requester_oid},
         {
             "$unset": {f"relationships.{str(current_user_oid)}": ""},
+            "$inc": {"version": 1},
             "$pull": {"sent_requests": str(current_user["_id"])}  # Mantener por compatibilidad
         }
     )
+    invalidate_principal(current_user_oid)
+    invalidate_principal(requester_oid)
     
     return {
         "message": "Solicitud rechazada",
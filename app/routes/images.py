@@ -1,13 +1,22 @@
 # routes/images.py
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Response
-from app.utils.util import upload_file_to_storage, upload_file_to_storage_post
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Response, Query
+from app.uploads import store_upload
 from bson import ObjectId
-from app.auth import require_role, UserRole
+from app.auth import require_role, UserRole, invalidate_principal
 from app.database import db 
-from app.models.image_model import Image, ImageCreate, ImageType, ImageComment, ImageCommentCreate
+from app.models.image_model import Image, ImageCreate, ImagePartial, ImagesPage, ImageType, ImageComment, ImageCommentCreate
+from app.utils.pagination import encode_cursor, decode_cursor, keyset_match
+from app.utils.fields import parse_fields, project_stage, pick_fields, model_field_names
 from datetime import datetime
 from app.websocket_manager import manager
-from typing import List, Optional
+from app.authors import attach_author_cards, invalidate_author
+from app.loaders import Loaders, get_loaders
+from app.likes import LIKE_TARGET_IMAGE, add_like, remove_like
+from app.counters import counter_buffer
+from app.image_variants import generate_variants, existing_variant_urls
+from app.deletion import delete_upload
+from PIL import Image as PILImage, UnidentifiedImageError
+from typing import Dict, List, Optional, Union
 import logging
 import pytz
 import os
@@ -22,9 +31,54 @@ PERU_TIMEZONE = pytz.timezone('America/Lima')
 
 router = APIRouter(prefix="/images", tags=["images"])
 
+# Campos que se pueden pedir con ?fields= (thumbnail_url se calcula a partir de variants)
+IMAGE_FIELDS = model_field_names(Image)
+IMAGE_STORED_FIELDS = IMAGE_FIELDS - {"thumbnail_url"}
+# Los comentarios de imágenes guardan la foto del autor como profile_picture
+IMAGE_COMMENT_AUTHOR_MAP = {"author_username": "username", "profile_picture": "profile_picture"}
+
 def get_peru_time():
     return datetime.now(PERU_TIMEZONE)
 
+def thumbnail_url(image: dict) -> Optional[str]:
+    """La variante más pequeña (WebP si existe) o la URL original"""
+    variants = image.get("variants") or {}
+    smallest = next(iter(variants.values()), None)
+    if smallest:
+        return smallest.get("webp") or next(iter(smallest.values()))
+    return image.get("url")
+
+def serialize_image(image: dict) -> dict:
+    """Convierte las referencias ObjectId de una imagen a string para la respuesta"""
+    image["_id"] = str(image["_id"])
+    if "owner_id" in image:  # Puede faltar con ?fields=
+        image["owner_id"] = str(image["owner_id"])
+    if "url" in image or "variants" in image:
+        image["thumbnail_url"] = thumbnail_url(image)
+    return image
+
+def new_image_document(image_data: ImageCreate) -> dict:
+    """Documento a insertar: owner_id se guarda como ObjectId para que los joins usen índices"""
+    document = image_data.dict()
+    document["owner_id"] = ObjectId(document["owner_id"])
+    return document
+
+async def build_variants(file_url: str, kind: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """
+    Genera las variantes de una subida recién guardada (si los mismos bytes ya se
+    subieron antes con este tipo, se reutilizan las existentes).
+    Si Pillow no puede decodificarla se suelta la subida y se responde 415; cualquier
+    otro fallo deja la subida sin variantes (las completa backfill-image-variants).
+    """
+    try:
+        return await existing_variant_urls(file_url, kind) or await generate_variants(file_url, kind)
+    except (UnidentifiedImageError, PILImage.DecompressionBombError):
+        await delete_upload(file_url)
+        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "La imagen no se puede procesar")
+    except Exception as e:
+        logger.error(f"Error generando variantes de {file_url}: {str(e)}")
+        return None
+
 def format_peru_time(dt: datetime):
     """Formatea datetime para mantener la zona horaria de Perú"""
     if dt.tzinfo is None:
@@ -38,33 +92,34 @@ async def upload_profile_picture(
     current_user: dict = Depends(require_role(UserRole.USER))
 ):
     # 1. Subir el archivo a tu servicio de almacenamiento
-    file_url = await upload_file_to_storage(file, "profile_pictures")
+    file_url = await store_upload(file, "profile_pictures")
+    variants = await build_variants(file_url, "profile_pictures")
     
     # 2. Crear registro en base de datos
     image_data = ImageCreate(
         url=file_url,
+        variants=variants,
         image_type=ImageType.PROFILE_PICTURE,
         owner_id=str(current_user["_id"]),
         created_at=  get_peru_time()
     )
     
     # 3. Insertar nueva imagen
-    result = await db.images.insert_one(image_data.dict())
+    result = await db.images.insert_one(new_image_document(image_data))
     new_image_id = str(result.inserted_id)
     
     # 4. Actualizar usuario para apuntar a esta imagen
     await db.users.update_one(
         {"_id": ObjectId(current_user["_id"])},
-        {"$set": {"current_profile_picture": new_image_id, "profile_picture": file_url}}  # Asegúrate de guardar también la URL directa
+        {
+            "$set": {"current_profile_picture": new_image_id, "profile_picture": file_url},  # Asegúrate de guardar también la URL directa
+            "$inc": {"version": 1}
+        }
     )
 
-    # 5. Actualizar todos los posts del usuario con la nueva imagen de perfil
-    await db.posts.update_many(
-        {"author_id": str(current_user["_id"])},
-        {"$set": {
-            "author_profile_picture": file_url
-        }}
-    )
+    # 5. Los posts y comentarios toman la foto nueva de la tarjeta del autor al leerse
+    invalidate_author(current_user["_id"])
+    invalidate_principal(current_user["_id"])
 
     # 6. Obtener el usuario actualizado para la notificación
     updated_user = await db.users.find_one({"_id": ObjectId(current_user["_id"])})
@@ -83,8 +138,7 @@ async def upload_profile_picture(
     
     # 5. Devolver la imagen creada
     created_image = await db.images.find_one({"_id": result.inserted_id})
-    created_image["_id"] = str(created_image["_id"])
-    return created_image
+    return serialize_image(created_image)
 
 @router.post("/cover-photo", response_model=Image, status_code=status.HTTP_201_CREATED)
 async def upload_cover_photo(
@@ -92,27 +146,29 @@ async def upload_cover_photo(
     current_user: dict = Depends(require_role(UserRole.USER))
 ):
     # Similar al anterior pero para cover photo
-    file_url = await upload_file_to_storage(file, "cover_photos")
+    file_url = await store_upload(file, "cover_photos")
+    variants = await build_variants(file_url, "cover_photos")
     date = datetime.utcnow()
     
     image_data = ImageCreate(
         url=file_url,
+        variants=variants,
         image_type=ImageType.COVER_PHOTO,
         owner_id=str(current_user["_id"]),
         created_at= get_peru_time()
     )
     
-    result = await db.images.insert_one(image_data.dict())
+    result = await db.images.insert_one(new_image_document(image_data))
     new_image_id = str(result.inserted_id)
     
     await db.users.update_one(
         {"_id": ObjectId(current_user["_id"])},
-        {"$set": {"current_cover_photo": new_image_id}}
+        {"$set": {"current_cover_photo": new_image_id}, "$inc": {"version": 1}}
     )
+    invalidate_principal(current_user["_id"])
     
     created_image = await db.images.find_one({"_id": result.inserted_id})
-    created_image["_id"] = str(created_image["_id"])
-    return created_image
+    return serialize_image(created_image)
 
 
 @router.get("/{image_id}", response_model=Image)
@@ -126,35 +182,75 @@ async def get_image_details(image_id: str):
         if not image:
             raise HTTPException(status_code=404, detail="Imagen no encontrada")
         
-        image["_id"] = str(image["_id"])
-        return image
+        counter_buffer.apply("images", image)
+        return serialize_image(image)
         
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.get("/user/{user_id}", response_model=List[Image])
+@router.get(
+    "/user/{user_id}",
+    response_model=Union[List[Union[Image, ImagePartial]], ImagesPage],
+    response_model_exclude_unset=True
+)
 async def get_user_images(
     user_id: str,
-    image_type: Optional[ImageType] = None
+    image_type: Optional[ImageType] = None,
+    limit: int = Query(50, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor opaco devuelto como next_cursor (vacío para la primera página)"),
+    fields: Optional[str] = Query(None, description="Campos separados por comas, p. ej. thumbnail_url,likes_count,comments_count")
 ):
     """
-    Obtiene todas las imágenes de un usuario (público)
-    Puede filtrarse por tipo de imagen si se especifica
+    Galería de un usuario (público), de la imagen más reciente a la más antigua.
+    Puede filtrarse por tipo de imagen si se especifica.
+    - Sin `after`: las `limit` más recientes (devuelve una lista).
+    - Con `after`: paginación por cursor sobre (created_at, _id); devuelve {images, next_cursor}.
+    - Con `fields`: solo se leen esos campos (para la cuadrícula basta
+      `thumbnail_url,likes_count,comments_count`).
+    Cada página es un recorrido acotado del índice (owner_id, [image_type], created_at, _id),
+    así que cuesta lo mismo sin importar cuántas imágenes haya subido el usuario.
     """
+    selected = parse_fields(fields, IMAGE_FIELDS)
+    cursor_mode = after is not None
     try:
-        query = {"owner_id": user_id}
-        if image_type:
-            query["image_type"] = image_type
-            
-        images = []
-        async for image in db.images.find(query).sort("created_at", -1):
-            image["_id"] = str(image["_id"])
-            images.append(image)
-            
+        query = {"owner_id": ObjectId(user_id)}
+    except Exception:
+        raise HTTPException(status_code=400, detail="ID de usuario inválido")
+    if image_type:
+        query["image_type"] = image_type
+    if after:
+        after_created_at, after_id = decode_cursor(after)
+        query.update(keyset_match("created_at", after_created_at, after_id))
+
+    if selected is None:
+        projection = {"liked_by": 0}  # Likes heredados (ver migrate-likes)
+    else:
+        # El cursor necesita created_at y thumbnail_url sale de variants/url
+        extra = ["created_at"] if cursor_mode else []
+        if "thumbnail_url" in selected:
+            extra += ["url", "variants"]
+        projection = project_stage(selected, IMAGE_STORED_FIELDS, extra)["$project"]
+
+    raw_images = await db.images.find(query, projection).sort(
+        [("created_at", -1), ("_id", -1)]
+    ).limit(limit + 1 if cursor_mode else limit).to_list(None)
+
+    next_cursor = None
+    if cursor_mode and len(raw_images) > limit:
+        raw_images = raw_images[:limit]
+        next_cursor = encode_cursor(raw_images[-1]["created_at"], raw_images[-1]["_id"])
+
+    images = []
+    for image in raw_images:
+        counter_buffer.apply("images", image)
+        images.append(pick_fields(serialize_image(image), selected))
+
+    if not cursor_mode:
         return images
-        
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "images": images,
+        "next_cursor": next_cursor
+    }
 
 @router.delete("/{image_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_image(
@@ -170,7 +266,7 @@ async def delete_image(
         if not image:
             raise HTTPException(status_code=404, detail="Imagen no encontrada")
             
-        if image["owner_id"] != str(current_user["_id"]):
+        if str(image["owner_id"]) != str(current_user["_id"]):
             raise HTTPException(status_code=403, detail="No tienes permiso para eliminar esta imagen")
             
         # 2. Eliminar la imagen de la base de datos
@@ -182,14 +278,21 @@ async def delete_image(
         if user.get("current_profile_picture") == image_id:
             await db.users.update_one(
                 {"_id": ObjectId(current_user["_id"])},
-                {"$unset": {"current_profile_picture": "", "profile_picture": ""}}
+                {"$unset": {"current_profile_picture": "", "profile_picture": ""}, "$inc": {"version": 1}}
             )
+            invalidate_author(current_user["_id"])
+            invalidate_principal(current_user["_id"])
             
         if user.get("current_cover_photo") == image_id:
             await db.users.update_one(
                 {"_id": ObjectId(current_user["_id"])},
-                {"$unset": {"current_cover_photo": ""}}
+                {"$unset": {"current_cover_photo": "", "cover_photo": ""}, "$inc": {"version": 1}}
             )
+            invalidate_principal(current_user["_id"])
+        
+        # 4. Soltar su archivo (después de quitarlo del usuario: delete_upload no borra
+        #    archivos que todavía usa una foto de perfil o portada)
+        await delete_upload(image.get("url"))
             
         return Response(status_code=204)
         
@@ -202,7 +305,8 @@ async def delete_image(
 async def create_image_comment(
     image_id: str,
     comment_data: ImageCommentCreate,
-    current_user: dict = Depends(require_role(UserRole.USER))
+    current_user: dict = Depends(require_role(UserRole.USER)),
+    loaders: Loaders = Depends(get_loaders)
 ):
     try:
         # Verificar si la imagen existe
@@ -210,27 +314,9 @@ async def create_image_comment(
         if not image:
             raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
 
-        # OBTENER USUARIO COMPLETO
-        user = await db.users.find_one({"_id": ObjectId(current_user["id"])})
-
-        profile_picture_url = None
-        if user and user.get("current_profile_picture"):
-            # Verificar si el ObjectId es válido
-            try:
-                profile_image_id = ObjectId(user["current_profile_picture"])
-                
-                profile_image = await db.images.find_one({"_id": profile_image_id})
-                
-                if profile_image:
-                    profile_picture_url = profile_image.get("url")
-                else:
-                    print("❌ PROFILE IMAGE NOT FOUND")
-
-                    
-            except Exception as e:
-                print(f"❌ ERROR CONVERTING TO ObjectId: {e}")
-        else:
-            print("❌ USER HAS NO current_profile_picture FIELD")
+        # Foto de perfil actual del autor (tarjeta en caché, ver app/authors.py)
+        card = await loaders.authors.load(str(current_user["_id"]))
+        profile_picture_url = (card["profile_picture"] or None) if card else None
         
         # Crear el comentario
         created_at = get_peru_time()
@@ -270,15 +356,12 @@ async def create_image_comment(
         }
         
         # Incrementar el contador de comentarios
-        await db.images.update_one(
-            {"_id": ObjectId(image_id)},
-            {"$inc": {"comments_count": 1}}
-        )
+        await counter_buffer.increment("images", image_id, {"comments_count": 1})
         
         # Crear notificación si no es comentario propio
         if str(image["owner_id"]) != str(current_user["_id"]):
             notification = {
-                "user_id": str(image["owner_id"]),
+                "user_id": ObjectId(image["owner_id"]),
                 "emitter_id": str(current_user["_id"]),
                 "emitter_username": current_user.get("username", "Usuario"),
                 "image_id": image_id,
@@ -310,11 +393,12 @@ async def create_image_comment(
 async def get_image_comments(
     image_id: str,
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    loaders: Loaders = Depends(get_loaders)
 ):
     try:
         # Verificar si la imagen existe
-        if not await db.images.find_one({"_id": ObjectId(image_id)}):
+        if not await db.images.find_one({"_id": ObjectId(image_id)}, {"_id": 1}):
             raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
         
         # Obtener comentarios
@@ -323,7 +407,9 @@ async def get_image_comments(
             comment["_id"] = str(comment["_id"])
             comment["created_at"] = format_peru_time(comment["created_at"])
             comments.append(comment)
-            
+        
+        # Username y foto actuales de todos los autores de la página en una sola consulta
+        await attach_author_cards(comments, IMAGE_COMMENT_AUTHOR_MAP, loaders.authors)
         return comments
         
     except Exception as e:
@@ -340,35 +426,28 @@ async def like_image(
         user_id = str(current_user["_id"])
         image_oid = ObjectId(image_id)
         
-        # Verificar si la imagen existe
-        image = await db.images.find_one({"_id": image_oid})
-        if not image:
-            raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
-        
-        # Verificar si ya dio like
-        if user_id in image.get("liked_by", []):
+        # Registrar el like (el índice único hace la verificación atómica)
+        if not await add_like(LIKE_TARGET_IMAGE, image_oid, user_id):
             raise HTTPException(status.HTTP_400_BAD_REQUEST, "Ya has dado like a esta imagen")
         
-        # Actualizar la imagen
+        # Actualizar la imagen y leer el nuevo estado en la misma operación
         update_time = datetime.utcnow()  # Definir update_time aquí
-        await db.images.update_one(
-            {"_id": image_oid},
-            {
-                "$inc": {"likes_count": 1},
-                "$push": {"liked_by": user_id},
-                "$set": {"updated_at": update_time}
-            }
+        updated_image = await counter_buffer.increment_and_get(
+            "images", image_oid, {"likes_count": 1}, sets={"updated_at": update_time}
         )
+        if not updated_image:
+            # La imagen no existe: deshacer el like registrado
+            await remove_like(LIKE_TARGET_IMAGE, image_oid, user_id)
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
         
-        # Obtener imagen actualizada
-        updated_image = await db.images.find_one({"_id": image_oid})
-        updated_image["_id"] = str(updated_image["_id"])
+        serialize_image(updated_image)
 
         # Preparar datos para el broadcast
         broadcast_data = {
             "image_id": image_id,
             "likes_count": updated_image.get("likes_count", 0),
-            "liked_by": updated_image.get("liked_by", []),
+            "user_id": user_id,
+            "liked": True,
             "timestamp": update_time.isoformat()  # Asegurar que es string
         }
 
@@ -376,9 +455,9 @@ async def like_image(
         await manager.broadcast_image_update(image_id, broadcast_data)
         
         # Crear notificación si no es like propio
-        if str(image["owner_id"]) != user_id:
+        if str(updated_image["owner_id"]) != user_id:
             notification = {
-                "user_id": str(image["owner_id"]),
+                "user_id": ObjectId(updated_image["owner_id"]),
                 "emitter_id": user_id,
                 "emitter_username": current_user.get("username", "Usuario"),
                 "image_id": image_id,
@@ -389,10 +468,12 @@ async def like_image(
             }
             
             await db.notifications.insert_one(notification)
-            await manager.broadcast_notification(str(image["owner_id"]), notification)
+            await manager.broadcast_notification(str(updated_image["owner_id"]), notification)
         
         return updated_image
         
+    except HTTPException:
+        raise
     except Exception as e:
         if "invalid object id" in str(e).lower():
             raise HTTPException(status.HTTP_400_BAD_REQUEST, "ID de imagen inválido")
@@ -408,35 +489,29 @@ async def unlike_image(
         user_id = str(current_user["_id"])
         image_oid = ObjectId(image_id)
         
-        # Verificar si la imagen existe
-        image = await db.images.find_one({"_id": image_oid})
-        if not image:
-            raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
-        
-        # Verificar si no ha dado like
-        if user_id not in image.get("liked_by", []):
+        # Verificar si no ha dado like (solo quien tenía el like decrementa)
+        if not await remove_like(LIKE_TARGET_IMAGE, image_oid, user_id):
+            # Consulta extra solo en el camino de error, para distinguir 404 de 400
+            if not await db.images.find_one({"_id": image_oid}, {"_id": 1}):
+                raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
             raise HTTPException(status.HTTP_400_BAD_REQUEST, "No has dado like a esta imagen")
         
-        # Actualizar la imagen
+        # Actualizar la imagen y leer el nuevo estado en la misma operación
         update_time = datetime.utcnow()  # Definir update_time aquí
-        await db.images.update_one(
-            {"_id": image_oid},
-            {
-                "$inc": {"likes_count": -1},
-                "$pull": {"liked_by": user_id},
-                "$set": {"updated_at": update_time}
-            }
+        updated_image = await counter_buffer.increment_and_get(
+            "images", image_oid, {"likes_count": -1}, sets={"updated_at": update_time}
         )
+        if not updated_image:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Imagen no encontrada")
         
-        # Obtener imagen actualizada
-        updated_image = await db.images.find_one({"_id": image_oid})
-        updated_image["_id"] = str(updated_image["_id"])
+        serialize_image(updated_image)
 
         # Preparar datos para el broadcast (similar a like_image)
         broadcast_data = {
             "image_id": image_id,
             "likes_count": updated_image.get("likes_count", 0),
-            "liked_by": updated_image.get("liked_by", []),
+            "user_id": user_id,
+            "liked": False,
             "timestamp": update_time.isoformat()  # Asegurar que es string
         }
 
@@ -445,6 +520,8 @@ async def unlike_image(
         
         return updated_image
         
+    except HTTPException:
+        raise
     except Exception as e:
         if "invalid object id" in str(e).lower():
             raise HTTPException(status.HTTP_400_BAD_REQUEST, "ID de imagen inválido")
@@ -460,10 +537,11 @@ async def upload_image(
 
     try:
         # Usar la función de utilidad
-        image_url = await upload_file_to_storage_post(file, "posts")
+        image_url = await store_upload(file, "posts")
+        image_variants = await build_variants(image_url, "posts")
 
         
-        return {"image_url": image_url}
+        return {"image_url": image_url, "image_variants": image_variants}
         
     except HTTPException as he:
         # Re-lanzar excepciones HTTP existentes
@@ -0,0 +1,28 @@
+from fastapi import APIRouter, Depends
+from app.auth import require_role, UserRole, principal_cache, token_cache
+from app.cache import post_cache
+from app.authors import author_cache
+from app.counters import counter_buffer
+from app.passwords import password_hasher
+from app.deletion import deletion_worker
+
+router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+
+@router.get("/", response_model=dict)
+async def get_metrics(
+    current_user: dict = Depends(require_role(UserRole.ADMIN))
+):
+    """
+    Métricas internas del proceso (solo administradores).
+    Los valores son por worker: cada proceso mantiene sus propios contadores.
+    """
+    return {
+        "post_cache": post_cache.stats(),
+        "author_cache": author_cache.stats(),
+        "principal_cache": principal_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "counter_buffer": counter_buffer.stats(),
+        "deletion": await deletion_worker.stats()
+    }
@@ -1,72 +1,86 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from bson import ObjectId
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Union
 from app.database import db
 from app.auth import require_role, UserRole
-from app.models.notification_model import Notification, NotificationCreate, NotificationType
+from app.models.notification_model import Notification, NotificationCreate, NotificationType, NotificationPartial
+from app.utils.fields import parse_fields, model_field_names
 from fastapi.encoders import jsonable_encoder
 from app.websocket_manager import manager
+from app.loaders import Loaders, get_loaders
+import asyncio
 
 router = APIRouter(prefix="/notifications", tags=["Notifications"])
 
+NOTIFICATION_FIELDS = model_field_names(Notification)
 
-@router.get("/", response_model=List[Notification])
+
+async def complete_notification(notif: dict, loaders: Loaders):
+    """Rellena los campos que las notificaciones antiguas pueden no tener"""
+    # Asegurarse de que todos los campos requeridos estén presentes
+    if "message" not in notif:
+        notif["message"] = ""  # O algún valor por defecto
+    if "emitter_username" not in notif:
+        # Obtener el username del emisor si no está en la notificación (en lote con el resto de la página)
+        emitter = await loaders.authors.load(str(notif["emitter_id"]))
+        notif["emitter_username"] = (emitter["username"] or "Usuario") if emitter else "Usuario"
+    
+    # Asegurar campos opcionales para imágenes
+    notif.setdefault("image_id", None)
+    notif.setdefault("image_url", None)
+    notif.setdefault("image_owner_id", None)
+    notif.setdefault("image_created_at", None)
+    notif.setdefault("post_id", None)
+    notif.setdefault("comment_id", None)
+
+    # Asegurar campos del post
+    notif.setdefault("post_title", "")
+    notif.setdefault("post_content", "")
+    notif.setdefault("post_author_id", "")
+    notif.setdefault("post_author_username", "Usuario")
+    notif.setdefault("post_author_profile_picture", "")
+    notif.setdefault("post_image_url", "")
+    notif.setdefault("post_likes_count", 0)
+    notif.setdefault("post_comments_count", 0)
+    notif.setdefault("post_liked_by", [])
+    notif.setdefault("post_created_at", datetime.utcnow())
+    notif.setdefault("post_updated_at", datetime.utcnow())
+
+
+@router.get("/", response_model=List[Union[Notification, NotificationPartial]], response_model_exclude_unset=True)
 async def get_user_notifications(
     current_user: dict = Depends(require_role(UserRole.USER)),
     limit: int = 100,
-    unread_only: bool = False
+    unread_only: bool = False,
+    fields: Optional[str] = None,
+    loaders: Loaders = Depends(get_loaders)
 ):
     """
     Obtiene las notificaciones del usuario actual.
     Parámetros:
     - limit: Límite de notificaciones a devolver (default: 100)
     - unread_only: Si True, devuelve solo las no leídas
+    - fields: Campos a devolver separados por comas (p. ej. type,message,read);
+      evita leer la copia del post embebida en cada notificación
     """
-    query = {"user_id": str(current_user["_id"])}
+    selected = parse_fields(fields, NOTIFICATION_FIELDS)
+    query = {"user_id": ObjectId(current_user["_id"])}
     
     if unread_only:
         query["read"] = False
     
-    notifications = []
-    async for notif in db.notifications.find(query).sort("created_at", -1).limit(limit):
-        # Asegurarse de que todos los campos requeridos estén presentes
-        if "message" not in notif:
-            notif["message"] = ""  # O algún valor por defecto
-        if "emitter_username" not in notif:
-            # Obtener el username del emisor si no está en la notificación
-            emitter = await db.users.find_one({"_id": ObjectId(notif["emitter_id"])})
-            notif["emitter_username"] = emitter.get("username", "Usuario") if emitter else "Usuario"
-        
-        # Asegurar campos opcionales para imágenes
-        notif.setdefault("image_id", None)
-        notif.setdefault("image_url", None)
-        notif.setdefault("image_owner_id", None)
-        notif.setdefault("image_created_at", None)
-        notif.setdefault("post_id", None)
-        notif.setdefault("comment_id", None)
-
-        # Asegurar campos del post
-        notif.setdefault("post_title", "")
-        notif.setdefault("post_content", "")
-        notif.setdefault("post_author_id", "")
-        notif.setdefault("post_author_username", "Usuario")
-        notif.setdefault("post_author_profile_picture", "")
-        notif.setdefault("post_image_url", "")
-        notif.setdefault("post_likes_count", 0)
-        notif.setdefault("post_comments_count", 0)
-        notif.setdefault("post_liked_by", [])
-        notif.setdefault("post_created_at", datetime.utcnow())
-        notif.setdefault("post_updated_at", datetime.utcnow())
-
-        # Convertir ObjectId a string
-        notif["_id"] = str(notif["_id"])
-        
-        # Asegurarse de que los campos opcionales estén presentes
-        notif.setdefault("post_id", None)
-        notif.setdefault("comment_id", None)
-        
-        notifications.append(notif)
+    projection = {field: 1 for field in selected} if selected is not None else None
+    
+    notifications = await db.notifications.find(query, projection).sort("created_at", -1).limit(limit).to_list(None)
+    if selected is None:
+        await asyncio.gather(*(complete_notification(notif, loaders) for notif in notifications))
+    
+    for notif in notifications:
+        # Convertir ObjectId a string (incluidas las referencias guardadas como ObjectId)
+        for field in ("_id", "user_id", "post_id"):
+            if isinstance(notif.get(field), ObjectId):
+                notif[field] = str(notif[field])
     
     return jsonable_encoder(notifications)
 
@@ -90,7 +104,7 @@ async def mark_notifications_as_read(
         update_result = await db.notifications.update_many(
             {
                 "_id": {"$in": object_ids},
-                "user_id": str(current_user["_id"])  # Asegurar que pertenecen al usuario
+                "user_id": ObjectId(current_user["_id"])  # Asegurar que pertenecen al usuario
             },
             {"$set": {"read": True, "read_at": datetime.utcnow()}}
         )
@@ -119,7 +133,7 @@ async def get_unread_count(
     Obtiene el conteo de notificaciones no leídas del usuario
     """
     count = await db.notifications.count_documents({
-        "user_id": str(current_user["_id"]),
+        "user_id": ObjectId(current_user["_id"]),
         "read": False
     })
     
@@ -1,9 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query, WebSocket
+from fastapi import APIRouter, Depends, HTTPException, status, Query, WebSocket, Request, Response
 from bson import ObjectId
 from app.auth import require_role, UserRole, optional_auth
 from app.database import db
-from app.models.post_model import Post, UserPostsResponse
-from typing import List, Optional
+from app.models.post_model import Post, PostResponse, UserPostsResponse, PostsPage
+from app.utils.pagination import encode_cursor, decode_cursor, keyset_match
+from app.utils.fields import parse_fields, project_stage, pick_fields, model_field_names
+from app.utils.etag import make_etag, etag_matches, set_etag, not_modified
+from app.cache import post_cache
+from app.counters import counter_buffer
+from app.likes import LIKE_TARGET_POST, add_like, remove_like, has_liked, liked_target_ids
+from app.timeline import fan_out_post, read_timeline_page
+from app.deletion import NOT_DELETED, request_post_deletion
+from app.trending import hot_score, hot_score_expression
+from app.image_variants import existing_variant_urls
+from app.authors import FEED_AUTHOR_MAP, AUTHOR_FIELD_MAP, attach_author_cards, get_author_cards
+from typing import List, Optional, Set, Union
 from ..websocket_manager import manager  # Importa el manager de WebSocket
 from app.models.notification_model import NotificationCreate
 from datetime import datetime
@@ -13,13 +24,32 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Campos guardados en la colección posts que se pueden pedir con ?fields=
+POST_STORED_FIELDS = model_field_names(Post)
+# Campos del feed calculados al leer (tarjeta del autor y likes)
+FEED_AUTHOR_FIELDS = set(FEED_AUTHOR_MAP)
+FEED_FIELDS = POST_STORED_FIELDS | FEED_AUTHOR_FIELDS | {"has_liked"}
+USER_POSTS_FIELDS = model_field_names(PostResponse)
+
+def invalidate_written_posts(collection: str, doc_ids: List[str]):
+    """Los contadores de estos posts cambiaron en la base de datos: descartar su caché"""
+    if collection == "posts":
+        for doc_id in doc_ids:
+            post_cache.invalidate(doc_id)
+
+counter_buffer.add_flush_listener(invalidate_written_posts)
+# La puntuación de tendencias se recalcula en la misma escritura que likes/comentarios
+counter_buffer.add_derived_field("posts", "hot_score", hot_score_expression())
+
 async def create_post_notification(
     notification_data: dict,
     current_user: dict,  # Esto podría estar llegando como string en lugar de dict
-    target_post_id: str
+    target_post_id: str,
+    post: Optional[dict] = None
 ):
     """
-    Crea una notificación con información completa del post
+    Crea una notificación con información completa del post.
+    Si el llamador ya tiene el documento del post, se pasa en `post` para no volver a leerlo.
     """
     try:
         print(f"Buscando post para notificación: {target_post_id}")
@@ -54,8 +84,9 @@ async def create_post_notification(
             )
         
         # Obtener información completa del post
-        post = await db.posts.find_one({"_id": post_object_id})
-        print(f"Post encontrado en notificación: {post is not None}")
+        if post is None:
+            post = await db.posts.find_one({"_id": post_object_id})
+            print(f"Post encontrado en notificación: {post is not None}")
         if not post:
             print(f"POST NO ENCONTRADO EN NOTIFICACIÓN: {target_post_id}")
             raise HTTPException(
@@ -70,7 +101,7 @@ async def create_post_notification(
         notification = {
             **notification_data,
             # Agregar información del post
-            "post_id": target_post_id,
+            "post_id": post_object_id,
             "post_title": post.get("title", ""),
             "post_content": post.get("content", ""),
             "post_author_id": str(post["author_id"]),
@@ -79,7 +110,6 @@ async def create_post_notification(
             "post_image_url": post.get("image_url", ""),
             "post_likes_count": post.get("likes_count", 0),
             "post_comments_count": post.get("comments_count", 0),
-            "post_liked_by": post.get("liked_by", []),
             "post_created_at": post.get("created_at", datetime.utcnow()),
             "post_updated_at": post.get("updated_at", datetime.utcnow()),
             # Campos requeridos
@@ -106,66 +136,260 @@ async def create_post_notification(
         )
 
 
-@router.get("/posts", response_model=List[dict])
+async def get_liked_post_ids(post_ids: List, current_user: Optional[dict]) -> Set[str]:
+    """Posts de la página a los que el usuario dio like (una sola consulta $in)"""
+    if not current_user:
+        return set()
+    return await liked_target_ids(LIKE_TARGET_POST, post_ids, current_user["_id"])
+
+def serialize_feed_post(post: dict, liked_post_ids: Set[str]) -> dict:
+    """Prepara un post del feed para la respuesta"""
+    counter_buffer.apply("posts", post)
+    post.pop("liked_by", None)  # Likes heredados (ver migrate-likes)
+    # Convertir ObjectId a string
+    post["_id"] = str(post["_id"])
+    if "author_id" in post:  # Puede faltar con ?fields=
+        post["author_id"] = str(post["author_id"])
+    post["has_liked"] = post["_id"] in liked_post_ids
+    return post
+
+
+@router.get("/posts", response_model=Union[List[dict], PostsPage])
 async def get_posts(
     skip: int = Query(0, ge=0),
-    limit: int = Query(10, le=100),
+    limit: int = Query(10, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor opaco devuelto como next_cursor (vacío para la primera página)"),
+    fields: Optional[str] = Query(None, description="Campos a devolver separados por comas, p. ej. title,likes_count"),
+    current_user: Optional[dict] = Depends(optional_auth)
+):
+    """
+    Feed global de posts.
+    - Sin `after`: paginación clásica con skip/limit (devuelve una lista).
+    - Con `after`: paginación por cursor sobre (created_at, _id); devuelve
+      {"posts", "next_cursor"} y cada página cuesta lo mismo sin importar la profundidad.
+    - Con `fields`: solo se leen de la base de datos los campos pedidos.
+    """
+    cursor_mode = after is not None
+    selected = parse_fields(fields, FEED_FIELDS)
+
+    if cursor_mode:
+        match = {}
+        if after:
+            after_created_at, after_id = decode_cursor(after)
+            match = keyset_match("created_at", after_created_at, after_id)
+        page_stages = [
+            {"$match": {**match, **NOT_DELETED}},
+            {"$sort": {"created_at": -1, "_id": -1}},
+            {"$limit": limit + 1}
+        ]
+    else:
+        page_stages = [
+            {"$match": NOT_DELETED},
+            {"$sort": {"created_at": -1}},
+            {"$skip": skip},
+            {"$limit": limit}
+        ]
+
+    pipeline = list(page_stages)
+    if selected is not None:
+        # El cursor necesita created_at y las tarjetas de autor necesitan author_id
+        extra = ["created_at"] if cursor_mode else []
+        if selected & FEED_AUTHOR_FIELDS:
+            extra.append("author_id")
+        pipeline.append(project_stage(selected, POST_STORED_FIELDS, extra))
+    
+    raw_posts = await db.posts.aggregate(pipeline).to_list(None)
+    if selected is None or selected & FEED_AUTHOR_FIELDS:
+        await attach_author_cards(raw_posts, FEED_AUTHOR_MAP)
+    liked_post_ids = set()
+    if selected is None or "has_liked" in selected:
+        liked_post_ids = await get_liked_post_ids([post["_id"] for post in raw_posts], current_user)
+    posts = [serialize_feed_post(post, liked_post_ids) for post in raw_posts]
+    
+    if not cursor_mode:
+        return [pick_fields(post, selected) for post in posts]
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        next_cursor = encode_cursor(last["created_at"], last["_id"])
+
+    return {
+        "posts": [pick_fields(post, selected) for post in posts],
+        "next_cursor": next_cursor
+    }
+
+@router.get("/posts/timeline", response_model=PostsPage)
+async def get_friends_timeline(
+    limit: int = Query(10, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor opaco devuelto como next_cursor"),
+    current_user: dict = Depends(require_role(UserRole.USER))
+):
+    """
+    Timeline con los posts de los amigos del usuario actual, paginado por cursor.
+    """
+    user = await db.users.find_one(
+        {"_id": ObjectId(current_user["_id"])},
+        {"relationships": 1}
+    )
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Usuario no encontrado"
+        )
+
+    entries = await read_timeline_page(user, limit, decode_cursor(after) if after else None)
+
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(*entries[-1])
+
+    post_ids = [post_id for _, post_id in entries]
+    posts_by_id = {}
+    if post_ids:
+        raw_posts = await db.posts.find({"_id": {"$in": post_ids}, **NOT_DELETED}).to_list(None)
+        await attach_author_cards(raw_posts, FEED_AUTHOR_MAP)
+        liked_post_ids = await get_liked_post_ids(post_ids, current_user)
+        for post in raw_posts:
+            posts_by_id[post["_id"]] = serialize_feed_post(post, liked_post_ids)
+
+    return {
+        # Mantener el orden del timeline; los posts ya eliminados se omiten
+        "posts": [posts_by_id[post_id] for post_id in post_ids if post_id in posts_by_id],
+        "next_cursor": next_cursor
+    }
+
+@router.get("/posts/search", response_model=PostsPage)
+async def search_posts(
+    q: str = Query(..., min_length=2, max_length=200, description="Texto a buscar en título y contenido"),
+    limit: int = Query(10, ge=1, le=50),
+    after: Optional[str] = Query(None, description="Cursor opaco devuelto como next_cursor"),
+    current_user: Optional[dict] = Depends(optional_auth)
+):
+    """
+    Búsqueda de posts por relevancia con el índice de texto `posts_text`
+    (stemming en español; el título pesa el triple que el contenido).
+    Se pagina por cursor sobre (score, _id).
+    """
+    pipeline = [
+        {"$match": {"$text": {"$search": q, "$language": "spanish"}, **NOT_DELETED}},
+        {"$addFields": {"score": {"$meta": "textScore"}}}
+    ]
+    if after:
+        after_score, after_id = decode_cursor(after)
+        pipeline.append({"$match": keyset_match("score", after_score, after_id)})
+    pipeline += [
+        {"$sort": {"score": -1, "_id": -1}},
+        {"$limit": limit + 1}
+    ]
+
+    raw_posts = await db.posts.aggregate(pipeline).to_list(None)
+    await attach_author_cards(raw_posts, FEED_AUTHOR_MAP)
+    liked_post_ids = await get_liked_post_ids([post["_id"] for post in raw_posts], current_user)
+    posts = [serialize_feed_post(post, liked_post_ids) for post in raw_posts]
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        next_cursor = encode_cursor(last["score"], last["_id"])
+
+    return {
+        "posts": posts,
+        "next_cursor": next_cursor
+    }
+
+@router.get("/posts/trending", response_model=PostsPage)
+async def get_trending_posts(
+    limit: int = Query(10, ge=1, le=50),
+    after: Optional[str] = Query(None, description="Cursor opaco devuelto como next_cursor"),
     current_user: Optional[dict] = Depends(optional_auth)
 ):
-    # Usar agregación para hacer JOIN con users en una sola consulta
+    """
+    Posts en tendencia: ordenados por hot_score precalculado (ver app/trending.py),
+    leídos por rango del índice (hot_score, _id) y paginados por cursor.
+    """
+    match = {"hot_score": {"$exists": True}, **NOT_DELETED}
+    if after:
+        after_score, after_id = decode_cursor(after)
+        match.update(keyset_match("hot_score", after_score, after_id))
+
     pipeline = [
+        {"$match": match},
+        {"$sort": {"hot_score": -1, "_id": -1}},
+        {"$limit": limit + 1}
+    ]
+
+    raw_posts = await db.posts.aggregate(pipeline).to_list(None)
+    await attach_author_cards(raw_posts, FEED_AUTHOR_MAP)
+    liked_post_ids = await get_liked_post_ids([post["_id"] for post in raw_posts], current_user)
+    posts = [serialize_feed_post(post, liked_post_ids) for post in raw_posts]
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        next_cursor = encode_cursor(last["hot_score"], last["_id"])
+
+    return {
+        "posts": posts,
+        "next_cursor": next_cursor
+    }
+
+def user_posts_pipeline(
+    user_object_id: ObjectId,
+    skip: int,
+    limit: int,
+    selected: Optional[Set[str]] = None
+) -> List[dict]:
+    """Usuario con una página de sus posts y el total (joins por índice sobre posts.author_id)"""
+    page_stages = [
+        {"$match": NOT_DELETED},
         {"$sort": {"created_at": -1}},
         {"$skip": skip},
-        {"$limit": limit},
+        {"$limit": limit}
+    ]
+    if selected is not None:
+        page_stages.append(project_stage(selected, POST_STORED_FIELDS))
+
+    return [
+        {"$match": {"_id": user_object_id, **NOT_DELETED}},
         {
             "$lookup": {
-                "from": "users",
-                "localField": "author_id",
-                "foreignField": "_id",
-                "as": "author_info"
+                "from": "posts",
+                "localField": "_id",
+                "foreignField": "author_id",
+                "pipeline": page_stages,
+                "as": "user_posts"
             }
         },
         {
-            "$addFields": {
-                "profile_picture": {
-                    "$ifNull": [
-                        {"$arrayElemAt": ["$author_info.profile_picture", 0]},
-                        ""
-                    ]
-                },
-                "username": {
-                    "$ifNull": [
-                        {"$arrayElemAt": ["$author_info.username", 0]},
-                        ""
-                    ]
-                }
+            "$lookup": {
+                "from": "posts",
+                "localField": "_id",
+                "foreignField": "author_id",
+                "pipeline": [
+                    {"$match": NOT_DELETED},
+                    {"$count": "total"}
+                ],
+                "as": "total_count"
             }
         },
-        {"$unset": "author_info"}  # Remover el array temporal
+        # Del usuario solo hacen falta los datos que se copian a cada post
+        {"$project": {"username": 1, "profile_picture": 1, "user_posts": 1, "total_count": 1}}
     ]
-    
-    posts = []
-    async for post in db.posts.aggregate(pipeline):
-        # Convertir ObjectId a string
-        post["_id"] = str(post["_id"])
-        post["author_id"] = str(post["author_id"])
-        
-        # Verificar likes si hay usuario autenticado
-        liked_by = [str(user) for user in post.get("liked_by", [])]
-        post["has_liked"] = current_user and str(current_user["_id"]) in liked_by
-        post["liked_by"] = liked_by
-        
-        posts.append(post)
-    
-    return posts
 
-@router.get("/posts/user/{user_id}", response_model=UserPostsResponse)
+@router.get("/posts/user/{user_id}", response_model=UserPostsResponse, response_model_exclude_unset=True)
 async def get_user_posts(
     user_id: str,
     skip: int = Query(0, ge=0),
     limit: int = Query(10, le=100),
+    fields: Optional[str] = Query(None, description="Campos de cada post separados por comas, p. ej. title,likes_count"),
     current_user: Optional[dict] = Depends(optional_auth)
 ):
+    selected = parse_fields(fields, USER_POSTS_FIELDS)
     try:
         user_object_id = ObjectId(user_id)
     except:
@@ -175,35 +399,7 @@ async def get_user_posts(
         )
     
     # Verificar si el usuario existe y obtener posts en una sola agregación
-    pipeline = [
-        {"$match": {"_id": user_object_id}},
-        {
-            "$lookup": {
-                "from": "posts",
-                "let": {"user_id_str": {"$toString": "$_id"}},
-                "pipeline": [
-                    {"$match": {"$expr": {"$eq": ["$author_id", "$$user_id_str"]}}},
-                    {"$sort": {"created_at": -1}},
-                    {"$skip": skip},
-                    {"$limit": limit}
-                ],
-                "as": "user_posts"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "posts",
-                "let": {"user_id_str": {"$toString": "$_id"}},
-                "pipeline": [
-                    {"$match": {"$expr": {"$eq": ["$author_id", "$$user_id_str"]}}},
-                    {"$count": "total"}
-                ],
-                "as": "total_count"
-            }
-        }
-    ]
-    
-    result = await db.users.aggregate(pipeline).to_list(1)
+    result = await db.users.aggregate(user_posts_pipeline(user_object_id, skip, limit, selected)).to_list(1)
     
     if not result:
         raise HTTPException(
@@ -213,24 +409,29 @@ async def get_user_posts(
     
     user_data = result[0]
     posts = []
+    liked_post_ids = set()
+    if selected is None or "has_liked" in selected:
+        liked_post_ids = await get_liked_post_ids(
+            [post["_id"] for post in user_data.get("user_posts", [])],
+            current_user
+        )
     
     for post in user_data.get("user_posts", []):
-        liked_by = [str(user) for user in post.get("liked_by", [])]
+        counter_buffer.apply("posts", post)
         post_dict = {
             "_id": str(post["_id"]),
-            "title": post["title"],
-            "content": post["content"],
-            "author_id": str(post.get("author_id", "")),
+            "title": post.get("title"),
+            "content": post.get("content"),
+            "author_id": user_id,
             "author_username": user_data["username"],
             "image_url": post.get("image_url", ""),
-            "created_at": post["created_at"],
+            "created_at": post.get("created_at"),
             "likes_count": post.get("likes_count", 0),
-            "liked_by": liked_by,
             "comments_count": post.get("comments_count", 0),
             "author_profile_picture": user_data.get("profile_picture", ""),
-            "has_liked": current_user and str(current_user["_id"]) in liked_by
+            "has_liked": str(post["_id"]) in liked_post_ids
         }
-        posts.append(post_dict)
+        posts.append(pick_fields(post_dict, selected))
     
     total_count_data = user_data.get("total_count", [])
     total_posts = total_count_data[0].get("total", 0) if total_count_data else 0
@@ -242,10 +443,33 @@ async def get_user_posts(
         "limit": limit
     }
 
+def post_etag(post_id: str, post_version: int, author_version: int, current_user: Optional[dict]) -> str:
+    """ETag del detalle de un post: cambia con el post, con el perfil del autor y según quién lo pide (has_liked)"""
+    viewer_id = str(current_user["_id"]) if current_user else ""
+    return make_etag("post", post_id, post_version, author_version, viewer_id)
+
+async def current_post_etag(post_object_id: ObjectId, current_user: Optional[dict]) -> str:
+    """Calcula el ETag con una lectura por _id y la tarjeta del autor, sin cargar el post completo"""
+    post = await db.posts.find_one({"_id": post_object_id, **NOT_DELETED}, {"version": 1, "author_id": 1})
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Post no encontrado"
+        )
+    counter_buffer.apply("posts", post)
+    author = (await get_author_cards([post["author_id"]])).get(str(post["author_id"]), {})
+    return post_etag(str(post_object_id), post.get("version", 0), author.get("version", 0), current_user)
+
 @router.get("/posts/{post_id}", response_model=dict)
-async def get_post(post_id: str, current_user: Optional[dict] = Depends(optional_auth)):
+async def get_post(
+    post_id: str,
+    request: Request,
+    response: Response,
+    current_user: Optional[dict] = Depends(optional_auth)
+):
     """
     Obtiene un post específico por su ID con información completa del autor.
+    Con If-None-Match responde 304 si el post no cambió.
     """
     try:
         post_object_id = ObjectId(post_id)
@@ -255,48 +479,41 @@ async def get_post(post_id: str, current_user: Optional[dict] = Depends(optional
             detail="ID de post inválido"
         )
     
-    # Usar agregación para obtener el post con información del autor
-    pipeline = [
-        {"$match": {"_id": post_object_id}},
-        {
-            "$lookup": {
-                "from": "users",
-                "let": {"author_id_str": "$author_id"},
-                "pipeline": [
-                    {
-                        "$match": {
-                            "$expr": {
-                                "$eq": [
-                                    {"$toString": "$_id"},
-                                    "$$author_id_str"
-                                ]
-                            }
-                        }
-                    }
-                ],
-                "as": "author_info"
-            }
-        },
-        {
-            "$addFields": {
-                "author_profile_picture": {
-                    "$ifNull": [
-                        {"$arrayElemAt": ["$author_info.profile_picture", 0]},
-                        ""
-                    ]
-                },
-                "author_username": {
-                    "$ifNull": [
-                        {"$arrayElemAt": ["$author_info.username", 0]},
-                        ""
-                    ]
-                }
-            }
-        },
-        {"$unset": "author_info"}  # Remover el array temporal
-    ]
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = await current_post_etag(post_object_id, current_user)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    post = post_cache.get(post_id)
+    if post is None:
+        post = await load_post(post_object_id)
+        post_cache.set(post_id, post)
     
-    result = await db.posts.aggregate(pipeline).to_list(1)
+    # La caché guarda el estado de la base de datos; sumar los contadores pendientes
+    counter_buffer.apply("posts", post)
+    # Datos actuales del autor (author_version cambia cuando edita su perfil, para el ETag)
+    await attach_author_cards([post], {**AUTHOR_FIELD_MAP, "author_version": "version"})
+    
+    # Verificar likes si hay usuario autenticado
+    post["has_liked"] = bool(current_user) and await has_liked(LIKE_TARGET_POST, post_object_id, current_user["_id"])
+    
+    author_version = post.pop("author_version", 0)
+    set_etag(response, post_etag(post_id, post.get("version", 0), author_version, current_user))
+    return post
+
+def post_detail_pipeline(post_object_id: ObjectId) -> List[dict]:
+    """Post por _id; los datos del autor se añaden al leer con su tarjeta (ver app/authors.py)"""
+    return [
+        {"$match": {"_id": post_object_id, **NOT_DELETED}},
+        {"$unset": "liked_by"}  # Remover likes heredados
+    ]
+
+async def load_post(post_object_id: ObjectId) -> dict:
+    """
+    Carga un post tal como está en la base de datos (sin datos del autor ni del usuario que lo consulta)
+    """
+    result = await db.posts.aggregate(post_detail_pipeline(post_object_id)).to_list(1)
     
     if not result:
         raise HTTPException(
@@ -310,11 +527,6 @@ async def get_post(post_id: str, current_user: Optional[dict] = Depends(optional
     post["_id"] = str(post["_id"])
     post["author_id"] = str(post["author_id"])
     
-    # Verificar likes si hay usuario autenticado
-    liked_by = [str(user) for user in post.get("liked_by", [])]
-    post["has_liked"] = current_user and str(current_user["_id"]) in liked_by
-    post["liked_by"] = liked_by
-    
     return post
 
 @router.post("/posts")
@@ -332,13 +544,26 @@ async def create_post(
     
     # Crear el diccionario del post con el author_username
     post_data = post.dict()
-    post_data["author_id"] = str(current_user["_id"])
+    # Contadores y fecha los pone el servidor (de ellos sale hot_score; no se aceptan los del cliente)
+    post_data["likes_count"] = 0
+    post_data["comments_count"] = 0
+    post_data["created_at"] = datetime.utcnow()
+    post_data["author_id"] = ObjectId(current_user["_id"])
     post_data["author_username"] = user["username"]
     post_data["author_profile_picture"] = user["profile_picture"]
+    # Las variantes se generaron al subir la imagen; no se aceptan las que mande el cliente
+    post_data["image_variants"] = await existing_variant_urls(post_data.get("image_url"), "posts")
+    post_data["hot_score"] = hot_score(0, 0, post_data["created_at"])
     
     # Insertar el post en la base de datos
     result = await db.posts.insert_one(post_data)
     
+    # Copiar el post al timeline de los amigos
+    try:
+        await fan_out_post(user, result.inserted_id, post_data["created_at"])
+    except Exception as e:
+        logger.error(f"Error en fan-out del post {result.inserted_id}: {str(e)}")
+    
     # Obtener el post creado para devolverlo
     created_post = await db.posts.find_one({"_id": result.inserted_id})
     
@@ -367,30 +592,10 @@ async def delete_post(
             detail="ID de post inválido"
         )
         
-    # Primero verificar si el post existe
-    post = await db.posts.find_one({"_id": post_object_id})
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post no encontrado"
-        )
-        
-    # Eliminar todos los comentarios asociados al post
-    delete_comments_result = await db.comments.delete_many({"post_id": post_id})
-    print(f"Eliminados {delete_comments_result.deleted_count} comentarios del post {post_id}")
-    
-    # Eliminar todas las notificaciones relacionadas con el post
-    delete_notifications_result = await db.notifications.delete_many({
-        "$or": [
-            {"related_post_id": post_id},  # Notificaciones directas sobre el post
-            {"post_id": post_id}          # Notificaciones sobre comentarios en el post
-        ]
-    })
-    print(f"Eliminadas {delete_notifications_result.deleted_count} notificaciones relacionadas con el post {post_id}")
-    
-    delete_result = await db.posts.delete_one({"_id": post_object_id})
-    
-    if delete_result.deleted_count == 0:
+    # Marcar el post como borrado (deja de verse al instante); comentarios,
+    # notificaciones, likes y archivos se borran en segundo plano por lotes
+    job_id = await request_post_deletion(post_object_id, requested_by=str(token_data["_id"]))
+    if job_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Post no encontrado"
@@ -400,9 +605,8 @@ async def delete_post(
     await manager.broadcast_deleted_post(post_id)
     
     return {
-        "message": "Post y sus comentarios eliminados exitosamente",
-        "deleted_comments": delete_comments_result.deleted_count,
-        "deleted_notifications": delete_notifications_result.deleted_count
+        "message": "Post eliminado; sus comentarios se eliminan en segundo plano",
+        "deletion_job_id": str(job_id)
     }
 
 @router.post("/posts/{post_id}/like")
@@ -419,46 +623,26 @@ async def like_post(
             detail="ID inválido"
         )
     
-    # DEBUG: Verificar si el post existe ANTES de cualquier operación
-    print(f"Buscando post con ID: {post_id}")
-    post = await db.posts.find_one({"_id": post_object_id})
-    print(f"Post encontrado: {post is not None}")
-    
-    # Verificar si el post existe
-    post = await db.posts.find_one({"_id": post_object_id})
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post no encontrado"
-        )
-    
-    # Verificar si el usuario ya dio like
-    if user_id in post.get("liked_by", []):
+    # Registrar el like: el índice único de `likes` hace la verificación
+    # atómica, así que dos peticiones simultáneas no pueden contar dos veces
+    if not await add_like(LIKE_TARGET_POST, post_object_id, user_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Ya has dado like a este post"
         )
     
-    # Actualizar el post
-    update_result = await db.posts.update_one(
-        {"_id": post_object_id},
-        {
-            "$inc": {"likes_count": 1},
-            "$push": {"liked_by": user_id}
-        }
-    )
-    
-    if update_result.modified_count == 0:
+    # Incrementar el contador y leer el nuevo estado en la misma operación
+    post = await counter_buffer.increment_and_get("posts", post_object_id, {"likes_count": 1, "version": 1})
+    if not post or post.get("deleted_at"):
+        # El post no existe o está pendiente de borrado: deshacer el like registrado
+        if post:
+            await counter_buffer.increment("posts", post_object_id, {"likes_count": -1})
+        await remove_like(LIKE_TARGET_POST, post_object_id, user_id)
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No se pudo actualizar el post"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Post no encontrado"
         )
     
-    # Obtener el post actualizado
-    updated_post = await db.posts.find_one({"_id": post_object_id})
-    updated_post["_id"] = str(updated_post["_id"])
-
-    
     # Emitir evento WebSocket
     await manager.broadcast_event(
         post_id,
@@ -466,8 +650,9 @@ async def like_post(
             "event": "post_updated",
             "data": {
                 "post_id": post_id,
-                "likes_count": updated_post["likes_count"],
-                "liked_by": updated_post.get("liked_by", [])
+                "likes_count": post["likes_count"],
+                "user_id": user_id,
+                "liked": True
             }
         }
     )
@@ -475,7 +660,7 @@ async def like_post(
     # Crear notificación si no es like propio
     if str(post["author_id"]) != str(current_user["_id"]):
         notification = {
-            "user_id": str(post["author_id"]),
+            "user_id": ObjectId(post["author_id"]),
             "emitter_id": str(current_user["_id"]),
             "type": "like",
             "message": f"A {current_user['username']} le gusta tu publicación",
@@ -484,9 +669,7 @@ async def like_post(
             "read": False
         }
 
-        print(f"Intentando crear notificación para post: {post_id}")
-
-        await create_post_notification(notification, current_user, post_id)
+        await create_post_notification(notification, current_user, post_id, post=post)
         
         # try:
         #     # Guardar en base de datos
@@ -523,37 +706,27 @@ async def unlike_post(
             detail="ID inválido"
         )
     
-    post = await db.posts.find_one({"_id": post_object_id})
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post no encontrado"
-        )
-    
-    if user_id not in post.get("liked_by", []):
+    # Solo quien tenía el like puede decrementar el contador
+    if not await remove_like(LIKE_TARGET_POST, post_object_id, user_id):
+        # Consulta extra solo en el camino de error, para distinguir 404 de 400
+        if not await db.posts.find_one({"_id": post_object_id, **NOT_DELETED}, {"_id": 1}):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Post no encontrado"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No has dado like a este post"
         )
     
-    update_result = await db.posts.update_one(
-        {"_id": post_object_id},
-        {
-            "$inc": {"likes_count": -1},
-            "$pull": {"liked_by": user_id}
-        }
-    )
-    
-    if update_result.modified_count == 0:
+    # Decrementar el contador y leer el nuevo estado en la misma operación
+    updated_post = await counter_buffer.increment_and_get("posts", post_object_id, {"likes_count": -1, "version": 1})
+    if not updated_post:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No se pudo actualizar el post"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Post no encontrado"
         )
     
-    # Obtener el post actualizado
-    updated_post = await db.posts.find_one({"_id": post_object_id})
-    updated_post["_id"] = str(updated_post["_id"])
-    
     # Emitir evento WebSocket
     await manager.broadcast_event(
         post_id,
@@ -562,7 +735,8 @@ async def unlike_post(
             "data": {
                 "post_id": post_id,
                 "likes_count": updated_post["likes_count"],
-                "liked_by": updated_post.get("liked_by", [])
+                "user_id": user_id,
+                "liked": False
             }
         }
     )
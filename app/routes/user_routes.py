@@ -1,11 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
 from app.auth import (
     create_access_token,
     get_password_hash,
-    verify_password,
+    verify_and_update_password,
     ACCESS_TOKEN_EXPIRE_MINUTES,
     require_role,
-    optional_auth
+    optional_auth,
+    invalidate_principal
 )
 from app.database import db
 from app.models.user_model import UserCreate, UserInDB, UserLogin, UserRole, UserUpdate
@@ -15,6 +16,10 @@ from typing import Optional
 import logging
 from pydantic import BaseModel
 from ..websocket_manager import manager  # Importa el manager de WebSocket
+from app.authors import invalidate_author
+from app.loaders import Loaders, get_loaders
+from app.utils.etag import make_etag, etag_matches, set_etag, not_modified
+from app.deletion import NOT_DELETED, request_user_deletion
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -39,7 +44,7 @@ async def register(user: UserCreate):
         )
     
     # Hashear la contraseña
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     
     # Crear documento para la base de datos
     db_user = {
@@ -93,7 +98,7 @@ async def register(user: UserCreate):
 async def login(login_data: UserLogin):
     try:
         # Buscar usuario en la base de datos
-        db_user = await db.users.find_one({"username": login_data.username})
+        db_user = await db.users.find_one({"username": login_data.username, **NOT_DELETED})
         
         if not db_user:
             logger.warning(f"Usuario no encontrado: {login_data.username}")
@@ -103,13 +108,21 @@ async def login(login_data: UserLogin):
             )
         
         # Verificar contraseña
-        if not verify_password(login_data.password, db_user.get("hashed_password", "")):
+        verified, new_hash = await verify_and_update_password(login_data.password, db_user.get("hashed_password", ""))
+        if not verified:
             logger.warning(f"Contraseña incorrecta para el usuario: {login_data.username}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials"
             )
         
+        # Rehacer el hash si se subió BCRYPT_ROUNDS (solo si nadie lo cambió mientras tanto)
+        if new_hash:
+            await db.users.update_one(
+                {"_id": db_user["_id"], "hashed_password": db_user["hashed_password"]},
+                {"$set": {"hashed_password": new_hash}}
+            )
+        
         # Crear token de acceso
         access_token = create_access_token(
             data={
@@ -134,6 +147,8 @@ async def login(login_data: UserLogin):
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         raise HTTPException(
@@ -209,7 +224,7 @@ async def update_user_profile(
         
         # Manejo de contraseña
         if update_data.password:
-            update_values["hashed_password"] = get_password_hash(update_data.password)
+            update_values["hashed_password"] = await get_password_hash(update_data.password)
         
         if not update_values:
             raise HTTPException(
@@ -223,7 +238,7 @@ async def update_user_profile(
         # Ejecutar actualización
         result = await db.users.update_one(
             {"_id": user_oid},
-            {"$set": update_values}
+            {"$set": update_values, "$inc": {"version": 1}}  # version: invalida los ETags del perfil
         )
         
         if result.modified_count == 0:
@@ -240,24 +255,11 @@ async def update_user_profile(
                 detail="Usuario no encontrado después de actualización"
             )
         
-        # Si se actualizó el username o la foto de perfil, actualizar los posts
+        # Los posts y comentarios toman username y foto de la tarjeta del autor al leerse
         if update_data.username or update_data.profile_picture:
-            update_posts_data = {}
-            if update_data.username:
-                update_posts_data["author_username"] = updated_user["username"]
-            if update_data.profile_picture:
-                update_posts_data["author_profile_picture"] = updated_user["profile_picture"]
-            if update_data.cover_photo:
-                update_posts_data["author_cover_photo"] = updated_user["cover_photo"]    
-            if update_data.bio:
-                update_posts_data["author_bio"] = updated_user["bio"]    
-            
-            # Actualizar todos los posts del usuario
-            if update_posts_data:
-                await db.posts.update_many(
-                    {"author_id": str(updated_user["_id"])},
-                    {"$set": update_posts_data}
-                )
+            invalidate_author(updated_user["_id"])
+        # El usuario autenticado en caché (incluye cambios de contraseña)
+        invalidate_principal(updated_user["_id"])
             
         # Crear nuevo token si se cambió el username
         new_token = None
@@ -320,10 +322,21 @@ async def update_user_profile(
             detail="Error interno al procesar la solicitud"
         )
         
+def profile_etag(user_id: str, user_version: int, current_user: Optional[dict]) -> str:
+    """ETag del perfil: depende del usuario y de quién lo pide (amistad, campos visibles)"""
+    viewer = (
+        (str(current_user["_id"]), current_user.get("version", 0), current_user.get("role"))
+        if current_user else ("", 0, "")
+    )
+    return make_etag("user", user_id, user_version, *viewer)
+
 @router.get("/users/{user_id}", response_model=UserInDB)
 async def get_user_profile(
     user_id: str,
-    current_user: dict = Depends(optional_auth)
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(optional_auth),
+    loaders: Loaders = Depends(get_loaders)
 ):
     try:
         
@@ -335,7 +348,17 @@ async def get_user_profile(
             )
             
         user_oid = ObjectId(user_id)
-        user = await db.users.find_one({"_id": user_oid})
+
+        # Revalidación barata: solo la versión del usuario
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            version_doc = await db.users.find_one({"_id": user_oid, **NOT_DELETED}, {"version": 1})
+            if version_doc:
+                etag = profile_etag(user_id, version_doc.get("version", 0), current_user)
+                if etag_matches(if_none_match, etag):
+                    return not_modified(etag)
+
+        user = await db.users.find_one({"_id": user_oid, **NOT_DELETED})
         
         # # Verificar permisos (solo admin puede ver otros perfiles)
         # if current_user["id"] != user_id and current_user["role"] != UserRole.ADMIN.value:
@@ -351,19 +374,10 @@ async def get_user_profile(
                 detail="Usuario no encontrado"
             )
 
-        # Obtener URLs de las imágenes si existen
-        profile_picture_url = None
-        cover_photo_url = None
-
-        if user.get("current_profile_picture"):
-            profile_pic = await db.images.find_one({"_id": ObjectId(user["current_profile_picture"])})
-            if profile_pic:
-                profile_picture_url = profile_pic.get("url")
-        
-        if user.get("current_cover_photo"):
-            cover_photo = await db.images.find_one({"_id": ObjectId(user["current_cover_photo"])})
-            if cover_photo:
-                cover_photo_url = cover_photo.get("url")
+        # Obtener URLs de las imágenes si existen (ambas en una consulta)
+        profile_picture_url, cover_photo_url = await loaders.image_urls.load_many(
+            [user.get("current_profile_picture"), user.get("current_cover_photo")]
+        )
         
         # Si hay usuario autenticado, verificar si es el mismo o admin
         if current_user:
@@ -419,6 +433,7 @@ async def get_user_profile(
             response_data["email"] = user["email"]
             response_data["hashed_password"] = user["hashed_password"]
         
+        set_etag(response, profile_etag(user_id, user.get("version", 0), current_user))
         return UserInDB(**response_data)
     except HTTPException:
         raise
@@ -429,6 +444,28 @@ async def get_user_profile(
             detail="Error interno del servidor"
         )
 
+@router.delete("/users/{user_id}", status_code=status.HTTP_202_ACCEPTED)
+async def delete_user_account(
+    user_id: str,
+    current_user: dict = Depends(require_role(UserRole.USER))
+):
+    """
+    Elimina la cuenta del usuario actual. La cuenta y sus posts dejan de verse
+    al instante; posts, comentarios, likes, imágenes y notificaciones se borran
+    en segundo plano (ver app/deletion.py).
+    """
+    if str(current_user["_id"]) != user_id:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    
+    job_id = await request_user_deletion(ObjectId(user_id), requested_by=user_id)
+    if job_id is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    
+    return {
+        "message": "Cuenta eliminada; sus datos se eliminan en segundo plano",
+        "deletion_job_id": str(job_id)
+    }
+
 @router.patch("/users/{user_id}/profile-picture")
 async def set_profile_picture(
     user_id: str,
@@ -442,7 +479,7 @@ async def set_profile_picture(
     # Verificar que la imagen existe y pertenece al usuario
     image = await db.images.find_one({
         "_id": ObjectId(image_data["imageId"]),
-        "owner_id": user_id
+        "owner_id": ObjectId(user_id)
     })
     if not image:
         raise HTTPException(status_code=404, detail="Imagen no encontrada")
@@ -450,11 +487,16 @@ async def set_profile_picture(
     # Actualizar el usuario
     await db.users.update_one(
         {"_id": ObjectId(user_id)},
-        {"$set": {
-            "current_profile_picture": image_data["imageId"],
-            "profile_picture": image["url"]
-        }}
+        {
+            "$set": {
+                "current_profile_picture": image_data["imageId"],
+                "profile_picture": image["url"]
+            },
+            "$inc": {"version": 1}
+        }
     )
+    invalidate_author(user_id)
+    invalidate_principal(user_id)
     
     return {"message": "Foto de perfil actualizada"}
 
@@ -471,7 +513,7 @@ async def set_cover_photo(
     # Verificar que la imagen existe y pertenece al usuario
     image = await db.images.find_one({
         "_id": ObjectId(image_data["imageId"]),
-        "owner_id": user_id
+        "owner_id": ObjectId(user_id)
     })
     if not image:
         raise HTTPException(status_code=404, detail="Imagen no encontrada")
@@ -479,11 +521,15 @@ async def set_cover_photo(
     # Actualizar el usuario
     await db.users.update_one(
         {"_id": ObjectId(user_id)},
-        {"$set": {
-            "current_cover_photo": image_data["imageId"],
-            "cover_photo": image["url"]
-        }}
+        {
+            "$set": {
+                "current_cover_photo": image_data["imageId"],
+                "cover_photo": image["url"]
+            },
+            "$inc": {"version": 1}
+        }
     )
+    invalidate_principal(user_id)
     
     return {"message": "Foto de portada actualizada"}
 
@@ -491,7 +537,8 @@ async def set_cover_photo(
 async def search_users(
     query: str = Query(..., min_length=1, description="Texto para buscar usuarios"),
     limit: int = Query(10, ge=1, le=100, description="Límite de resultados"),
-    current_user: dict = Depends(optional_auth)
+    current_user: dict = Depends(optional_auth),
+    loaders: Loaders = Depends(get_loaders)
 ):
     """
     Busca usuarios por nombre de usuario, email o biografía.
@@ -506,29 +553,23 @@ async def search_users(
                 {"username": search_regex},
                 {"email": search_regex},
                 {"bio": search_regex}
-            ]
+            ],
+            **NOT_DELETED
         }
         
         # Ejecutar la consulta
         users_cursor = db.users.find(search_query).limit(limit)
         users = await users_cursor.to_list(length=limit)
         
+        # URLs de las fotos de perfil y portada de todos los resultados en una sola consulta
+        image_ids = [user.get(field) for user in users for field in ("current_profile_picture", "current_cover_photo")]
+        image_urls = dict(zip(image_ids, await loaders.image_urls.load_many(image_ids)))
+        
         # Procesar resultados
         results = []
         for user in users:
-            # Obtener URLs de imágenes si existen
-            profile_picture_url = None
-            cover_photo_url = None
-            
-            if user.get("current_profile_picture"):
-                profile_pic = await db.images.find_one({"_id": ObjectId(user["current_profile_picture"])})
-                if profile_pic:
-                    profile_picture_url = profile_pic.get("url")
-            
-            if user.get("current_cover_photo"):
-                cover_photo = await db.images.find_one({"_id": ObjectId(user["current_cover_photo"])})
-                if cover_photo:
-                    cover_photo_url = cover_photo.get("url")
+            profile_picture_url = image_urls.get(user.get("current_profile_picture"))
+            cover_photo_url = image_urls.get(user.get("current_cover_photo"))
             
             # Ocultar información sensible si no es el usuario actual o admin
             if current_user:
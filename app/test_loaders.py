@@ -0,0 +1,272 @@
+"""
+DataLoader (agrupación, memoización, prime y errores) y número de consultas de los
+endpoints que resuelven datos relacionados con Loaders: una sola consulta $in a
+`images` (Loaders.image_urls) o a `users` (Loaders.authors) por petición, sin
+importar cuántos documentos haya.
+
+    python -m pytest app/test_loaders.py
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from starlette.requests import Request
+from starlette.responses import Response
+
+import app.authors as authors_module
+import app.loaders as loaders_module
+from app.authors import author_cache
+from app.loaders import DataLoader, Loaders
+from app.routes import notifications as notifications_module, user_routes
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction=1):
+        self.docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+    def __aiter__(self):
+        async def iterate():
+            for doc in self.docs:
+                yield doc
+        return iterate()
+
+
+class CountingBatch:
+    """Función de lote que registra las claves de cada llamada; falla las `failures` primeras"""
+    def __init__(self, failures=0):
+        self.calls = []
+        self.failures = failures
+
+    async def __call__(self, keys):
+        self.calls.append(list(keys))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("lote fallido")
+        return {key: f"valor-{key}" for key in keys if key != "ausente"}
+
+
+class FakeImages:
+    """Colección `images` que cuenta las consultas"""
+    def __init__(self, images):
+        self.images = {image["_id"]: image for image in images}
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        ids = query["_id"]["$in"]
+        return FakeCursor([self.images[image_id] for image_id in ids if image_id in self.images])
+
+    async def find_one(self, query, projection=None):
+        self.queries.append(query)
+        return self.images.get(query.get("_id"))
+
+
+class FakeUsers:
+    """Colección `users` que cuenta las consultas"""
+    def __init__(self, users):
+        self.users = users
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        if isinstance(query.get("_id"), dict):
+            ids = query["_id"]["$in"]
+            return FakeCursor([user for user in self.users if user["_id"] in ids])
+        return FakeCursor(self.users)
+
+    async def find_one(self, query, projection=None):
+        return next((user for user in self.users if user["_id"] == query.get("_id")), None)
+
+
+class FakeNotifications:
+    def __init__(self, notifications):
+        self.notifications = notifications
+
+    def find(self, query, projection=None):
+        return FakeCursor([notif for notif in self.notifications if notif["user_id"] == query["user_id"]])
+
+
+class FakeDB:
+    def __init__(self, users, images, notifications=()):
+        self.users = FakeUsers(users)
+        self.images = FakeImages(images)
+        self.notifications = FakeNotifications(list(notifications))
+
+
+def make_users(count):
+    users, images = [], []
+    for index in range(count):
+        profile = {"_id": ObjectId(), "url": f"/static/uploads/objects/p{index}.jpg"}
+        cover = {"_id": ObjectId(), "url": f"/static/uploads/objects/c{index}.jpg"}
+        images += [profile, cover]
+        users.append({
+            "_id": ObjectId(),
+            "username": f"usuario{index}",
+            "email": f"usuario{index}@example.com",
+            "role": "user",
+            "bio": "",
+            "current_profile_picture": str(profile["_id"]),
+            "current_cover_photo": str(cover["_id"]),
+            "created_at": datetime.utcnow(),
+            "relationships": {}
+        })
+    return users, images
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(users, images, notifications=()):
+        db = FakeDB(users, images, notifications)
+        for module in (user_routes, notifications_module, loaders_module, authors_module):
+            monkeypatch.setattr(module, "db", db)
+        # Las tarjetas de autor cacheadas de otro test evitarían la consulta
+        author_cache.clear()
+        return db
+    return install
+
+
+def test_dataloader_batches_loads_in_the_same_tick():
+    batch = CountingBatch()
+
+    async def run():
+        loader = DataLoader(batch)
+        values = await asyncio.gather(loader.load("a"), loader.load("b"), loader.load("a"), loader.load("ausente"))
+        return loader, values
+
+    loader, values = asyncio.run(run())
+
+    assert batch.calls == [["a", "b", "ausente"]]
+    assert loader.batches == 1
+    assert values == ["valor-a", "valor-b", "valor-a", None]
+
+
+def test_dataloader_splits_by_max_batch_size():
+    batch = CountingBatch()
+
+    async def run():
+        return await DataLoader(batch, max_batch_size=2).load_many(["a", "b", "c"])
+
+    assert asyncio.run(run()) == ["valor-a", "valor-b", "valor-c"]
+    assert batch.calls == [["a", "b"], ["c"]]
+
+
+def test_dataloader_memoizes_across_batches():
+    batch = CountingBatch()
+
+    async def run():
+        loader = DataLoader(batch)
+        first = await loader.load_many(["a", "b"])
+        second = await loader.load_many(["b", "a", "c"])
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert batch.calls == [["a", "b"], ["c"]]
+    assert first == ["valor-a", "valor-b"]
+    assert second == ["valor-b", "valor-a", "valor-c"]
+
+
+def test_dataloader_prime_skips_the_batch():
+    batch = CountingBatch()
+
+    async def run():
+        loader = DataLoader(batch)
+        loader.prime("a", "primado")
+        loader.prime("a", "ignorado")  # No pisa un valor ya conocido
+        return await loader.load_many(["a", "b"])
+
+    assert asyncio.run(run()) == ["primado", "valor-b"]
+    assert batch.calls == [["b"]]
+
+
+def test_dataloader_does_not_memoize_errors():
+    batch = CountingBatch(failures=1)
+
+    async def run():
+        loader = DataLoader(batch)
+        results = await asyncio.gather(loader.load("a"), loader.load("b"), return_exceptions=True)
+        retried = await loader.load_many(["a", "b"])
+        again = await loader.load("a")
+        return results, retried, again
+
+    results, retried, again = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retried == ["valor-a", "valor-b"]
+    assert again == "valor-a"
+    assert batch.calls == [["a", "b"], ["a", "b"]]
+
+
+@pytest.mark.parametrize("count", [1, 5, 50])
+def test_search_users_single_images_query(fake_db, count):
+    users, images = make_users(count)
+    db = fake_db(users, images)
+
+    results = asyncio.run(user_routes.search_users(query="usuario", limit=100, current_user=None, loaders=Loaders()))
+
+    assert len(db.images.queries) == 1
+    assert "$in" in db.images.queries[0]["_id"]
+    assert len(results) == count
+    assert [result.profile_picture_url for result in results] == [f"/static/uploads/objects/p{i}.jpg" for i in range(count)]
+    assert [result.cover_photo_url for result in results] == [f"/static/uploads/objects/c{i}.jpg" for i in range(count)]
+
+
+def test_get_user_profile_single_images_query(fake_db):
+    users, images = make_users(1)
+    db = fake_db(users, images)
+    request = Request({"type": "http", "method": "GET", "headers": []})
+
+    profile = asyncio.run(user_routes.get_user_profile(
+        str(users[0]["_id"]), request, Response(), current_user=None, loaders=Loaders()
+    ))
+
+    assert len(db.images.queries) == 1
+    assert "$in" in db.images.queries[0]["_id"]
+    assert profile.profile_picture_url == "/static/uploads/objects/p0.jpg"
+    assert profile.cover_photo_url == "/static/uploads/objects/c0.jpg"
+
+
+def test_get_user_notifications_single_users_query(fake_db):
+    users, images = make_users(5)
+    owner, emitters = users[0], users[1:]
+    now = datetime.utcnow()
+    notifs, expected = [], []
+    for index in range(12):
+        emitter = emitters[index % len(emitters)]
+        notif = {
+            "_id": ObjectId(),
+            "user_id": owner["_id"],
+            "emitter_id": str(emitter["_id"]),
+            "type": "like",
+            "message": "",
+            "read": False,
+            "created_at": now - timedelta(minutes=index)
+        }
+        # Las notificaciones antiguas no guardan el username del emisor
+        if index % 3:
+            notif["emitter_username"] = "guardado"
+        notifs.append(notif)
+        expected.append((str(notif["_id"]), notif.get("emitter_username", emitter["username"])))
+    missing = {ObjectId(notif["emitter_id"]) for notif in notifs if "emitter_username" not in notif}
+    db = fake_db(users, images, notifs)
+
+    results = asyncio.run(notifications_module.get_user_notifications(
+        current_user={"_id": str(owner["_id"])}, limit=100, unread_only=False, fields=None, loaders=Loaders()
+    ))
+
+    assert len(missing) > 1
+    assert len(db.users.queries) == 1
+    assert set(db.users.queries[0]["_id"]["$in"]) == missing
+    assert [(result["_id"], result["emitter_username"]) for result in results] == expected
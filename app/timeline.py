@@ -0,0 +1,148 @@
+# app/timeline.py
+"""
+Timeline materializado de amigos (fan-out-on-write).
+
+Cada post nuevo se copia como referencia {owner_id, post_id, author_id, created_at}
+en la colección `timelines` de cada amigo del autor, de modo que leer el timeline
+es una sola consulta por rango sobre (owner_id, created_at, post_id).
+
+Los autores con demasiados amigos no hacen fan-out: se marcan con
+`timeline_fanout_on_read` y sus posts se mezclan al leer (fan-out-on-read).
+"""
+from bson import ObjectId
+from datetime import datetime
+from pymongo.errors import BulkWriteError
+from typing import List, Optional, Tuple
+from app.database import db
+from app.utils.pagination import keyset_match
+from app.deletion import NOT_DELETED
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Por encima de este número de amigos el autor pasa a fan-out-on-read
+TIMELINE_FANOUT_LIMIT = int(os.getenv("TIMELINE_FANOUT_LIMIT", "500"))
+# Posts que se copian al timeline cuando nace una amistad
+TIMELINE_BACKFILL_SIZE = int(os.getenv("TIMELINE_BACKFILL_SIZE", "50"))
+
+
+def get_friend_ids(user: dict) -> List[str]:
+    """IDs (string) de los amigos según el mapa `relationships` del usuario"""
+    return [
+        user_id for user_id, rel_type in (user.get("relationships") or {}).items()
+        if rel_type == "friend"
+    ]
+
+
+async def _insert_entries(entries: List[dict]):
+    """Inserta entradas ignorando duplicados (índice único owner_id + post_id)"""
+    if not entries:
+        return
+    try:
+        await db.timelines.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        # 11000 = duplicado, esperado al reintentar o al hacer backfill
+        real_errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+        if real_errors:
+            raise
+
+
+async def fan_out_post(author: dict, post_id: ObjectId, created_at: datetime):
+    """Copia la referencia del post al timeline de cada amigo del autor"""
+    friend_ids = get_friend_ids(author)
+    if not friend_ids:
+        return
+
+    if author.get("timeline_fanout_on_read") or len(friend_ids) > TIMELINE_FANOUT_LIMIT:
+        # Demasiados amigos: los lectores mezclarán sus posts al leer
+        if not author.get("timeline_fanout_on_read"):
+            await db.users.update_one(
+                {"_id": ObjectId(author["_id"])},
+                {"$set": {"timeline_fanout_on_read": True}}
+            )
+            logger.info(f"Usuario {author['_id']} pasa a fan-out-on-read ({len(friend_ids)} amigos)")
+        return
+
+    author_oid = ObjectId(author["_id"])
+    await _insert_entries([
+        {
+            "owner_id": ObjectId(friend_id),
+            "post_id": post_id,
+            "author_id": author_oid,
+            "created_at": created_at
+        }
+        for friend_id in friend_ids
+    ])
+
+
+async def backfill_friendship(user_a: ObjectId, user_b: ObjectId):
+    """Copia los posts recientes de cada uno en el timeline del otro"""
+    for owner_oid, author_oid in ((user_a, user_b), (user_b, user_a)):
+        author = await db.users.find_one({"_id": author_oid}, {"timeline_fanout_on_read": 1})
+        if not author or author.get("timeline_fanout_on_read"):
+            # Sus posts ya se leen con fan-out-on-read
+            continue
+
+        recent_posts = await db.posts.find(
+            {"author_id": author_oid, **NOT_DELETED},
+            {"_id": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(TIMELINE_BACKFILL_SIZE).to_list(TIMELINE_BACKFILL_SIZE)
+
+        await _insert_entries([
+            {
+                "owner_id": owner_oid,
+                "post_id": post["_id"],
+                "author_id": author_oid,
+                "created_at": post["created_at"]
+            }
+            for post in recent_posts
+        ])
+
+
+async def read_timeline_page(
+    user: dict,
+    limit: int,
+    after: Optional[Tuple[datetime, ObjectId]] = None
+) -> List[Tuple[datetime, ObjectId]]:
+    """
+    Devuelve hasta limit + 1 pares (created_at, post_id) en orden descendente.
+    Mezcla las entradas materializadas con los posts de amigos en fan-out-on-read.
+    """
+    owner_oid = ObjectId(user["_id"])
+    friend_oids = [ObjectId(friend_id) for friend_id in get_friend_ids(user)]
+
+    timeline_query = {"owner_id": owner_oid}
+    if after:
+        timeline_query.update(keyset_match("created_at", after[0], after[1], id_field="post_id"))
+
+    entries = await db.timelines.find(
+        timeline_query,
+        {"post_id": 1, "created_at": 1}
+    ).sort([("created_at", -1), ("post_id", -1)]).limit(limit + 1).to_list(limit + 1)
+
+    page = {entry["post_id"]: entry["created_at"] for entry in entries}
+
+    # Amigos que no hacen fan-out: leer sus posts directamente
+    if friend_oids:
+        heavy_authors = await db.users.find(
+            {"_id": {"$in": friend_oids}, "timeline_fanout_on_read": True},
+            {"_id": 1}
+        ).to_list(None)
+
+        if heavy_authors:
+            posts_query = {"author_id": {"$in": [author["_id"] for author in heavy_authors]}, **NOT_DELETED}
+            if after:
+                posts_query.update(keyset_match("created_at", after[0], after[1]))
+
+            async for post in db.posts.find(
+                posts_query,
+                {"_id": 1, "created_at": 1}
+            ).sort([("created_at", -1), ("_id", -1)]).limit(limit + 1):
+                page.setdefault(post["_id"], post["created_at"])
+
+    merged = sorted(
+        ((created_at, post_id) for post_id, created_at in page.items()),
+        reverse=True
+    )
+    return merged[:limit + 1]
@@ -0,0 +1,72 @@
+# app/trending.py
+"""
+Puntuación de tendencia (hot_score) precalculada en cada post.
+
+    hot_score = log10(max(1, likes + 2 * comentarios)) + segundos_desde_EPOCH / TRENDING_DECAY_SECONDS
+
+El decaimiento está en el término de tiempo: un post nuevo necesita 10 veces
+menos interacción que uno publicado TRENDING_DECAY_SECONDS antes para quedar
+igual. Como la puntuación no cambia con el paso del tiempo, solo hay que
+recalcularla cuando cambian los contadores: es un campo derivado del buffer de
+contadores (se recalcula en la misma escritura que incrementa likes/comentarios),
+y el endpoint de tendencias es una lectura por rango del índice (hot_score, _id).
+"""
+from datetime import datetime, timezone
+from app.database import db
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+TRENDING_DECAY_SECONDS = float(os.getenv("TRENDING_DECAY_SECONDS", "45000"))
+# Los comentarios cuentan más que los likes
+COMMENT_WEIGHT = 2
+HOT_SCORE_EPOCH = datetime(2024, 1, 1)
+
+
+def hot_score(likes_count: int, comments_count: int, created_at: datetime) -> float:
+    """Misma fórmula que hot_score_expression, para calcularla al crear el post"""
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    engagement = max(1, (likes_count or 0) + COMMENT_WEIGHT * (comments_count or 0))
+    age = (created_at - HOT_SCORE_EPOCH).total_seconds()
+    return math.log10(engagement) + age / TRENDING_DECAY_SECONDS
+
+
+def hot_score_expression() -> dict:
+    """
+    Expresión de agregación que recalcula hot_score con los contadores del documento.
+    Si created_at no es una fecha deja hot_score como estaba, para no hacer fallar la
+    escritura de contadores que la incluye.
+    """
+    return {
+        "$cond": [
+            {"$eq": [{"$type": "$created_at"}, "date"]},
+            {"$add": [
+                {"$log10": {"$max": [
+                    1,
+                    {"$add": [
+                        {"$ifNull": ["$likes_count", 0]},
+                        {"$multiply": [COMMENT_WEIGHT, {"$ifNull": ["$comments_count", 0]}]}
+                    ]}
+                ]}},
+                {"$divide": [
+                    {"$subtract": ["$created_at", HOT_SCORE_EPOCH]},  # milisegundos
+                    TRENDING_DECAY_SECONDS * 1000
+                ]}
+            ]},
+            "$hot_score"
+        ]
+    }
+
+
+async def backfill_hot_scores() -> dict:
+    """Calcula hot_score en los posts que aún no lo tienen"""
+    result = await db.posts.update_many(
+        {"hot_score": {"$exists": False}, "created_at": {"$type": "date"}},
+        [{"$set": {"hot_score": hot_score_expression()}}]
+    )
+    if result.modified_count:
+        logger.info(f"hot_score calculado en {result.modified_count} posts")
+    return {"posts": result.modified_count}
@@ -0,0 +1,306 @@
+# app/uploads.py
+"""
+Almacenamiento de subidas direccionado por contenido.
+
+Cada archivo se guarda una sola vez en static/uploads/objects/ab/cd/<sha256>.<ext>,
+así que dos subidas con los mismos bytes (la misma foto como perfil y portada,
+o dos usuarios con `photo.jpg`) comparten archivo, y como el contenido de una
+URL no cambia nunca se puede servir con caché inmutable.
+
+La colección `uploads` lleva la cuenta de referencias por hash:
+
+    {_id: sha256, url, size, refs, kinds, created_at, updated_at}
+
+Cada subida suma una referencia; la suelta el documento que la usa cuando se
+borra (la imagen de la galería o el post), ver `app.deletion.delete_upload`.
+Mientras se borran sus archivos el registro lleva `deleting`; una subida de los
+mismos bytes en ese momento lo vuelve a reclamar (ver _remove_object_files).
+"""
+from bson import ObjectId
+from datetime import datetime, timedelta
+from fastapi import UploadFile
+from pymongo import ReturnDocument
+from typing import Iterator, List, Optional, Set, Tuple
+from app.database import db
+from app.image_variants import VARIANTS_DIR, variant_paths
+from app.utils.util import stream_upload, discard_temp
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_DIR = "static/uploads"
+OBJECTS_DIR = f"{UPLOADS_DIR}/objects"
+OBJECTS_PREFIX = f"/{OBJECTS_DIR}/"
+VARIANTS_PREFIX = f"/{UPLOADS_DIR}/{VARIANTS_DIR}/"
+
+# Recolector de subidas huérfanas (ver collect_orphan_uploads)
+UPLOAD_GC_GRACE_SECONDS = int(os.getenv("UPLOAD_GC_GRACE_SECONDS", str(24 * 3600)))
+UPLOAD_GC_BATCH_SIZE = int(os.getenv("UPLOAD_GC_BATCH_SIZE", "500"))
+UPLOAD_GC_DELETES_PER_SECOND = float(os.getenv("UPLOAD_GC_DELETES_PER_SECOND", "20"))
+
+
+def object_url(sha256: str, extension: str) -> str:
+    """URL del archivo con ese hash, repartida en dos niveles de subdirectorios"""
+    return f"{OBJECTS_PREFIX}{sha256[:2]}/{sha256[2:4]}/{sha256}.{extension}"
+
+
+def is_object_url(url: Optional[str]) -> bool:
+    return bool(url) and url.startswith(OBJECTS_PREFIX)
+
+
+def object_hash(url: str) -> str:
+    return os.path.splitext(os.path.basename(url))[0]
+
+
+def _is_hash(value: str) -> bool:
+    return len(value) == 64 and all(char in "0123456789abcdef" for char in value)
+
+
+async def store_upload(file: UploadFile, kind: str) -> str:
+    """
+    Guarda una subida (por bloques, ver stream_upload) y suma una referencia a su hash.
+    Si los mismos bytes ya estaban guardados se descarta la copia nueva.
+    `kind` es la carpeta lógica (posts, profile_pictures, cover_photos) y define sus variantes.
+    Devuelve la URL relativa.
+    """
+    temp_path, sha256, extension, size = await stream_upload(file, OBJECTS_DIR)
+    url = object_url(sha256, extension)
+    path = url.lstrip("/")
+    try:
+        now = datetime.utcnow()
+        previous = await db.uploads.find_one_and_update(
+            {"_id": sha256},
+            {
+                "$inc": {"refs": 1},
+                "$addToSet": {"kinds": kind},
+                "$set": {"updated_at": now},
+                "$unset": {"deleting": ""},
+                "$setOnInsert": {"url": url, "size": size, "created_at": now}
+            },
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        # Se escribe también si el registro existía pero el archivo se perdió o se estaba borrando
+        if previous is None or previous.get("deleting") or not await asyncio.to_thread(os.path.exists, path):
+            await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
+            await asyncio.to_thread(os.replace, temp_path, path)
+        else:
+            logger.info(f"Subida duplicada de {sha256}: se reutiliza el archivo existente")
+        return url
+    finally:
+        await discard_temp(temp_path)
+
+
+async def release_reference(url: str) -> int:
+    """Resta la referencia de un documento que deja de usar la subida; devuelve las que quedan"""
+    upload = await db.uploads.find_one_and_update(
+        {"_id": object_hash(url)},
+        {"$inc": {"refs": -1}, "$set": {"updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    return upload["refs"] if upload else 0
+
+
+def _remove_file(path: str) -> int:
+    """Borra un archivo y devuelve los bytes liberados (0 si ya no existía)"""
+    try:
+        size = os.stat(path).st_size
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_paths(paths: List[str]) -> int:
+    """Borra los archivos y devuelve los bytes liberados"""
+    return sum(_remove_file(path) for path in paths)
+
+
+def _move_aside(path: str, target: str) -> bool:
+    """Renombra el archivo y le pone la hora actual (el recolector respeta el periodo de gracia)"""
+    try:
+        os.rename(path, target)
+    except FileNotFoundError:
+        return False
+    os.utime(target)
+    return True
+
+
+async def _remove_object_files(url: str, condition: dict) -> Optional[int]:
+    """
+    Borra una subida direccionada por contenido (y sus variantes) sin llevarse por
+    delante una subida simultánea de los mismos bytes:
+
+    1. marca el registro con `deleting` si cumple `condition`,
+    2. aparta el archivo a <ruta>.<marca>.deleting,
+    3. borra el registro solo si sigue con su marca. Si store_upload lo reclamó
+       entretanto, el archivo apartado vuelve a su sitio (mismo hash, mismos bytes)
+       y no se borra nada.
+
+    Sin registro (subidas anteriores al recuento) se borra directamente.
+    Devuelve los bytes liberados, o None si la subida sigue en uso.
+    """
+    sha256 = object_hash(url)
+    path = url.lstrip("/")
+    token = ObjectId()
+    result = await db.uploads.update_one({"_id": sha256, **condition}, {"$set": {"deleting": token}})
+    if not result.matched_count and await db.uploads.count_documents({"_id": sha256}, limit=1):
+        return None
+
+    aside = f"{path}.{token}.deleting"
+    moved = await asyncio.to_thread(_move_aside, path, aside)
+    result = await db.uploads.delete_one({"_id": sha256, "deleting": token})
+    if not result.deleted_count and await db.uploads.count_documents({"_id": sha256}, limit=1):
+        if moved:
+            await asyncio.to_thread(os.replace, aside, path)
+        logger.info(f"Subida {sha256} reclamada durante su borrado: se conserva")
+        return None
+
+    freed = await asyncio.to_thread(_remove_paths, variant_paths(url))
+    if moved:
+        freed += await asyncio.to_thread(_remove_file, aside)
+    return freed
+
+
+async def remove_upload_files(url: str) -> bool:
+    """
+    Borra del disco una subida y sus variantes.
+    Para las direccionadas por contenido solo si su registro sigue sin referencias
+    (otra subida de los mismos bytes pudo volver a reclamarla, ver _remove_object_files).
+    """
+    if is_object_url(url):
+        return bool(await _remove_object_files(url, {"refs": {"$lte": 0}}))
+
+    for path in variant_paths(url):
+        try:
+            await asyncio.to_thread(os.remove, path)
+        except FileNotFoundError:
+            pass
+
+    try:
+        await asyncio.to_thread(os.remove, url.lstrip("/"))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _scan_uploads(cutoff: float, batch_size: int) -> Iterator[List[Tuple[str, int]]]:
+    """
+    Recorre static/uploads con os.scandir (sin listar directorios enteros en memoria)
+    y produce lotes de (url, tamaño) de los archivos modificados antes de `cutoff`.
+    Es síncrono: se avanza lote a lote desde un hilo.
+    """
+    batch = []
+    pending = [UPLOADS_DIR]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                # Archivos ocultos (.gitkeep...) salvo los temporales de subida
+                if entry.name.startswith(".") and not entry.name.endswith(".part"):
+                    continue
+                stat_result = entry.stat(follow_symlinks=False)
+                if stat_result.st_mtime >= cutoff:
+                    continue
+                batch.append(("/" + entry.path.replace(os.sep, "/"), stat_result.st_size))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+async def _referenced_urls(urls: List[str]) -> Set[str]:
+    """URLs del lote a las que apunta algún documento (una consulta por índice y colección)"""
+    query = {"$in": urls}
+    referenced = set(await db.posts.distinct("image_url", {"image_url": query}))
+    referenced.update(await db.images.distinct("url", {"url": query}))
+    referenced.update(await db.users.distinct("profile_picture", {"profile_picture": query}))
+    referenced.update(await db.users.distinct("cover_photo", {"cover_photo": query}))
+    return referenced
+
+
+async def collect_orphan_uploads(dry_run: bool = False) -> dict:
+    """
+    Borra los archivos de static/uploads que ningún documento usa y que tienen más de
+    UPLOAD_GC_GRACE_SECONDS (p. ej. imágenes subidas con /images/upload que nunca se
+    adjuntaron a un post, o restos de borrados interrumpidos):
+
+    - originales sin referencias en posts.image_url, images.url ni en la foto de perfil
+      o portada de un usuario (con sus variantes); los direccionados por contenido
+      además pierden su registro en `uploads`, salvo que se haya vuelto a subir hace poco,
+    - variantes cuyo original direccionado por contenido ya no está registrado,
+    - temporales `.part` de subidas que no terminaron y `.deleting` de borrados interrumpidos.
+
+    El directorio y las referencias se procesan por lotes de UPLOAD_GC_BATCH_SIZE y los
+    borrados se limitan a UPLOAD_GC_DELETES_PER_SECOND. Con dry_run solo se cuenta.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=UPLOAD_GC_GRACE_SECONDS)
+    delay = 1 / UPLOAD_GC_DELETES_PER_SECOND if UPLOAD_GC_DELETES_PER_SECOND > 0 else 0
+    report = {"scanned": 0, "orphans": 0, "deleted": 0, "reclaimed_bytes": 0, "dry_run": dry_run}
+
+    async def reclaim(url: str, size: int, paths: List[str]):
+        report["orphans"] += 1
+        if dry_run:
+            report["reclaimed_bytes"] += size
+            return
+        for path in paths:
+            report["reclaimed_bytes"] += await asyncio.to_thread(_remove_file, path)
+        report["deleted"] += 1
+        if delay:
+            await asyncio.sleep(delay)
+
+    batches = _scan_uploads(time.time() - UPLOAD_GC_GRACE_SECONDS, UPLOAD_GC_BATCH_SIZE)
+    while True:
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            break
+        report["scanned"] += len(batch)
+
+        originals = [
+            (url, size) for url, size in batch
+            if not url.endswith((".part", ".deleting")) and not url.startswith(VARIANTS_PREFIX)
+        ]
+        referenced = await _referenced_urls([url for url, _ in originals]) if originals else set()
+
+        variant_hashes = {
+            url: os.path.basename(url).split("_", 1)[0]
+            for url, _ in batch if url.startswith(VARIANTS_PREFIX)
+        }
+        candidate_hashes = [value for value in variant_hashes.values() if _is_hash(value)]
+        registered = set(await db.uploads.distinct("_id", {"_id": {"$in": candidate_hashes}})) if candidate_hashes else set()
+
+        for url, size in batch:
+            if url.endswith((".part", ".deleting")):
+                await reclaim(url, size, [url.lstrip("/")])
+            elif url in variant_hashes:
+                sha256 = variant_hashes[url]
+                if _is_hash(sha256) and sha256 not in registered:
+                    await reclaim(url, size, [url.lstrip("/")])
+            elif url not in referenced:
+                if is_object_url(url) and not dry_run:
+                    # Se conserva si alguien ha vuelto a subir los mismos bytes después del corte
+                    freed = await _remove_object_files(url, {"updated_at": {"$lt": cutoff}})
+                    if freed is None:
+                        continue
+                    report["orphans"] += 1
+                    report["deleted"] += 1
+                    report["reclaimed_bytes"] += freed
+                    if delay:
+                        await asyncio.sleep(delay)
+                    continue
+                await reclaim(url, size, [*variant_paths(url), url.lstrip("/")])
+
+    logger.info(f"Recolección de subidas huérfanas: {report}")
+    return report
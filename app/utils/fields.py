@@ -0,0 +1,64 @@
+from fastapi import HTTPException, status
+from pydantic import BaseModel, Field, create_model
+from typing import Iterable, Optional, Set, Type
+
+
+def parse_fields(fields: Optional[str], allowed: Iterable[str]) -> Optional[Set[str]]:
+    """
+    Convierte el parámetro `?fields=a,b,c` en un conjunto de campos.
+    Devuelve None si no se pidió proyección (documento completo).
+    `_id` se incluye siempre; `id` se acepta como sinónimo de `_id`.
+    Lanza 400 si se pide un campo que el endpoint no expone.
+    """
+    if fields is None or not fields.strip():
+        return None
+
+    selected = {"_id"}
+    for field in fields.split(","):
+        field = field.strip()
+        if not field:
+            continue
+        selected.add("_id" if field == "id" else field)
+
+    unknown = selected - set(allowed)
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Campos no válidos en fields: {', '.join(sorted(unknown))}"
+        )
+    return selected
+
+
+def project_stage(selected: Set[str], stored: Iterable[str], extra: Iterable[str] = ()) -> dict:
+    """
+    Etapa $project con los campos pedidos que existen en la colección (`stored`)
+    más los que el servidor necesita internamente (`extra`, p. ej. para joins o cursores).
+    """
+    projection = {field: 1 for field in (selected & set(stored)) | set(extra)}
+    projection.setdefault("_id", 1)
+    return {"$project": projection}
+
+
+def pick_fields(doc: dict, selected: Optional[Set[str]]) -> dict:
+    """Deja en el documento solo los campos pedidos (quita los auxiliares de la proyección)"""
+    if selected is None:
+        return doc
+    return {key: value for key, value in doc.items() if key in selected}
+
+
+def model_field_names(model: Type[BaseModel]) -> Set[str]:
+    """Nombres públicos de los campos de un modelo (el alias si lo tiene, p. ej. `_id`)"""
+    return {info.alias or name for name, info in model.model_fields.items()}
+
+
+def partial_model(model: Type[BaseModel], name: str) -> Type[BaseModel]:
+    """
+    Versión del modelo con todos los campos opcionales, para respuestas con `?fields=`.
+    Las rutas que la usan deben declarar response_model_exclude_unset=True para que
+    los campos no pedidos no aparezcan como null.
+    """
+    overrides = {
+        field_name: (Optional[info.annotation], Field(None, alias=info.alias))
+        for field_name, info in model.model_fields.items()
+    }
+    return create_model(name, __base__=model, **overrides)
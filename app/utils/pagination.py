@@ -0,0 +1,68 @@
+from fastapi import HTTPException, status
+from bson import ObjectId
+from datetime import datetime
+from typing import Any, Tuple, Union
+import base64
+import json
+
+SortValue = Union[datetime, int, float]
+
+
+def encode_cursor(sort_value: SortValue, object_id: Union[ObjectId, str]) -> str:
+    """
+    Codifica (valor de orden, _id) en un cursor opaco para paginación por keyset
+    """
+    if isinstance(sort_value, datetime):
+        payload = {"t": "d", "v": sort_value.isoformat()}
+    else:
+        payload = {"t": "n", "v": sort_value}
+    payload["id"] = str(object_id)
+
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[SortValue, ObjectId]:
+    """
+    Decodifica un cursor generado por encode_cursor.
+    Lanza 400 si el cursor fue alterado o no es válido.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if payload["t"] == "d":
+            sort_value = datetime.fromisoformat(payload["v"])
+        else:
+            sort_value = payload["v"]
+            if not isinstance(sort_value, (int, float)):
+                raise ValueError("valor de orden inválido")
+        return sort_value, ObjectId(payload["id"])
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor inválido"
+        )
+
+
+def keyset_match(
+    field: str,
+    sort_value: Any,
+    object_id: ObjectId,
+    descending: bool = True,
+    id_field: str = "_id"
+) -> dict:
+    """
+    Construye el filtro para continuar después de (sort_value, object_id).
+
+    La condición sobre `field` va fuera del $or para que Mongo la use como
+    límite del rango del índice; el $or solo desempata por `id_field`.
+    """
+    op = "$lt" if descending else "$gt"
+    bound = "$lte" if descending else "$gte"
+    return {
+        field: {bound: sort_value},
+        "$or": [
+            {field: {op: sort_value}},
+            {field: sort_value, id_field: {op: object_id}}
+        ]
+    }
@@ -1,50 +1,136 @@
 from fastapi import UploadFile
 from fastapi import HTTPException  # ← AÑADE ESTA IMPORTACIÓN
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Optional, Tuple
+import asyncio
+import hashlib
 import os
 import uuid
 
-async def upload_file_to_storage(file: UploadFile, folder: str):
-    # Implementación de ejemplo para almacenamiento local
-    import os
-    from fastapi import UploadFile
-    
-    upload_dir = f"static/uploads/{folder}"
-    os.makedirs(upload_dir, exist_ok=True)
-    
-    file_path = f"{upload_dir}/{file.filename}"
-    
-    with open(file_path, "wb") as buffer: 
-        content = await file.read()
-        buffer.write(content)
-    
-    return f"/{file_path}"  # URL relativa
-
-async def upload_file_to_storage_post(file: UploadFile, folder: str):
+# Tamaño máximo por archivo y tamaño de cada bloque leído del request
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+# Margen para los límites del multipart y los demás campos del formulario
+UPLOAD_FORM_OVERHEAD_BYTES = int(os.getenv("UPLOAD_FORM_OVERHEAD_BYTES", str(64 * 1024)))
+
+# Firmas (magic bytes) de los formatos de imagen aceptados -> extensión
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Extensión según el contenido real del archivo (no según el nombre ni el Content-Type)"""
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _write_chunk(buffer, digest, chunk: bytes):
+    # hashlib suelta el GIL con bloques grandes: hash y escritura van juntos al hilo
+    digest.update(chunk)
+    buffer.write(chunk)
+
+
+async def stream_upload(file: UploadFile, upload_dir: str) -> Tuple[str, str, str, int]:
     """
-    Sube un archivo al almacenamiento local y devuelve la URL relativa
+    Guarda el archivo por bloques en un temporal de `upload_dir` calculando su SHA-256.
+    Devuelve (ruta del temporal, sha256, extensión detectada, tamaño en bytes).
+    Las escrituras van a un hilo para no bloquear el event loop.
+
+    - Comprueba el tipo real con los primeros bytes (415 si no es una imagen).
+    - 413 si el archivo supera UPLOAD_MAX_BYTES. Cuando se llama, Starlette ya ha
+      recibido el cuerpo entero (lo guarda en un SpooledTemporaryFile al parsear el
+      formulario); lo que impide recibir cuerpos enormes es UploadSizeLimitMiddleware.
+
+    El llamador mueve el temporal a su sitio (os.replace es atómico en el mismo
+    sistema de archivos, así nunca queda un archivo a medias publicado) o lo borra.
     """
+    await asyncio.to_thread(os.makedirs, upload_dir, exist_ok=True)
+    temp_path = os.path.join(upload_dir, f".{uuid.uuid4().hex}.part")
+    buffer = await asyncio.to_thread(open, temp_path, "wb")
+    digest = hashlib.sha256()
     try:
-        # Crear directorio si no existe
-        upload_dir = f"static/uploads/{folder}"
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        # Generar nombre único para el archivo
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else ''
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        
-        # Ruta completa del archivo
-        file_path = os.path.join(upload_dir, unique_filename)
-        
-        # Guardar el archivo
-        with open(file_path, "wb") as buffer: 
-            content = await file.read()
-            buffer.write(content)
-        
-        return f"/{file_path}"  # URL relativa
-        
-    except Exception as e:
-        # Ahora HTTPException está definido
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error al subir el archivo: {str(e)}"
-        )
\ No newline at end of file
+        size = 0
+        extension = None
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if extension is None:
+                extension = sniff_image_type(chunk[:16])
+                if extension is None:
+                    raise HTTPException(status_code=415, detail="Formato de imagen no soportado")
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=_too_large_detail())
+            await asyncio.to_thread(_write_chunk, buffer, digest, chunk)
+
+        if extension is None:
+            raise HTTPException(status_code=400, detail="El archivo está vacío")
+
+        await asyncio.to_thread(buffer.close)
+        return temp_path, digest.hexdigest(), extension, size
+    except BaseException:
+        await asyncio.to_thread(buffer.close)
+        await discard_temp(temp_path)
+        raise
+
+
+async def discard_temp(temp_path: str):
+    try:
+        await asyncio.to_thread(os.remove, temp_path)
+    except FileNotFoundError:
+        pass
+
+
+def _too_large_detail() -> str:
+    return f"El archivo supera el tamaño máximo de {UPLOAD_MAX_BYTES // (1024 * 1024)} MB"
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Limita el cuerpo de las peticiones multipart/form-data antes de que se parseen:
+    413 directamente si el Content-Length declarado supera el límite, y para cuerpos
+    sin Content-Length (chunked) 413 en cuanto lo recibido lo supera, sin leer el resto.
+    """
+    def __init__(self, app: ASGIApp, max_body_bytes: int = UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD_BYTES):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if not headers.get("content-type", "").startswith("multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            response = JSONResponse({"detail": _too_large_detail()}, status_code=413, headers={"Connection": "close"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes:
+                    # FastAPI deja pasar las HTTPException lanzadas al leer el cuerpo
+                    raise HTTPException(status_code=413, detail=_too_large_detail())
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -5,6 +5,7 @@ import asyncio
 from app.models.notification_model import Notification
 from fastapi import WebSocketDisconnect
 from collections import defaultdict
+from bson import ObjectId
 import logging
 
 logger = logging.getLogger(__name__)
@@ -177,7 +178,11 @@ class WebSocketManager:
                     notification["_id"] = str(notification["_id"])  # Convertir ObjectId a string
                     notification["user_id"] = str(notification.get("user_id", ""))
                     notification["emitter_id"] = str(notification.get("emitter_id", ""))
-                    notification = Notification.model_validate(notification)
+                    # Las demás referencias (post_id, image_owner_id...) también se guardan como ObjectId
+                    notification = Notification.model_validate({
+                        key: str(value) if isinstance(value, ObjectId) else value
+                        for key, value in notification.items()
+                    })
                 
                 notification_dict = notification.model_dump(by_alias=True, mode='json')
             
@@ -301,8 +306,9 @@ class WebSocketManager:
                     "data": {
                         "image_id": image_id,
                         "likes_count": serializable_data.get("likes_count", 0),
-                        "liked_by": serializable_data.get("liked_by", []),
-                        "timestamp": serializable_data.get("updated_at")
+                        "user_id": serializable_data.get("user_id"),
+                        "liked": serializable_data.get("liked"),
+                        "timestamp": serializable_data.get("timestamp")
                     }
                 }
                 logger.info(f"📤 Enviando mensaje {i+1}/{len(self.image_connections[image_id])}")